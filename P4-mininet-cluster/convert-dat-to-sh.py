@@ -1,4 +1,5 @@
 import argparse
+import json
 import os, shutil, stat
 
 parser=argparse.ArgumentParser(description="traff gen scripts")
@@ -10,6 +11,7 @@ parser.add_argument('--numhosts',dest="numhosts",default=2,help="Number of hosts
 parser.add_argument('--start',dest="start",default=5,help="Number of switches")
 parser.add_argument('--src_mapping', dest="src_mapping", default=None, help="mapping from consecutive number to node id for source nodes")
 parser.add_argument('--dst_mapping', dest="dst_mapping", default=None, help="mapping from consecutive number to node id for destination nodes")
+parser.add_argument('--addresses', dest="addresses", default=None, help="address table of the topology (addresses.json), to take host IPs from instead of the 10.0.<tor>.<21+n> layout")
 
 args=parser.parse_args()
 print args
@@ -31,24 +33,36 @@ dst_hostips=[]
 #start=(kary*kary)/4+(kary*kary)
 start=int(args.start)
 
-if args.src_mapping != None:
-	for i in range(0, len(src_nodes)):
+if args.addresses != None:
+	with open(args.addresses) as f:
+		hosts=json.load(f)['hosts']
+	if args.src_mapping != None:
+		src_hostips=[hosts['h'+str(int(n)+start)]['ip'] for n in src_nodes]
+	else:
+		src_hostips=[hosts['h'+str(start+i+1)]['ip'] for i in range(0, numhosts/2)]
+	if args.dst_mapping != None:
+		dst_hostips=[hosts['h'+str(int(n)+start)]['ip'] for n in dst_nodes]
+	else:
+		dst_hostips=[hosts['h'+str(start+i+1)]['ip'] for i in range(numhosts/2, numhosts)]
+else:
+	if args.src_mapping != None:
+		for i in range(0, len(src_nodes)):
 #			index = numtorhosts*(i-1)+(h-21)
 			print src_nodes[i]
 			src_hostips.append('10.0.'+str((int(src_nodes[i])-1)/numtorhosts+1)+'.'+str((int(src_nodes[i])-1)%numtorhosts+21))
-else:
-	for i in range(1,(numtors/2)+1):
-		for h in range(21,21+numtorhosts):
-			src_hostips.append('10.0.'+str(i)+'.'+str(h))
-if args.dst_mapping != None:
-	for i in range(0, len(dst_nodes)):
+	else:
+		for i in range(1,(numtors/2)+1):
+			for h in range(21,21+numtorhosts):
+				src_hostips.append('10.0.'+str(i)+'.'+str(h))
+	if args.dst_mapping != None:
+		for i in range(0, len(dst_nodes)):
 #			index = numtorhosts*(i-(numtors/2)-1)+h-21
 			print dst_nodes[i]
 			dst_hostips.append('10.0.'+str((int(dst_nodes[i])-1)/numtorhosts+1)+'.'+str((int(dst_nodes[i])-1)%numtorhosts+21))
-else:
-	for i in range((numtors/2)+1, numtors+1):
-		for h in range(21,21+numtorhosts):
-			dst_hostips.append('10.0.'+str(i)+'.'+str(h))
+	else:
+		for i in range((numtors/2)+1, numtors+1):
+			for h in range(21,21+numtorhosts):
+				dst_hostips.append('10.0.'+str(i)+'.'+str(h))
 
 print src_hostips
 print dst_hostips
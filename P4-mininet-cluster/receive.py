@@ -1,7 +1,11 @@
 #!/usr/bin/env python
+import os
 import sys
 import struct
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils', 'mininet'))
+from addressing import load_table
+
 from scapy.all import sniff, sendp, hexdump, get_if_list, get_if_hwaddr
 from scapy.all import Packet, IPOption
 from scapy.all import ShortField, IntField, LongField, BitField, FieldListField, FieldLenField
@@ -32,8 +36,11 @@ class IPOption_MRI(IPOption):
                                    [],
                                    IntField("", 0),
                                    length_from=lambda pkt:pkt.count*4) ]
-def handle_pkt(pkt):
+def handle_pkt(pkt, addresses=None):
     print "got a packet"
+    if addresses and IP in pkt:
+        print "%s -> %s" % (addresses.get(pkt[IP].src, pkt[IP].src),
+                            addresses.get(pkt[IP].dst, pkt[IP].dst))
     pkt.show2()
 #    hexdump(pkt)
     sys.stdout.flush()
@@ -41,10 +48,11 @@ def handle_pkt(pkt):
 
 def main():
     iface = sys.argv[1]+'-eth0'
+    addresses = load_table(sys.argv[2])['by_ip'] if len(sys.argv) > 2 else None
     print "sniffing on %s" % iface
     sys.stdout.flush()
     sniff(filter="ip", iface = iface,
-          prn = lambda x: handle_pkt(x))
+          prn = lambda x: handle_pkt(x, addresses))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python2
+
+# Addressing plans for AppTopo.
+#
+# A plan gives every host its IP and MAC address and every switch port its
+# MAC (and, towards a host, the IP the host routes through), from the
+# numbers in node names (h<n>, s<n>). The addresses of a built topology are
+# exported as a JSON lookup table, written to the log directory of a run
+# (addresses.json) or, without running anything, by:
+#
+#     addressing.py --manifest p4app.json --target multiswitch -o addresses.json
+#
+# for convert-dat-to-sh.py (--addresses), the controller and capture tools
+# to share.
+#
+#     { "plan": "legacy", "prefix_len": 16,
+#       "hosts": { "h46": { "ip": "10.0.1.21", "mac": "00:04:00:00:00:2e",
+#                           "links": { "s1": { "sw_ip", "sw_mac", "sw_port",
+#                                              "idx" } } } },
+#       "switches": { "s1": { "s21": { "mac", "port", "peer_mac",
+#                                      "peer_port" } } } }
+
+import abc
+import argparse
+import json
+
+from mininet.log import warn
+
+
+class AddressPlan(object):
+    """Addresses of hosts and switch ports. Control host n is host n of
+    switch n's subnet; end host i of ToR t is host 21 + i of ToR t's
+    subnet."""
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+    # Length of the prefix every host address is in
+    prefix_len = None
+    # Highest switch or host number, and the most end hosts of a ToR
+    max_node = None
+    max_end_hosts = 234
+
+    def fits(self, max_node, max_end_hosts=0):
+        "Can the plan address nodes up to max_node without collisions?"
+        return max_node <= self.max_node and max_end_hosts <= self.max_end_hosts
+
+    def check(self, max_node, max_end_hosts=0):
+        "Raise an exception if addresses would collide"
+        if not self.fits(max_node, max_end_hosts):
+            raise Exception('The %s addressing plan addresses nodes numbered up to %d, with up to %d '
+                            'end hosts per ToR; this topology has node %d and %d end hosts per ToR. '
+                            'Use "addressing": "wide" in the target' % (
+                                self.name, self.max_node, self.max_end_hosts, max_node, max_end_hosts))
+
+    def control_host(self, host_num):
+        "(ip, mac) of control host h<host_num>"
+        return self.subnet_ip(host_num, 10), self.host_mac(host_num)
+
+    def end_host(self, host_num, tor_num, index):
+        "(ip, mac) of h<host_num>, end host index (from 0) of ToR s<tor_num>"
+        return self.subnet_ip(tor_num, 21 + index), self.host_mac(host_num)
+
+    def host_port(self, sw_num, host_num, idx):
+        "(sw_ip, sw_mac) of the port of s<sw_num> to host link idx of h<host_num>"
+        return self.subnet_ip(host_num, idx + 1), self.host_port_mac(sw_num, host_num)
+
+    def subnet(self, num):
+        "Prefix (a.b.c.0/24) of the subnet of node num"
+        return self.subnet_ip(num, 0) + '/24'
+
+    @abc.abstractmethod
+    def subnet_ip(self, num, host):
+        "IP address host of the subnet of node num"
+
+    @abc.abstractmethod
+    def host_mac(self, host_num):
+        "MAC of h<host_num>"
+
+    @abc.abstractmethod
+    def host_port_mac(self, sw_num, host_num):
+        "MAC of the port of s<sw_num> to h<host_num>"
+
+    @abc.abstractmethod
+    def switch_port_mac(self, sw_num, peer_num):
+        "MAC of the port of s<sw_num> to switch s<peer_num>"
+
+
+class LegacyPlan(AddressPlan):
+    """The original layout: subnet 10.0.<n>.0/24 of node n in 10.0.0.0/16,
+    with single-byte node numbers in MACs"""
+    name = 'legacy'
+    prefix_len = 16
+    max_node = 255
+
+    def subnet_ip(self, num, host):
+        return '10.0.%d.%d' % (num, host)
+
+    def host_mac(self, host_num):
+        return '00:04:00:00:00:%02x' % host_num
+
+    def host_port_mac(self, sw_num, host_num):
+        return '00:aa:00:%02x:00:%02x' % (sw_num, host_num)
+
+    def switch_port_mac(self, sw_num, peer_num):
+        return '00:aa:00:%02x:%02x:00' % (sw_num, peer_num)
+
+
+def _mac(kind, value):
+    "Locally administered MAC: 02, a kind byte and a 32-bit value"
+    return ':'.join(['02', '%02x' % kind] +
+                    ['%02x' % (value >> shift & 0xff) for shift in (24, 16, 8, 0)])
+
+
+class WidePlan(AddressPlan):
+    """Two-byte node numbers: subnet 10.<n / 256>.<n % 256>.0/24 of node n
+    in 10.0.0.0/8, and MACs with a byte for the kind of address (04 host,
+    aa port to a host, ab port to a switch) and the rest for node numbers"""
+    name = 'wide'
+    prefix_len = 8
+    max_node = 0xffff
+
+    def subnet_ip(self, num, host):
+        return '10.%d.%d.%d' % (num >> 8, num & 0xff, host)
+
+    def host_mac(self, host_num):
+        return _mac(0x04, host_num)
+
+    def host_port_mac(self, sw_num, host_num):
+        return _mac(0xaa, sw_num << 16 | host_num)
+
+    def switch_port_mac(self, sw_num, peer_num):
+        return _mac(0xab, sw_num << 16 | peer_num)
+
+
+# Values of a target's "addressing" in p4app.json, besides "auto": the
+# legacy plan when the topology fits it, else the wide one
+PLANS = {
+    'legacy': LegacyPlan,
+    'wide': WidePlan,
+}
+
+
+def make_plan(name, max_node, max_end_hosts=0):
+    """Addressing plan name for a topology whose highest node number is
+    max_node, with up to max_end_hosts end hosts per ToR
+    returns: AddressPlan"""
+    name = name or 'auto'
+    if name == 'auto':
+        plan = LegacyPlan()
+        if not plan.fits(max_node, max_end_hosts):
+            warn('*** Node numbers up to %d do not fit the legacy addressing plan; '
+                 'using the wide one\n' % max_node)
+            plan = WidePlan()
+    elif name in PLANS:
+        plan = PLANS[name]()
+    else:
+        raise Exception('Unknown addressing "%s", expected auto or one of %s' % (
+            name, ', '.join(sorted(PLANS))))
+    plan.check(max_node, max_end_hosts)
+    return plan
+
+
+def address_table(topo):
+    "Lookup table of the addresses of an AppTopo"
+    plan = topo.address_plan
+    table = dict(plan=plan.name, prefix_len=plan.prefix_len, hosts={}, switches={})
+    for host, links in topo._host_links.iteritems():
+        entry = table['hosts'][host] = dict(links={})
+        for sw, link in links.iteritems():
+            entry['ip'], entry['mac'] = link['host_ip'], link['host_mac']
+            entry['links'][sw] = dict((k, link[k]) for k in ('sw_ip', 'sw_mac', 'sw_port', 'idx'))
+    for sw, links in topo._sw_links.iteritems():
+        table['switches'][sw] = dict(
+            (peer, dict(mac=port['mac'], port=port['port'],
+                        peer_mac=peer_port['mac'], peer_port=peer_port['port']))
+            for peer, (port, peer_port) in links.iteritems())
+    return table
+
+
+def write_table(topo, path):
+    "Write the address lookup table of an AppTopo to path"
+    with open(path, 'w') as f:
+        json.dump(address_table(topo), f, indent=2, sort_keys=True)
+    return path
+
+
+def load_table(path):
+    """Read an address lookup table, adding reverse lookups "by_ip" and
+    "by_mac": address -> node name"""
+    with open(path, 'r') as f:
+        table = json.load(f)
+    table['by_ip'], table['by_mac'] = {}, {}
+    for host, entry in table['hosts'].iteritems():
+        table['by_ip'][entry['ip']] = host
+        table['by_mac'][entry['mac']] = host
+        for sw, link in entry['links'].iteritems():
+            table['by_ip'][link['sw_ip']] = sw
+            table['by_mac'][link['sw_mac']] = sw
+    for sw, links in table['switches'].iteritems():
+        for port in links.values():
+            table['by_mac'][port['mac']] = sw
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Address table of a multiswitch target')
+    parser.add_argument('--manifest', '-m', help='Path to manifest file',
+                        type=str, action="store", required=True)
+    parser.add_argument('--target', '-t', help='Target in manifest file',
+                        type=str, action="store", required=True)
+    parser.add_argument('--output', '-o', help='File to write the table to',
+                        type=str, action="store", required=True)
+    args = parser.parse_args()
+
+    import apptopo
+    with open(args.manifest, 'r') as f:
+        manifest = json.load(f)
+    conf = manifest['targets'][args.target]
+    links = [l[:2] for l in conf['links']]
+    switch_info = dict((n, 'switch.json') for l in links for n in l if n[0] == 's')
+    args.behavioral_exe = 'simple_switch'
+    args.thrift_port = 9090
+    topo = apptopo.AppTopo(links, switch_info, args, False, False, manifest=manifest,
+                           target=args.target, NUM_END_HOSTS=int(conf.get('NUM_END_HOSTS', 0)))
+    print 'Addresses (%s plan) written to %s' % (topo.address_plan.name, write_table(topo, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+agent.py: per-server command agent for MininetCluster
+
+Even over a shared ssh connection, every rcmd() starts a new ssh session
+and a sudo on the server. An agent is a single long-lived root process on
+a server that runs batches of commands sent to it over its stdin, and
+sends their results back over its stdout.
+
+Frames in both directions are a decimal byte count on a line of its own,
+followed by that many bytes of JSON:
+
+    request:  { "cmds": [ { "cmd": "ip link show", "ns": 1234 }, ... ],
+                "parallel": false }
+    response: { "results": [ { "out": "...", "code": 0 }, ... ] }
+
+A command with an "ns" runs in the namespaces of that pid (mnexec -a),
+otherwise in the server's root namespace. Output is stdout and stderr
+combined, like RemoteMixin.rcmd().
+
+The agent needs nothing but this file on the server: Agent() sends the
+source over the channel itself, so the same client works for remote
+servers (over ssh) and for localhost.
+"""
+
+import json
+import os
+import subprocess
+import sys
+from pipes import quote
+from threading import Lock, Thread
+
+# Read the agent's source from stdin, then run it
+BOOT = ( 'import sys; '
+         'exec( sys.stdin.read( int( sys.stdin.readline() ) ) )' )
+
+
+def readFrame( f ):
+    "Read one frame from f, or return None at EOF"
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads( f.read( int( line ) ) )
+
+
+def writeFrame( f, obj ):
+    "Write obj to f as one frame"
+    data = json.dumps( obj )
+    f.write( '%d\n%s' % ( len( data ), data ) )
+    f.flush()
+
+
+def runCmd( cmd ):
+    """Run one command of a request; returns its result. A command that
+       cannot be run at all gets its error as output and code 127,
+       leaving the agent to run the rest."""
+    try:
+        # Commands arrive as (unicode) JSON strings; exec takes bytes
+        line = cmd[ 'cmd' ]
+        if not isinstance( line, bytes ):
+            line = line.encode( 'utf-8' )
+        args = [ b'sh', b'-c', line ]
+        if cmd.get( 'ns' ):
+            args = [ b'mnexec', b'-a', str( cmd[ 'ns' ] ).encode( 'ascii' ) ] + args
+        p = subprocess.Popen( args, stdin=open( os.devnull ),
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, close_fds=True )
+        out = p.communicate()[ 0 ]
+        code = p.returncode
+    except Exception as e:  # pylint: disable=broad-except
+        out, code = '%s: %s' % ( type( e ).__name__, e ), 127
+    if isinstance( out, bytes ):
+        out = out.decode( 'utf-8', 'replace' )
+    return { 'out': out, 'code': code }
+
+
+def serve( fin=sys.stdin, fout=sys.stdout ):
+    "Answer requests from fin on fout until EOF"
+    while True:
+        request = readFrame( fin )
+        if request is None:
+            return
+        cmds = request.get( 'cmds', [] )
+        results = [ None ] * len( cmds )
+        if request.get( 'parallel' ):
+            def run( i ):
+                results[ i ] = runCmd( cmds[ i ] )
+            threads = [ Thread( target=run, args=( i, ) )
+                        for i in range( len( cmds ) ) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        else:
+            results = [ runCmd( cmd ) for cmd in cmds ]
+        writeFrame( fout, { 'results': results } )
+
+
+class Agent( object ):
+    "Client side of an agent running on a server"
+
+    def __init__( self, server='localhost', sshcmd=None, sudo=True ):
+        """server: server name, for messages
+           sshcmd: command prefix reaching the server, none for localhost
+           sudo: run the agent as root with sudo"""
+        self.server = server
+        self.lock = Lock()
+        self.batches = 0
+        self.commands = 0
+        with open( os.path.splitext( __file__ )[ 0 ] + '.py' ) as f:
+            source = f.read() + '\nserve()\n'
+        cmd = [ 'sudo', '-E' ] if sudo else []
+        if sshcmd:
+            # ssh joins its arguments for the server's shell
+            cmd = sshcmd + cmd + [ 'python', '-u', '-c', quote( BOOT ) ]
+        else:
+            cmd += [ 'python', '-u', '-c', BOOT ]
+        self.proc = subprocess.Popen( cmd, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      close_fds=True )
+        self.proc.stdin.write( '%d\n%s' % ( len( source ), source ) )
+        self.proc.stdin.flush()
+
+    def batch( self, cmds, parallel=False ):
+        """Run a batch of commands
+           cmds: list of command strings or { cmd, ns } dicts
+           parallel: run the commands concurrently
+           returns: list of { out, code } dicts"""
+        cmds = [ c if isinstance( c, dict ) else { 'cmd': c } for c in cmds ]
+        with self.lock:
+            writeFrame( self.proc.stdin,
+                        { 'cmds': cmds, 'parallel': parallel } )
+            response = readFrame( self.proc.stdout )
+            self.batches += 1
+            self.commands += len( cmds )
+        if response is None:
+            raise Exception( 'agent on %s exited with code %s' %
+                             ( self.server, self.proc.poll() ) )
+        results = response[ 'results' ]
+        for result in results:
+            # Callers expect output as (utf-8) str, like rcmd()'s
+            result[ 'out' ] = result[ 'out' ].encode( 'utf-8' )
+        return results
+
+    def run( self, cmd, ns=None ):
+        "Run one command; returns its output"
+        return self.batch( [ { 'cmd': cmd, 'ns': ns } ] )[ 0 ][ 'out' ]
+
+    def stop( self ):
+        "Close the channel, which ends the agent"
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
@@ -1,6 +1,12 @@
+import json
 import subprocess
 
+from bootstrap import runBootstrap
+from bulkload import (BulkLoader, ThriftConnection, expected_counts, load_report, parse_register,
+                      register_array, snapshot, thrift_available)
+from reader import OutputReader, readOutput
 from shortest_path import ShortestPath
+import timeline
 
 class AppController:
 
@@ -11,6 +17,9 @@ class AppController:
         self.topo = topo
         self.net = net
         self.links = links
+        self.entries = {} # switch name -> entries loaded by start()
+        self.connections = {} # switch name -> connection kept open for register reads
+        self.thrift = None # whether use_thrift()
 
     def read_entries(self, filename):
         entries = []
@@ -22,53 +31,237 @@ class AppController:
         return entries
 
     def add_entries(self, thrift_port=9090, sw=None, entries=None):
-        assert entries
-        if sw: thrift_port = sw.thrift_port
-
-        print '\n'.join(entries)
-        p = sw.rpopen(['simple_switch_CLI', '--thrift-port', str(thrift_port)], stdout=sw.output, tt=False)
-        p.stdin.write('\n'.join(entries))
-        p.stdin.close()
-
-    def read_register(self, register, idx, thrift_port=9090, sw=None):
-        if sw: thrift_port = sw.thrift_port
-        p = subprocess.Popen(['simple_switch_CLI', '--thrift-port', str(thrift_port)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate(input="register_read %s %d" % (register, idx))
+        """Load entries into one switch, through load_entries(). Kept for
+        custom controllers; thrift_port is taken from sw."""
+        assert entries and sw
+        return self.load_entries({sw.name: entries})
+
+    def run_cli(self, cmds, timeout=None):
+        """Run simple_switch_CLI commands on several switches at once and
+        wait for all of them to finish. Each switch's output goes to its
+        log.
+        cmds: dict of switch name -> list of commands
+        timeout: seconds after which the CLIs still running are killed
+        returns: dict of switch name -> output"""
+        reader = OutputReader()
+        for sw_name, sw_cmds in cmds.iteritems():
+            if not sw_cmds: continue
+            sw = self.net.get(sw_name)
+            p = sw.rpopen(['simple_switch_CLI', '--thrift-port', str(sw.thrift_port)], tt=False)
+            reader.add(sw_name, p, data='\n'.join(sw_cmds) + '\n')
+        for sw_name in reader.wait(timeout=timeout):
+            print "Switch %s: simple_switch_CLI timed out after %ss" % (sw_name, timeout)
+            reader.kill(sw_name)
+        outputs = {}
+        for sw_name in reader.procs:
+            outputs[sw_name] = reader.result(sw_name)[1]
+            self.net.get(sw_name).output.write(outputs[sw_name])
+        return outputs
+
+    def connect(self, sw_name):
+        "Persistent Thrift connection to a switch, for the bulk loader"
+        sw = self.net.get(sw_name)
+        host, port = sw.thrift_address()
+        return ThriftConnection(host, port, output=sw.output)
+
+    def use_thrift(self):
+        """Whether to talk to switches over Thrift connections rather than
+        with simple_switch_CLI: the target's "table_loader" is "thrift" (the
+        default) and bmv2's Python runtime is installed"""
+        if self.thrift is None:
+            loader = self.conf.get('table_loader', 'thrift')
+            if loader not in ('thrift', 'cli'):
+                raise Exception('Unknown table_loader "%s", expected thrift or cli' % loader)
+            self.thrift = loader == 'thrift' and thrift_available()
+            if loader == 'thrift' and not self.thrift:
+                print "bmv2's Python runtime is not installed; using simple_switch_CLI"
+        return self.thrift
+
+    def connection(self, sw_name):
+        "Thrift connection to a switch that stays open until stop()"
+        if sw_name not in self.connections:
+            self.connections[sw_name] = self.connect(sw_name)
+        return self.connections[sw_name]
+
+    def load_entries(self, cmds, counts=None):
+        """Run commands on several switches at once. With the target's
+        "table_loader": "thrift" (the default when bmv2's Python runtime is
+        installed), they are loaded over one Thrift connection per switch
+        and the entry count of every table is checked afterwards; with
+        "cli", or without the runtime, they go through run_cli().
+        cmds: dict of switch name -> list of commands
+        counts: dict of switch name -> entries of its tables before
+        returns: True unless the bulk loader found errors"""
+        if not self.use_thrift():
+            with timeline.timed('table loading'):
+                self.run_cli(cmds)
+            return True
+        results = BulkLoader(self.connect).load(cmds, counts)
+        for sw_name, r in results.iteritems():
+            timeline.record('%s entries' % sw_name, r['start'], r['end'], kind='node',
+                            server=getattr(self.net.get(sw_name), 'server', 'localhost'))
+        print load_report(results)
+        return not any(r['errors'] or r['mismatches'] for r in results.values())
+
+    def snapshot(self, registers, switches=None, timeout=None):
+        """Read registers of several switches at once, whole or in index
+        ranges, over connections kept open between calls (see use_thrift();
+        otherwise with one simple_switch_CLI per switch)
+        registers: list of register names, or dict of register name ->
+        (start, end) of the indexes to read
+        switches: switch names, default all
+        timeout: seconds after which a simple_switch_CLI is given up on
+        returns: dict of switch name -> dict of register name -> NumPy array
+        (list without NumPy)"""
+        if switches is None: switches = self.topo.switches()
+        if self.use_thrift():
+            return snapshot(self.connection, switches, registers, close=False)
+        if not isinstance(registers, dict):
+            registers = dict((register, (0, None)) for register in registers)
+        cmds = dict((sw_name, ['register_read %s' % r for r in sorted(registers)]) for sw_name in switches)
+        outputs = self.run_cli(cmds, timeout)
+        values = {}
+        for sw_name in switches:
+            values[sw_name] = dict((register, register_array(parse_register(outputs[sw_name], register)[start:end]))
+                                   for register, (start, end) in registers.iteritems())
+        return values
+
+    def read_registers(self, sw_name, register, start=0, end=None, timeout=None):
+        """Values of indexes start to end (default: the last) of a register
+        of a switch, read in one call (see snapshot())"""
+        return self.snapshot({register: (start, end)}, [sw_name], timeout)[sw_name][register]
+
+    def read_register(self, register, idx, thrift_port=9090, sw=None, timeout=None):
+        if sw: return long(self.read_registers(sw.name, register, idx, idx + 1, timeout)[0])
+        p = subprocess.Popen(['simple_switch_CLI', '--thrift-port', str(thrift_port)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        code, stdout = readOutput(p, data="register_read %s %d" % (register, idx), timeout=timeout)
+        if code is None:
+            raise Exception('register_read %s[%d] on port %d timed out after %ss' % (register, idx, thrift_port, timeout))
         reg_val = filter(lambda l: ' %s[%d]' % (register, idx) in l, stdout.split('\n'))[0].split('= ', 1)[1]
         return long(reg_val)
 
-    def start(self):
-        shortestpath = ShortestPath(self.links)
+    def host_config_cmds(self):
+        """Commands that give every host its addresses and a route to its
+        switch, as a dict of host name -> list of commands"""
+        cmds = {}
+        for host_name in self.topo._host_links:
+            h = self.net.get(host_name)
+            cmds[host_name] = []
+            for link in self.topo._host_links[host_name].values():
+                iface = h.intfNames()[link['idx']]
+                # update mininet's view of the default interface the way
+                # h.setIP() and h.setMAC() would, since the commands below
+                # bypass them
+                intf = h.intf()
+                prefix_len = link.get('prefix_len', 16)
+                intf.ip, intf.prefixLen, intf.mac = link['host_ip'], prefix_len, link['host_mac']
+                cmds[host_name] += [
+                    'ip link set dev %s down' % intf,
+                    'ip link set dev %s address %s' % (intf, link['host_mac']),
+                    'ip link set dev %s up' % intf,
+                    'ip addr flush dev %s' % intf,
+                    'ip addr add %s/%d brd + dev %s' % (link['host_ip'], prefix_len, intf),
+                    'arp -i %s -s %s %s' % (iface, link['sw_ip'], link['sw_mac']),
+                    'ethtool --offload %s rx off tx off' % iface,
+                    'ip route add %s dev %s' % (link['sw_ip'], iface)]
+            cmds[host_name].append('ip route replace default via %s' % link['sw_ip'])
+        return cmds
+
+    def switch_entries(self, conf=None):
+        """Table entries of every switch, as a dict of switch name -> list
+        of commands, from conf (default: the target's configuration)"""
+        if conf is None: conf = self.conf
         entries = {}
         for sw in self.topo.switches():
             entries[sw] = []
-            if 'switches' in self.conf and sw in self.conf['switches'] and 'entries' in self.conf['switches'][sw]:
-                extra_entries = self.conf['switches'][sw]['entries']
+            if 'switches' in conf and sw in conf['switches'] and 'entries' in conf['switches'][sw]:
+                extra_entries = conf['switches'][sw]['entries']
                 if type(extra_entries) == list: # array of entries
                     entries[sw] += extra_entries
                 else: # path to file that contains entries
                     entries[sw] += self.read_entries(extra_entries)
+        return entries
+
+    @staticmethod
+    def entries_by_table(entries):
+        """Group entries by the table they apply to, keeping their order.
+        Commands that are not about a table are grouped under None.
+        returns: list of (table, list of entries)"""
+        groups = []
+        index = {}
+        for entry in entries:
+            words = entry.split()
+            table = words[1] if len(words) > 1 and words[0].startswith('table_') else None
+            if table not in index:
+                index[table] = len(groups)
+                groups.append((table, []))
+            groups[index[table]][1].append(entry)
+        return groups
+
+    def changed_entries(self, entries):
+        """Commands that turn the entries currently loaded into entries.
+        Every table whose entries differ is cleared and loaded again;
+        the other tables are left alone. Default actions are not reset.
+        returns: dict of switch name -> list of commands"""
+        cmds = {}
+        for sw_name, sw_entries in entries.iteritems():
+            old = dict(self.entries_by_table(self.entries.get(sw_name, [])))
+            new = self.entries_by_table(sw_entries)
+            cmds[sw_name] = []
+            for table, table_entries in new:
+                if old.get(table) == table_entries: continue
+                if table is not None: cmds[sw_name].append('table_clear %s' % table)
+                cmds[sw_name] += table_entries
+            for table in old:
+                if table is not None and table not in dict(new):
+                    cmds[sw_name].append('table_clear %s' % table)
+        return cmds
+
+    def state_reset_cmds(self, sw_name):
+        """Commands that reset every register and counter of a switch,
+        as declared in its compiled program"""
+        with open(self.net.get(sw_name).json_path, 'r') as f:
+            program = json.load(f)
+        return (['register_reset %s' % r['name'] for r in program.get('register_arrays', [])] +
+                ['counter_reset %s' % c['name'] for c in program.get('counter_arrays', [])])
+
+    def prepare_trial(self, conf, reset=True):
+        """Get the running switches ready for another trial: reset their
+        registers and counters, and reload the tables whose entries in conf
+        differ from the ones loaded.
+        conf: target configuration of the trial
+        reset: whether to reset registers and counters"""
+        entries = self.switch_entries(conf)
+        cmds = self.changed_entries(entries)
+        for sw_name in sorted(cmds):
+            reloaded = len([c for c in cmds[sw_name] if c.startswith('table_clear ')])
+            if reset: cmds[sw_name][0:0] = self.state_reset_cmds(sw_name)
+            print "Switch %s: %d tables reloaded%s" % (sw_name, reloaded, ', state reset' if reset else '')
+        counts = dict((sw_name, expected_counts(self.entries.get(sw_name, []))) for sw_name in cmds)
+        if not self.load_entries(cmds, counts):
+            raise Exception('Could not reload the tables of the switches for the trial')
+        self.entries = entries
+
+    def start(self, bootstrap=None):
+        """Configure hosts and populate the switches' tables.
+        bootstrap: optional dict of host name -> list of commands. When
+        given, the host configuration commands are added to it for the
+        caller to run in the same batch as its own, instead of being
+        run here."""
+        shortestpath = ShortestPath(self.links)
+        entries = self.switch_entries()
+        #for sw in self.topo.switches():
             #entries[sw] += [
             #    'table_set_default send_frame _drop',
             #    'table_set_default forward _drop',
             #    'table_set_default ipv4_lpm _drop']
 
-        for host_name in self.topo._host_links:
-            h = self.net.get(host_name)
-            for link in self.topo._host_links[host_name].values():
-                sw = link['sw']
-                #entries[sw].append('table_add send_frame rewrite_mac %d => %s' % (link['sw_port'], link['sw_mac']))
-                #entries[sw].append('table_add forward set_dmac %s => %s' % (link['host_ip'], link['host_mac']))
-                #entries[sw].append('table_add ipv4_lpm set_nhop %s/32 => %s %d' % (link['host_ip'], link['host_ip'], link['sw_port']))
-                iface = h.intfNames()[link['idx']]
-                # use mininet to set ip and mac to let it know the change
-                h.setIP(link['host_ip'], 16)
-                h.setMAC(link['host_mac'])
-                #h.cmd('ifconfig %s %s hw ether %s' % (iface, link['host_ip'], link['host_mac']))
-                h.cmd('arp -i %s -s %s %s' % (iface, link['sw_ip'], link['sw_mac']))
-                h.cmd('ethtool --offload %s rx off tx off' % iface)
-                h.cmd('ip route add %s dev %s' % (link['sw_ip'], iface))
-            h.setDefaultRoute("via %s" % link['sw_ip'])
+        host_cmds = self.host_config_cmds()
+        if bootstrap is None:
+            runBootstrap(self.net, host_cmds)
+        else:
+            for host_name, cmds in host_cmds.iteritems():
+                bootstrap.setdefault(host_name, [])[0:0] = cmds
 
 #        for h in self.net.hosts:
 #            h_link = self.topo._host_links[h.name].values()[0]
@@ -92,13 +285,15 @@ class AppController:
 
         print "**********"
         print "Configuring entries in p4 tables"
-        for sw_name in entries:
-            print
-            print "Configuring switch... %s" % sw_name
-            sw = self.net.get(sw_name)
-            self.add_entries(sw=sw, entries=entries[sw_name])
+        for sw_name in sorted(entries):
+            print "Switch %s: %d entries" % (sw_name, len(entries[sw_name]))
+        if not self.load_entries(entries):
+            raise Exception('Could not load the tables of the switches')
+        self.entries = entries
         print "Configuration complete."
         print "**********"
 
     def stop(self):
-        pass
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
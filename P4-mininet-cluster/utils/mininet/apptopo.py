@@ -1,9 +1,54 @@
 from mininet.topo import Topo
+from mininet.link import TCIntf
 from cluster import RemoteP4Switch, RemoteP4Host
 from p4_mininet import P4Switch
+from addressing import make_plan
 
 next_thrift_port = 0
 
+# Settings of links between hosts and switches ("host") and between
+# switches ("switch"). A target's "link_classes" overrides them by class,
+# including a "cross_server" class for links between servers, and a link's
+# own settings, a dict at the end of its entry in "links", override those.
+#   bw: Mbit/s, or null for no limit
+#   delay, jitter: "5ms", or a number of ms
+#   loss: % of packets lost
+#   queue: packets the link may queue
+#   shaping: "htb", "hfsc", "tbf", or "none" for no bandwidth limit
+#   red, ecn: RED queueing, and ECN marking with it
+LINK_DEFAULTS = dict(bw=50, delay='0ms', queue=1000, shaping='htb')
+
+SHAPING = ('htb', 'hfsc', 'tbf', 'none')
+
+def link_params(settings):
+    "TCLink parameters for link settings"
+    params = {}
+    for key, value in settings.iteritems():
+        if key == 'bw':
+            params['bw'] = value
+        elif key in ('delay', 'jitter'):
+            params[key] = value if isinstance(value, basestring) else '%sms' % value
+        elif key == 'loss':
+            params['loss'] = value
+        elif key == 'queue':
+            params['max_queue_size'] = int(value)
+        elif key == 'red':
+            params['enable_red'] = bool(value)
+        elif key == 'ecn':
+            params['enable_ecn'] = bool(value)
+        elif key != 'shaping':
+            raise Exception('Unknown link setting "%s"' % key)
+    shaping = settings.get('shaping', 'htb')
+    if shaping not in SHAPING:
+        raise Exception('Unknown link shaping "%s", expected one of %s' % (shaping, ', '.join(SHAPING)))
+    params.update(use_hfsc=shaping == 'hfsc', use_tbf=shaping == 'tbf')
+    if shaping == 'none':
+        params['bw'] = None
+    if params.get('bw') is not None and not 0 < params['bw'] <= TCIntf.bwParamMax:
+        raise Exception('Link bandwidth %s is outside the 0..%d Mbit/s Mininet can shape; '
+                        'use "shaping": "none" for unlimited links' % (params['bw'], TCIntf.bwParamMax))
+    return params
+
 class AppTopo(Topo):
 
     def __init__(self, links, switch_info, args, bmv2_log, pcap_dump, latencies={}, losses={}, manifest=None, target=None,
@@ -24,25 +69,37 @@ class AppTopo(Topo):
 
         Topo.__init__(self, **opts)
 
-        nodes = sum(map(list, zip(*links)), [])
-        sequence = filter(lambda n: n[0] == 'h', nodes)
+        # One pass over the links indexes them: node names in order of
+        # first appearance (first ends, then second ends, as the order of
+        # hosts and switches sets port numbers), and each host's links
+        host_names, sw_names, host_links = [], [], {}
         seen = set()
-        host_names = [x for x in sequence if not (x in seen or seen.add(x))]
+        for column in (0, 1):
+            for link in links:
+                n = link[column]
+                if n in seen: continue
+                seen.add(n)
+                if n[0] == 'h': host_names.append(n)
+                elif n[0] == 's': sw_names.append(n)
+        for link in links:
+            for n in link[:2]:
+                if n[0] == 'h': host_links.setdefault(n, []).append(link)
         print host_names
-        sequence = filter(lambda n: n[0] == 's', nodes)
-        seen = set()
-        sw_names = [x for x in sequence if not (x in seen or seen.add(x))]
-        sw_ports = dict([(sw, []) for sw in sw_names])
+
+        # Ports of each switch, numbered from 1 in the order they are added;
+        # a peer's port is the first one to it
+        sw_ports = dict([(sw, {}) for sw in sw_names])
+        sw_port_count = dict([(sw, 0) for sw in sw_names])
+
+        def add_port(sw, peer):
+            sw_port_count[sw] += 1
+            return sw_ports[sw].setdefault(peer, sw_port_count[sw])
 
         self._host_links = {}
         self._sw_links = dict([(sw, {}) for sw in sw_names])
 
         max_sw_num = 0
 
-        BANDWIDTH = 50
-        QUEUE_SIZE = 1000
-        DELAY = '0s'
-
         for sw_name in sw_names:
             json = switch_info[sw_name]
             switchClass = configureP4Switch(
@@ -54,54 +111,74 @@ class AppTopo(Topo):
             sw_num = int(sw_name[1:])
             max_sw_num = sw_num if sw_num > max_sw_num else max_sw_num
 
+        # Addresses come from the target's "addressing" plan (see
+        # addressing.py), checked to have room for every node
+        conf = manifest['targets'][target] if manifest and target else {}
+        max_node = max([int(n[1:]) for n in sw_names + host_names] or [0])
+        self.address_plan = make_plan(conf.get('addressing'), max_node,
+                                      NUM_END_HOSTS if any(int(h[1:]) > max_sw_num for h in host_names) else 0)
+        plan = self.address_plan
+
+        link_classes = conf.get('link_classes', {})
+        link_settings = dict((tuple(sorted(l[:2])), l[-1]) for l in conf.get('links', [])
+                             if isinstance(l[-1], dict))
+
+        def link_opts(link_class, delay_key, a, b):
+            """addLink() parameters of link a-b of link_class ("host" or
+            "switch"), whose latency and loss are keyed by delay_key"""
+            explicit = {}
+            if delay_key in latencies: explicit['delay'] = latencies[delay_key]
+            if delay_key in losses: explicit['loss'] = losses[delay_key]
+            explicit.update(link_settings.get(tuple(sorted([a, b])), {}))
+            settings = dict(LINK_DEFAULTS, **link_classes.get(link_class, {}))
+            opts = link_params(dict(settings, **explicit))
+            # MininetCluster.addLink() applies these to links between servers
+            if 'cross_server' in link_classes:
+                settings.update(link_classes['cross_server'])
+                opts['cross_server'] = link_params(dict(settings, **explicit))
+            return opts
+
+        def add_host(host_name, host_ip, host_mac):
+            host_num = int(host_name[1:])
+            self.addHost(host_name)
+
+            self._host_links[host_name] = {}
+
+            sw_idx = 0
+            for link in host_links[host_name]:
+                sw = link[0] if link[0] != host_name else link[1]
+                sw_num = int(sw[1:])
+                assert sw[0]=='s', "Hosts should be connected to switches, not " + str(sw)
+
+                sw_ip, sw_mac = plan.host_port(sw_num, host_num, sw_idx)
+                self._host_links[host_name][sw] = dict(
+                        idx=sw_idx,
+                        host_mac = host_mac,
+                        host_ip = host_ip,
+                        prefix_len = plan.prefix_len,
+                        sw = sw,
+                        sw_mac = sw_mac,
+                        sw_ip = sw_ip,
+                        sw_port = add_port(sw, host_name)
+                        )
+                self.addLink(host_name, sw, addr1=host_mac, addr2=sw_mac,
+                             **link_opts('host', ''.join([host_name, sw]), host_name, sw))
+                sw_idx += 1
+
         for host_name in host_names:
             host_num = int(host_name[1:])
             if (host_num <= max_sw_num):  #it's control host
-                host_ip = "10.0.%d.10" % host_num
-                host_mac = '00:04:00:00:00:%02x' % host_num
-
-                self.addHost(host_name)
-    
-                self._host_links[host_name] = {}
-                host_links = filter(lambda l: l[0]==host_name or l[1]==host_name, links)
-    
-                sw_idx = 0
-                for link in host_links:
-                    sw = link[0] if link[0] != host_name else link[1]
-                    sw_num = int(sw[1:])
-                    assert sw[0]=='s', "Hosts should be connected to switches, not " + str(sw)
-    
-                    delay_key = ''.join([host_name, sw])
-                    delay = latencies[delay_key] if delay_key in latencies else '0ms'
-                    loss = losses[delay_key] if delay_key in losses else 0
-                    sw_ports[sw].append(host_name)
-                    self._host_links[host_name][sw] = dict(
-                            idx=sw_idx,
-                            host_mac = host_mac,
-                            host_ip = host_ip,
-                            sw = sw,
-                            sw_mac = "00:aa:00:%02x:00:%02x" % (sw_num, host_num),
-                            sw_ip = "10.0.%d.%d" % (host_num, sw_idx+1),
-                            sw_port = sw_ports[sw].index(host_name)+1
-                            )
-                    self.addLink(host_name, sw, bw=BANDWIDTH, delay=DELAY, loss=loss, max_queue_size=QUEUE_SIZE, 
-                            addr1=host_mac, addr2=self._host_links[host_name][sw]['sw_mac'])
-                    sw_idx += 1
+                add_host(host_name, *plan.control_host(host_num))
 
         for link in links: # only check switch-switch links
             sw1, sw2 = link
             if sw1[0] != 's' or sw2[0] != 's': continue
 
-            delay_key = ''.join(sorted([sw1, sw2]))
-            delay = latencies[delay_key] if delay_key in latencies else '0ms'
-            loss = losses[delay_key] if delay_key in losses else 0
-            self.addLink(sw1, sw2, bw=BANDWIDTH, delay=DELAY, loss=loss, max_queue_size=QUEUE_SIZE)
-            sw_ports[sw1].append(sw2)
-            sw_ports[sw2].append(sw1)
+            self.addLink(sw1, sw2, **link_opts('switch', ''.join(sorted([sw1, sw2])), sw1, sw2))
 
             sw1_num, sw2_num = int(sw1[1:]), int(sw2[1:])
-            sw1_port = dict(mac="00:aa:00:%02x:%02x:00" % (sw1_num, sw2_num), port=sw_ports[sw1].index(sw2)+1)
-            sw2_port = dict(mac="00:aa:00:%02x:%02x:00" % (sw2_num, sw1_num), port=sw_ports[sw2].index(sw1)+1)
+            sw1_port = dict(mac=plan.switch_port_mac(sw1_num, sw2_num), port=add_port(sw1, sw2))
+            sw2_port = dict(mac=plan.switch_port_mac(sw2_num, sw1_num), port=add_port(sw2, sw1))
 
             self._sw_links[sw1][sw2] = [sw1_port, sw2_port]
             self._sw_links[sw2][sw1] = [sw2_port, sw1_port]
@@ -111,35 +188,5 @@ class AppTopo(Topo):
                 host_num = int(host_name[1:])
                 if (host_num > max_sw_num):  #it's end hosts
                     tor_num = (host_num-max_sw_num-1) / NUM_END_HOSTS + 1
-                    end_host_num = (host_num-max_sw_num-1) % NUM_END_HOSTS + 21
-                    host_ip = "10.0.%d.%d" % (tor_num, end_host_num)
-                    host_mac = '00:04:00:00:00:%02x' % host_num
-    
-                    self.addHost(host_name)
-        
-                    self._host_links[host_name] = {}
-                    host_links = filter(lambda l: l[0]==host_name or l[1]==host_name, links)
-        
-                    sw_idx = 0
-                    for link in host_links:
-                        sw = link[0] if link[0] != host_name else link[1]
-                        sw_num = int(sw[1:])
-                        assert sw[0]=='s', "Hosts should be connected to switches, not " + str(sw)
-        
-                        delay_key = ''.join([host_name, sw])
-                        delay = latencies[delay_key] if delay_key in latencies else '0ms'
-                        loss = losses[delay_key] if delay_key in losses else 0
-                        sw_ports[sw].append(host_name)
-                        self._host_links[host_name][sw] = dict(
-                                idx=sw_idx,
-                                host_mac = host_mac,
-                                host_ip = host_ip,
-                                sw = sw,
-                                sw_mac = "00:aa:00:%02x:00:%02x" % (sw_num, host_num),
-                                sw_ip = "10.0.%d.%d" % (host_num, sw_idx+1),
-                                sw_port = sw_ports[sw].index(host_name)+1
-                                )
-                        self.addLink(host_name, sw, bw=BANDWIDTH, delay=DELAY,loss=loss, max_queue_size=QUEUE_SIZE, 
-                                addr1=host_mac, addr2=self._host_links[host_name][sw]['sw_mac'])
-                        sw_idx += 1
-
+                    end_host_idx = (host_num-max_sw_num-1) % NUM_END_HOSTS
+                    add_host(host_name, *plan.end_host(host_num, tor_num, end_host_idx))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+
+# Scaling benchmark for AppTopo construction.
+#
+# Builds the AppTopo graph of synthetic topologies of increasing size and
+# reports how long it takes and how much memory it uses per link, which
+# should stay flat as the topology grows.
+#
+# Every topology has S switches in a ring with random chords, one control
+# host per switch and --end-hosts end hosts per switch, for S * (3 + end
+# hosts) links in all.
+
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import sys
+from time import time
+
+import apptopo
+
+parser = argparse.ArgumentParser(description='AppTopo construction benchmark')
+parser.add_argument('--links', help='Approximate link counts to build topologies of',
+                    type=int, nargs='+', default=[100, 300, 1000, 3000, 10000])
+parser.add_argument('--end-hosts', help='End hosts per switch',
+                    type=int, action="store", default=2)
+parser.add_argument('--repeat', help='Builds of each topology; the fastest is reported',
+                    type=int, action="store", default=3)
+parser.add_argument('--seed', help='Random seed for the switch-switch links',
+                    type=int, action="store", default=1)
+
+
+class BenchArgs(object):
+    "The parts of multi_switch_mininet's arguments AppTopo reads"
+    behavioral_exe = 'simple_switch'
+    thrift_port = 9090
+
+
+def make_links(num_links, end_hosts, seed):
+    """Links of a synthetic topology of about num_links links
+    returns: (links, switch names)"""
+    rand = random.Random(seed)
+    n = max(3, num_links / (3 + end_hosts))
+    switches = ['s%d' % i for i in range(1, n + 1)]
+    links = [['h%d' % i, 's%d' % i] for i in range(1, n + 1)]
+    links += [[switches[i], switches[(i + 1) % n]] for i in range(n)]
+    links += [list(rand.sample(switches, 2)) for _ in range(n)]
+    for i in range(n * end_hosts):
+        links.append(['h%d' % (n + 1 + i), 's%d' % (i / end_hosts + 1)])
+    return links, switches
+
+
+def build(links, switches, end_hosts, conn):
+    "Build an AppTopo, and send its build time and memory growth on conn"
+    switch_info = dict((sw, 'switch.json') for sw in switches)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    start = time()
+    apptopo.AppTopo(links, switch_info, BenchArgs, False, False, NUM_END_HOSTS=end_hosts)
+    elapsed = time() - start
+    sys.stdout = stdout
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send((elapsed, (after - before) / 1024.0))
+
+
+def measure(links, switches, end_hosts):
+    """Build an AppTopo in a fresh process, so that its memory is its own
+    returns: (seconds, MB)"""
+    parent, child = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=build, args=(links, switches, end_hosts, child))
+    p.start()
+    result = parent.recv()
+    p.join()
+    return result
+
+
+def main():
+    args = parser.parse_args()
+    print '%8s %8s %10s %10s %10s %10s' % ('links', 'nodes', 'seconds', 'us/link', 'MB', 'KB/link')
+    for num_links in args.links:
+        links, switches = make_links(num_links, args.end_hosts, args.seed)
+        nodes = len(set(n for link in links for n in link))
+        runs = [measure(links, switches, args.end_hosts) for _ in range(args.repeat)]
+        elapsed = min(r[0] for r in runs)
+        memory = min(r[1] for r in runs)
+        print '%8d %8d %10.3f %10.1f %10.1f %10.2f' % (
+            len(links), nodes, elapsed, elapsed / len(links) * 1e6,
+            memory, memory * 1024 / len(links))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+
+# Benchmark of the bulk table loader against fake switches.
+#
+# Starts --switches FakeThriftServers in a separate process and loads
+# --entries table entries into each of them three ways: one switch after
+# the other with a round trip per command (how simple_switch_CLI loads
+# them), all switches at once with a round trip per command, and all at
+# once with pipelining. Every run starts from empty tables, and the entry
+# counts are verified after each. Then a --register-size register is read
+# from every switch, an index per round trip and as a snapshot.
+
+import argparse
+import multiprocessing
+from time import time
+
+from bulkload import BulkLoader, FakeConnection, FakeThriftServer, WINDOW, snapshot
+
+parser = argparse.ArgumentParser(description='Bulk table loader benchmark')
+parser.add_argument('--switches', help='Number of fake switches',
+                    type=int, action="store", default=20)
+parser.add_argument('--entries', help='Table entries per switch',
+                    type=int, action="store", default=2000)
+parser.add_argument('--tables', help='Tables the entries are spread over',
+                    type=int, action="store", default=4)
+parser.add_argument('--latency', help='Seconds a fake switch takes per command',
+                    type=float, action="store", default=0.0)
+parser.add_argument('--register-size', help='Size of the register read from every switch',
+                    type=int, action="store", default=64)
+parser.add_argument('--window', help='Commands pipelined at a time',
+                    type=int, action="store", default=WINDOW)
+
+
+def serve(num_switches, latency, register_size, conn):
+    "Run fake switches, sending their ports on conn, until conn is closed"
+    servers = [FakeThriftServer(latency=latency, registers={'reg': register_size})
+               for _ in range(num_switches)]
+    conn.send([s.port for s in servers])
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+
+
+def make_cmds(num_entries, num_tables):
+    "Commands of one switch: clear the tables, then add entries to them"
+    cmds = ['table_clear t%d' % t for t in range(num_tables)]
+    cmds += ['table_add t%d set_nhop 10.%d.%d.0/24 => %d' % (i % num_tables, i / 256 % 256, i % 256, i % 16)
+             for i in range(num_entries)]
+    return cmds
+
+
+def run(ports, cmds, window, concurrent):
+    """Load cmds into every switch
+    returns: (seconds, switches with errors or wrong entry counts)"""
+    loader = BulkLoader(lambda sw: FakeConnection('127.0.0.1', ports[sw], window=window))
+    all_cmds = dict((sw, cmds) for sw in ports)
+    start = time()
+    if concurrent:
+        results = loader.load(all_cmds)
+    else:
+        results = {}
+        for sw in sorted(ports):
+            results.update(loader.load({sw: cmds}))
+    elapsed = time() - start
+    return elapsed, len([r for r in results.values() if r['errors'] or r['mismatches']])
+
+
+def main():
+    args = parser.parse_args()
+    parent, child = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=serve, args=(args.switches, args.latency, args.register_size, child))
+    p.daemon = True
+    p.start()
+    ports = dict(('s%d' % (i + 1), port) for i, port in enumerate(parent.recv()))
+    cmds = make_cmds(args.entries, args.tables)
+    total = len(cmds) * len(ports)
+    print '%d switches, %d commands each' % (len(ports), len(cmds))
+    print '%-28s %10s %12s %8s' % ('mode', 'seconds', 'commands/s', 'failed')
+    for mode, window, concurrent in (('sequential, round trips', 1, False),
+                                     ('concurrent, round trips', 1, True),
+                                     ('concurrent, pipelined', args.window, True)):
+        elapsed, failed = run(ports, cmds, window, concurrent)
+        print '%-28s %10.3f %12.0f %8d' % (mode, elapsed, total / elapsed, failed)
+    conns = dict((sw, FakeConnection('127.0.0.1', port)) for sw, port in ports.iteritems())
+    start = time()
+    for sw in sorted(conns):
+        for i in range(args.register_size):
+            conns[sw].call('register_read reg %d' % i)
+    elapsed = time() - start
+    print '%-28s %10.3f' % ('register, index at a time', elapsed)
+    start = time()
+    snapshot(conns.get, sorted(conns), ['reg'], close=False)
+    print '%-28s %10.3f' % ('register snapshot', time() - start)
+    for conn in conns.values():
+        conn.close()
+    parent.send(None)
+    p.join()
+
+
+if __name__ == '__main__':
+    main()
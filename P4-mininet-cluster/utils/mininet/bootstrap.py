@@ -0,0 +1,134 @@
+"""
+bootstrap.py: batched network bootstrap for hosts
+
+Generated manifests configure every host with hundreds of small commands
+(ip route add ..., arp -s ...). Sent one at a time through a remote node's
+shell, each of them costs a full round trip. Here a node's commands are
+turned into a script that keeps their order but folds every run of
+consecutive plain 'ip' commands into one 'ip -batch', and every run of
+plain 'arp -s' entries into one 'arp -f'.
+
+The script is written to a file on the node and sourced by the node's
+shell. A node's shell reads its commands from a terminal that cuts lines
+at 4095 bytes, so the file is written by command lines of at most
+MAX_LINE bytes, one round trip each. The command lines of all nodes are
+sent before waiting for any of them, so nodes bootstrap concurrently.
+"""
+
+import os
+import re
+from time import time
+
+from mininet.log import info
+
+import timeline
+
+# Only plain words may be moved into an ip/arp batch; anything with
+# shell syntax is run as is.
+_plainCmd = re.compile( r'^[\w\s.:/+-]+$' )
+
+# Longest command line sent to a node's shell, well under the 4095 bytes
+# its terminal takes
+MAX_LINE = 3000
+
+# End of the batches in a script
+_batchEnd = 'BOOTSTRAP_BATCH_END'
+
+
+def _batchLine( cmd ):
+    """returns: ( 'ip' or 'arp', line of the batch ) if cmd can go into an
+       ip or arp batch, else ( None, cmd )"""
+    words = cmd.split()
+    if not _plainCmd.match( cmd ):
+        return None, cmd.strip()
+    if len( words ) > 1 and words[ 0 ] == 'ip' and not words[ 1 ].startswith( '-' ):
+        return 'ip', ' '.join( words[ 1: ] )
+    if len( words ) == 4 and words[ :2 ] == [ 'arp', '-s' ]:
+        return 'arp', '%s %s' % ( words[ 2 ], words[ 3 ] )
+    if ( len( words ) == 6 and words[ :2 ] == [ 'arp', '-i' ] and
+         words[ 3 ] == '-s' ):
+        return 'ip', ( 'neigh replace %s lladdr %s dev %s nud permanent'
+                       % ( words[ 4 ], words[ 5 ], words[ 2 ] ) )
+    return None, cmd.strip()
+
+
+def batchScript( cmds ):
+    """Turn a list of shell commands into a script that runs them in
+       order, with runs of consecutive ip and arp commands batched
+       cmds: list of command strings, in execution order
+       returns: script text"""
+    lines, kind = [], None
+    for cmd in cmds:
+        cmdKind, line = _batchLine( cmd )
+        if cmdKind != kind and kind is not None:
+            lines.append( _batchEnd )
+        if cmdKind == 'ip' and kind != 'ip':
+            lines.append( "ip -force -batch - <<'%s'" % _batchEnd )
+        elif cmdKind == 'arp' and kind != 'arp':
+            lines.append( "arp -f /dev/stdin <<'%s'" % _batchEnd )
+        lines.append( line )
+        kind = cmdKind
+    if kind is not None:
+        lines.append( _batchEnd )
+    return '\n'.join( lines ) + '\n'
+
+
+def _escape( c ):
+    "A character of printf %b's single-quoted argument"
+    return { '\\': '\\\\', '\n': '\\n', "'": "'\\''" }.get( c, c )
+
+
+def scriptCmds( script, path, maxLine=MAX_LINE ):
+    """Command lines of at most maxLine bytes (unless path is absurdly
+       long) that write script to path and source it
+       returns: list of command strings, to run in order"""
+    run = '. %s; rm -f %s' % ( path, path )
+    cmds, chunk = [], []
+    size = 0
+    for c in script:
+        e = _escape( c )
+        # printf %b '...' >> path; plus room to run it on the last line
+        if size + len( e ) > maxLine - len( path ) - len( run ) - 20:
+            cmds.append( ''.join( chunk ) )
+            chunk, size = [], 0
+        chunk.append( e )
+        size += len( e )
+    cmds.append( ''.join( chunk ) )
+    cmds = [ "printf %%b '%s' %s %s" % ( chunk, '>>' if i else '>', path )
+             for i, chunk in enumerate( cmds ) ]
+    cmds[ -1 ] += '; ' + run
+    return cmds
+
+
+def runBootstrap( net, cmds ):
+    """Run every node's bootstrap commands as one script per node,
+       with all nodes working concurrently
+       net: Mininet network
+       cmds: dict of node name -> list of command strings
+       returns: dict of node name -> output"""
+    start = time()
+    lines = {}
+    for name in sorted( cmds ):
+        if not cmds[ name ]:
+            continue
+        info( '%s: %d commands\n' % ( name, len( cmds[ name ] ) ) )
+        path = '/tmp/bootstrap-%s-%d.sh' % ( name, os.getpid() )
+        lines[ name ] = scriptCmds( batchScript( cmds[ name ] ), path )
+    output = {}
+    # The script of every node is written a command line at a time, all
+    # nodes at once; the last line runs it
+    for i in range( max( [ len( l ) for l in lines.values() ] or [ 0 ] ) ):
+        nodes = [ net.get( name ) for name in sorted( lines )
+                  if i < len( lines[ name ] ) ]
+        for node in nodes:
+            node.sendCmd( lines[ node.name ][ i ] )
+        for node in nodes:
+            output[ node.name ] = node.waitOutput()
+            if i < len( lines[ node.name ] ) - 1:
+                continue
+            # Nodes are collected in turn, so this is an upper bound
+            timeline.record( '%s bootstrap' % node.name, start, time(),
+                             kind='node', commands=len( cmds[ node.name ] ) )
+            if output[ node.name ].strip():
+                info( '%s: %s\n' % ( node.name, output[ node.name ].strip() ) )
+    return output
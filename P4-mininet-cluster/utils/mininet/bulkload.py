@@ -0,0 +1,611 @@
+# Bulk table loading over Thrift.
+#
+# simple_switch_CLI starts a process per switch, opens a fresh Thrift
+# connection, and waits for the reply to each command before parsing the
+# next one. A BulkLoader instead keeps one connection per switch open,
+# loads all switches running the same program at once, pipelines the RPCs whose replies nothing
+# depends on (table entries, default actions, register writes), and checks
+# the number of entries each table ends up with against what the commands
+# should have left in it.
+#
+# Connections parse CLI commands with bmv2's own runtime_CLI module, so the
+# loader takes the same commands as simple_switch_CLI. runtime_CLI parses
+# commands for one program at a time, so switches that run different
+# programs are loaded a program after the other. Connections also
+# read whole registers in one RPC (read_register(), snapshot()), as NumPy
+# arrays when NumPy is installed. FakeThriftServer is
+# a stand-in for a switch's Thrift server that the loader can talk to
+# through a FakeConnection, to test and benchmark it without bmv2 (see
+# bench_bulkload.py):
+#
+#     server = FakeThriftServer()
+#     loader = BulkLoader(lambda sw: FakeConnection('localhost', server.port))
+#     results = loader.load({'s1': ['table_add ipv4_lpm set_nhop 10.0.1.0/24 => 1']})
+
+import socket
+import sys
+import threading
+from time import sleep, time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# RPCs sent in a row on one connection before their replies are read; the
+# replies of a full window have to fit in the socket buffers
+WINDOW = 128
+
+# Commands whose replies nothing waits for, which are pipelined
+PIPELINED_COMMANDS = ('table_add', 'table_set_default', 'table_delete', 'table_modify',
+                      'table_clear', 'register_write', 'register_reset', 'counter_reset')
+
+# Their RPCs, in bmv2's Thrift API
+PIPELINED_RPCS = ('bm_mt_add_entry', 'bm_mt_set_default_action', 'bm_mt_delete_entry',
+                  'bm_mt_modify_entry', 'bm_mt_clear_entries', 'bm_register_write',
+                  'bm_register_reset', 'bm_counter_reset_all')
+
+
+def expected_counts(cmds, counts=None):
+    """Number of entries each table should have after cmds, starting from
+    counts (default: empty tables)
+    returns: dict of table -> entries"""
+    counts = dict(counts or {})
+    for cmd in cmds:
+        words = cmd.split()
+        if len(words) < 2: continue
+        if words[0] == 'table_add':
+            counts[words[1]] = counts.get(words[1], 0) + 1
+        elif words[0] == 'table_delete':
+            counts[words[1]] = counts.get(words[1], 0) - 1
+        elif words[0] == 'table_clear':
+            counts[words[1]] = 0
+    return counts
+
+
+def register_array(values):
+    "Register values as a NumPy array of int64 (a list without NumPy)"
+    values = [long(v) for v in values]
+    return numpy.array(values, dtype=numpy.int64) if numpy is not None else values
+
+
+def parse_register(output, register):
+    """Values of a whole register from the output of simple_switch_CLI's
+    "register_read <register>" ("<register>= v0, v1, ...")
+    returns: list of values"""
+    for line in output.split('\n'):
+        if ' %s= ' % register in ' ' + line:
+            values = line.split('= ', 1)[1].strip()
+            return [long(v) for v in values.split(',')] if values else []
+    raise Exception('No values of register %s in: %s' % (register, output.strip()[-200:]))
+
+
+class _ThreadOutput(object):
+    """sys.stdout replacement that sends what a thread prints to the buffer
+    it registered, if any, so that concurrent CLIs do not mix their output"""
+
+    def __init__(self, out):
+        self.out = out
+        self.buffers = {}
+
+    def write(self, data):
+        self.buffers.get(threading.current_thread(), self.out).write(data)
+
+    def flush(self):
+        self.out.flush()
+
+
+_output_lock = threading.Lock()
+
+
+def _capture(buf):
+    "Send what this thread prints to buf (a file), or stop if buf is None"
+    with _output_lock:
+        if not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)
+        if buf is None:
+            sys.stdout.buffers.pop(threading.current_thread(), None)
+        else:
+            sys.stdout.buffers[threading.current_thread()] = buf
+
+
+class _PipelinedClient(object):
+    """Thrift client wrapper that only sends the requests of PIPELINED_RPCS
+    and reads their replies later, in order, a window at a time"""
+
+    def __init__(self, client, window=WINDOW):
+        self._client = client
+        self._window = window
+        self._pending = []
+        self.command = None
+        self.errors = []
+
+    def drain(self):
+        "Read the replies of all pipelined requests, recording failures"
+        pending, self._pending = self._pending, []
+        for name, command in pending:
+            try:
+                getattr(self._client, 'recv_' + name)()
+            except Exception as e:  # pylint: disable=broad-except
+                self.errors.append((command, repr(e)))
+
+    def __getattr__(self, name):
+        if name not in PIPELINED_RPCS:
+            # Anything else may depend on what came before
+            self.drain()
+            return getattr(self._client, name)
+
+        def send(*args):
+            getattr(self._client, 'send_' + name)(*args)
+            self._pending.append((name, self.command))
+            if len(self._pending) >= self._window:
+                self.drain()
+            # Stands for the entry handle the CLI prints
+            return 0
+        return send
+
+
+_program_lock = threading.Lock()
+# Program runtime_CLI parsed, and the number of open connections using it
+_program = dict(config=None, connections=0)
+
+
+def _load_program(runtime_CLI, client, config):
+    """Have runtime_CLI parse commands for config, the program a switch
+    runs. runtime_CLI keeps the program in module globals, so every
+    connection running commands at a time has to be to a switch running the
+    same one (BulkLoader.load() groups switches by program). It is
+    forgotten when the last of them closes (_release_program())."""
+    with _program_lock:
+        if _program['connections'] and _program['config'] != config:
+            raise Exception('Switches run different programs; use "table_loader": "cli"')
+        if not _program['connections']:
+            runtime_CLI.load_json_config(client)
+            _program['config'] = config
+        _program['connections'] += 1
+
+
+def _release_program():
+    "Forget the program once no connection uses it"
+    with _program_lock:
+        _program['connections'] -= 1
+        if not _program['connections']:
+            _program['config'] = None
+
+
+class ThriftConnection(object):
+    """Connection to a bmv2 switch's Thrift server that runs CLI commands
+    with bmv2's runtime_CLI (and sswitch_CLI, when installed)"""
+
+    def __init__(self, host, port, output=None, window=WINDOW):
+        """host, port: address of the Thrift server
+        output: file the CLI's messages go to (default: discarded)"""
+        import runtime_CLI
+        self.output = output if output is not None else open('/dev/null', 'w')
+        pre = runtime_CLI.PreType.SimplePreLAG
+        services = runtime_CLI.RuntimeAPI.get_thrift_services(pre)
+        try:
+            from sswitch_CLI import SimpleSwitchAPI
+            services.extend(SimpleSwitchAPI.get_thrift_services())
+        except ImportError:
+            SimpleSwitchAPI = None
+        clients = runtime_CLI.thrift_connect(host, port, services)
+        self.runtime_CLI = runtime_CLI
+        self.program = clients[0].bm_get_config()
+        # Whether runtime_CLI parses commands for program on its behalf;
+        # only once it runs one, so that switches running other programs
+        # can be connected to meanwhile
+        self.parsing = False
+        self.closed = False
+        self.client = _PipelinedClient(clients[0], window)
+        if SimpleSwitchAPI:
+            self.api = SimpleSwitchAPI(pre, self.client, clients[1], clients[2])
+        else:
+            self.api = runtime_CLI.RuntimeAPI(pre, self.client, clients[1])
+
+    def _run(self, cmd):
+        if not self.parsing:
+            _load_program(self.runtime_CLI, self.client._client, self.program)
+            self.parsing = True
+        self.client.command = cmd
+        _capture(self.output)
+        try:
+            self.api.onecmd(cmd)
+        finally:
+            _capture(None)
+
+    def send(self, cmd):
+        "Run a command, without waiting for its RPC's reply if it can be pipelined"
+        self._run(cmd)
+
+    def call(self, cmd):
+        "Run a command once all previous ones are done"
+        self.client.drain()
+        self._run(cmd)
+
+    def flush(self):
+        """Wait for the replies of pipelined RPCs
+        returns: list of (command, error) of the RPCs that failed"""
+        self.client.drain()
+        errors, self.client.errors = self.client.errors, []
+        return errors
+
+    def num_entries(self, table):
+        "Number of entries of a table"
+        self.client.drain()
+        return self.client.bm_mt_get_num_entries(0, table)
+
+    def read_register(self, register, start=0, end=None):
+        """Values of indexes start to end (default: the last) of a register,
+        read in one RPC. It does not go through runtime_CLI, so registers of
+        switches running any program can be read at any time.
+        returns: register_array()"""
+        return register_array(self.client.bm_register_read_all(0, register)[start:end])
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        try:
+            self.client.drain()
+            # Down through the protocols to the transport
+            trans = self.client._client._oprot
+            while not hasattr(trans, 'isOpen'):
+                trans = trans.trans
+            trans.close()
+        finally:
+            if self.parsing: _release_program()
+
+
+class FakeThriftServer(object):
+    """Stand-in for a switch's Thrift server: takes CLI commands, one per
+    line, over TCP, and answers each with "ok <value>" or "error <message>".
+    It keeps the entries of tables with their actions, default actions and
+    registers; every command takes latency seconds."""
+
+    def __init__(self, port=0, latency=0.0, registers=None, program='program'):
+        """registers: dict of register name -> size
+        program: name of the program it stands for a switch running"""
+        self.latency = latency
+        self.program = program
+        self.tables = {}
+        self.actions = {}
+        self.defaults = {}
+        self.registers = dict((name, [0] * size) for name, size in (registers or {}).iteritems())
+        self.handles = 0
+        self.lock = threading.Lock()
+        self.handlers = {}  # thread -> connection it serves
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn, _addr = self.sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            with self.lock:
+                self.handlers[t] = conn
+            t.start()
+
+    def handle(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        f = conn.makefile('r+b')
+        for line in f:
+            if self.latency: sleep(self.latency)
+            with self.lock:
+                try:
+                    reply = 'ok %s' % self.execute(line.split())
+                except Exception as e:  # pylint: disable=broad-except
+                    reply = 'error %s' % e
+            try:
+                f.write(reply + '\n')
+                f.flush()
+            except socket.error:
+                break
+        conn.close()
+
+    def execute(self, words):
+        "Run one command; returns its value"
+        cmd, args = words[0], words[1:]
+        if cmd == 'table_add':
+            table, arrow = args[0], args.index('=>')
+            key = tuple(args[2:arrow])
+            entries = self.tables.setdefault(table, {})
+            if key in entries.values():
+                raise Exception('DUPLICATE_ENTRY')
+            self.handles += 1
+            entries[self.handles] = key
+            self.actions[self.handles] = [args[1]] + args[arrow + 1:]
+            return self.handles
+        if cmd in ('table_delete', 'table_modify'):
+            handle = int(args[2] if cmd == 'table_modify' else args[1])
+            if handle not in self.tables.get(args[0], {}):
+                raise Exception('INVALID_HANDLE')
+            if cmd == 'table_modify':
+                # table_modify <table> <action> <handle> [action parameters]
+                self.actions[handle] = [args[1]] + args[3:]
+            else:
+                del self.tables[args[0]][handle]
+                del self.actions[handle]
+            return ''
+        if cmd == 'table_clear':
+            for handle in self.tables.get(args[0], {}):
+                del self.actions[handle]
+            self.tables[args[0]] = {}
+            return ''
+        if cmd == 'table_num_entries':
+            return len(self.tables.get(args[0], {}))
+        if cmd == 'get_config':
+            return self.program
+        if cmd == 'table_set_default':
+            self.defaults[args[0]] = args[1:]
+            return ''
+        if cmd.startswith('register_'):
+            if args[0] not in self.registers:
+                raise Exception('INVALID_REGISTER_NAME')
+            values = self.registers[args[0]]
+            if len(args) > 1 and not 0 <= int(args[1]) < len(values):
+                raise Exception('INVALID_INDEX')
+        if cmd == 'register_write':
+            values[int(args[1])] = long(args[2])
+            return ''
+        if cmd == 'register_read':
+            if len(args) > 1:
+                return values[int(args[1])]
+            return '%s= %s' % (args[0], ', '.join(str(v) for v in values))
+        if cmd == 'register_reset':
+            values[:] = [0] * len(values)
+            return ''
+        if cmd.startswith('mc_') or cmd == 'counter_reset':
+            self.handles += 1
+            return self.handles
+        raise Exception('unknown command %s' % cmd)
+
+    def stop(self):
+        "Stop accepting connections and close the open ones"
+        # Shutting sockets down wakes up the threads blocked on them, which
+        # hold them open past close()
+        for sock in [self.sock] + self.handlers.values():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.sock.close()
+        self.thread.join()
+        for t in self.handlers:
+            t.join()
+
+
+class _FakeRuntimeCLI(object):
+    "Stand-in for runtime_CLI's module globals: the program it parsed"
+
+    def __init__(self):
+        self.program = None
+
+    def load_json_config(self, client):
+        self.program = client.bm_get_config()
+
+
+_fake_runtime_CLI = _FakeRuntimeCLI()
+
+
+class FakeConnection(object):
+    """Connection to a FakeThriftServer, with the interface of
+    ThriftConnection. Its commands take turns with those of other programs
+    in a stand-in for runtime_CLI the way ThriftConnection's do."""
+
+    def __init__(self, host, port, output=None, window=WINDOW):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.f = self.sock.makefile('r+b')
+        self.output = output
+        self.window = window
+        self.pending = []
+        self.errors = []
+        self.parsing = False
+        self.program = self._call('get_config')
+
+    def bm_get_config(self):
+        return self.program
+
+    def _parse(self):
+        if not self.parsing:
+            _load_program(_fake_runtime_CLI, self, self.program)
+            self.parsing = True
+        if _fake_runtime_CLI.program != self.program:
+            raise Exception('Commands for %s parsed for %s' % (self.program, _fake_runtime_CLI.program))
+
+    def _reply(self, cmd):
+        reply = self.f.readline().rstrip('\n')
+        if self.output is not None:
+            self.output.write('%s: %s\n' % (cmd, reply))
+        status, _, value = reply.partition(' ')
+        if status != 'ok':
+            self.errors.append((cmd, reply))
+        return value
+
+    def _drain(self):
+        self.f.flush()
+        pending, self.pending = self.pending, []
+        for cmd in pending:
+            self._reply(cmd)
+
+    def _call(self, cmd):
+        self._drain()
+        self.f.write(cmd + '\n')
+        self.f.flush()
+        return self._reply(cmd)
+
+    def send(self, cmd):
+        self._parse()
+        self.f.write(cmd + '\n')
+        self.pending.append(cmd)
+        if len(self.pending) >= self.window:
+            self._drain()
+
+    def call(self, cmd):
+        self._parse()
+        return self._call(cmd)
+
+    def flush(self):
+        self._drain()
+        errors, self.errors = self.errors, []
+        return errors
+
+    def num_entries(self, table):
+        return int(self._call('table_num_entries %s' % table))
+
+    def read_register(self, register, start=0, end=None):
+        errors = len(self.errors)
+        reply = self._call('register_read %s' % register)
+        if len(self.errors) > errors:
+            raise Exception('%s: %s' % self.errors.pop())
+        return register_array(parse_register(reply, register)[start:end])
+
+    def close(self):
+        try:
+            self._drain()
+            self.sock.close()
+        finally:
+            if self.parsing: _release_program()
+            self.parsing = False
+
+
+def _in_parallel(function, names):
+    "Call function with each of names, each in a thread of its own, and wait for them"
+    threads = [threading.Thread(target=function, args=(name,)) for name in names]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+
+class BulkLoader(object):
+    "Load CLI commands into many switches at once"
+
+    def __init__(self, connect, pipelined=PIPELINED_COMMANDS):
+        """connect: function of a switch name that returns a connection to
+        it (ThriftConnection, FakeConnection)
+        pipelined: commands that are pipelined"""
+        self.connect = connect
+        self.pipelined = pipelined
+
+    def load_switch(self, sw_name, cmds, counts=None, verify=True, conn=None):
+        """Load commands into one switch
+        counts: entries of its tables before, default none
+        conn: connection to the switch to load through and close, default
+        a new one
+        returns: dict of commands, start, end, errors (list of (command,
+        error)) and mismatches (dict of table -> (expected, installed))"""
+        result = dict(commands=len(cmds), start=time(), errors=[], mismatches={})
+        try:
+            if conn is None: conn = self.connect(sw_name)
+            try:
+                for cmd in cmds:
+                    if cmd.split(None, 1)[0] in self.pipelined:
+                        conn.send(cmd)
+                    else:
+                        conn.call(cmd)
+                result['errors'] = conn.flush()
+                if verify:
+                    for table, expected in sorted(expected_counts(cmds, counts).iteritems()):
+                        installed = conn.num_entries(table)
+                        if installed != expected:
+                            result['mismatches'][table] = (expected, installed)
+            finally:
+                conn.close()
+        except Exception as e:  # pylint: disable=broad-except
+            result['errors'].append((None, repr(e)))
+        result['end'] = time()
+        return result
+
+    def load(self, cmds, counts=None, verify=True):
+        """Load commands into switches, all those running the same program
+        at once, one program after the other
+        cmds: dict of switch name -> list of commands
+        counts: dict of switch name -> entries of its tables before
+        returns: dict of switch name -> result of load_switch()"""
+        counts = counts or {}
+        conns, results = {}, {}
+
+        def connect(sw_name):
+            try:
+                conns[sw_name] = self.connect(sw_name)
+            except Exception as e:  # pylint: disable=broad-except
+                results[sw_name] = dict(commands=len(cmds[sw_name]), start=time(), end=time(),
+                                        errors=[(None, repr(e))], mismatches={})
+
+        def run(sw_name):
+            results[sw_name] = self.load_switch(sw_name, cmds[sw_name], counts.get(sw_name), verify,
+                                                conns[sw_name])
+
+        _in_parallel(connect, [sw_name for sw_name in cmds if cmds[sw_name]])
+        programs = {}
+        for sw_name in sorted(conns):
+            programs.setdefault(conns[sw_name].program, []).append(sw_name)
+        for switches in sorted(programs.values()):
+            _in_parallel(run, switches)
+        return results
+
+
+def snapshot(connect, switches, registers, close=True):
+    """Read registers of several switches, all at once, whatever programs
+    they run
+    connect: function of a switch name that returns a connection to it
+    registers: list of register names, or dict of register name ->
+    (start, end) of the indexes to read
+    close: close the connections once read; False when connect keeps
+    them open between calls (AppController.connection()), and closes them
+    itself
+    returns: dict of switch name -> dict of register name -> values, as
+    returned by read_register()"""
+    if not isinstance(registers, dict):
+        registers = dict((register, (0, None)) for register in registers)
+    values, errors = {}, {}
+
+    def run(sw_name):
+        try:
+            conn = connect(sw_name)
+            try:
+                values[sw_name] = dict((register, conn.read_register(register, start, end))
+                                       for register, (start, end) in registers.iteritems())
+            finally:
+                if close: conn.close()
+        except Exception as e:  # pylint: disable=broad-except
+            errors[sw_name] = repr(e)
+
+    _in_parallel(run, switches)
+    if errors:
+        raise Exception('Could not read registers of %s' % ', '.join(
+            '%s (%s)' % (sw_name, errors[sw_name]) for sw_name in sorted(errors)))
+    return values
+
+
+def thrift_available():
+    "Is bmv2's Python runtime (runtime_CLI) installed?"
+    try:
+        import runtime_CLI  # pylint: disable=unused-variable
+        return True
+    except ImportError:
+        return False
+
+
+def load_report(results):
+    "Return a printable report of the results of BulkLoader.load()"
+    lines = ['*** Table loading']
+    for sw_name in sorted(results):
+        r = results[sw_name]
+        problems = ['%d errors' % len(r['errors'])] if r['errors'] else []
+        problems += ['%s: %d entries, expected %d' % (table, installed, expected)
+                     for table, (expected, installed) in sorted(r['mismatches'].iteritems())]
+        lines.append('  %-16s %6d commands %8.3fs  %s' % (
+            sw_name, r['commands'], r['end'] - r['start'], '; '.join(problems) or 'ok'))
+        for cmd, error in r['errors'][:5]:
+            lines.append('    %s: %s' % (cmd or 'connection', error))
+    return '\n'.join(lines)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python2
+
+# Targeted cleanup for multiswitch targets.
+#
+# Removes what a run of a p4app.json target left behind on its servers --
+# its bmv2 switches, node shells and namespaces, ssh tunnels, interfaces,
+# tap devices and bmv2 IPC files -- on all servers at once, leaving
+# anything else running on them alone. What the run created, and on which
+# servers, is read from the cleanup state file it kept in its log
+# directory (cleanup_state.json) as it built the network; a run that
+# stopped its network cleanly leaves none.
+
+import argparse
+import os
+
+from mininet.log import setLogLevel
+
+from cluster import CLEANUP_STATE, ClusterCleanup
+
+parser = argparse.ArgumentParser(description='Mininet cluster cleanup')
+parser.add_argument('--state', help='Cleanup state file of the run to clean up after',
+                    type=str, action="store", default=os.path.join('logs', CLEANUP_STATE))
+parser.add_argument('--timeout', help='Seconds each server is given to clean up',
+                    type=int, action="store", default=ClusterCleanup.timeout)
+
+
+def main():
+    args = parser.parse_args()
+    if not ClusterCleanup.load(args.state):
+        print 'No cleanup state in %s: nothing is left from a run there' % args.state
+        return 0
+    if not any(ClusterCleanup.experiment.values()):
+        # cleanup() would fall back to a full mn -c on every server
+        print 'Nothing was created by the run recorded in %s' % args.state
+        ClusterCleanup.forget()
+        return 0
+    ClusterCleanup.timeout = args.timeout
+    if ClusterCleanup.cleanup():
+        return 1
+    ClusterCleanup.forget()
+    return 0
+
+
+if __name__ == '__main__':
+    setLogLevel('info')
+    exit(main())
@@ -35,9 +35,12 @@ pair of mininet servers that needs to communicate.
 How are tunnels created?
 
 We have several options including ssh, GRE, OF capsulator, socat, VDE, l2tp,
-etc..  It's not clear what the best one is.  For now, we use ssh tunnels since
-they are encrypted and semi-automatically shared.  We will probably want to
-support GRE as well because it's very easy to set up with OVS.
+etc..  It's not clear what the best one is.  By default we use ssh tunnels
+since they are encrypted and semi-automatically shared.  Kernel VXLAN or
+GRETAP tunnels (tunnel='vxlan' or 'gretap') keep data packets out of
+userspace, with ssh only used to set them up. They carry full-size frames
+unfragmented, so the underlay between servers needs an MTU of 1500 plus
+their headers; making a tunnel fails when it is smaller.
 
 How are tunnels destroyed?
 
@@ -81,23 +84,27 @@ from mininet.topo import LinearTopo
 from mininet.topolib import TreeTopo
 from mininet.util import quietRun, errRun
 from mininet.examples.clustercli import CLI
-from mininet.log import setLogLevel, debug, info, error
+from mininet.log import setLogLevel, debug, info, warn, error
 from mininet.clean import addCleanupCallback
 
 from signal import signal, SIGINT, SIG_IGN
 from subprocess import Popen, PIPE, STDOUT
+import json
 import os
 from random import randrange
 import sys
 import re
-from itertools import groupby
+from itertools import groupby, count
+from threading import Thread, RLock, Lock
 from operator import attrgetter
 from distutils.version import StrictVersion
 
-from p4_mininet import P4Switch, P4Host
-import tempfile
-import socket
-from time import sleep
+from p4_mininet import P4Switch, P4Host, cpu_list
+from agent import Agent
+from reader import OutputReader, readOutput
+import timeline
+from pipes import quote
+from time import sleep, time
 
 def findUser():
     "Try to return logged-in (usually non-root) user"
@@ -110,34 +117,206 @@ def findUser():
             quietRun( 'whoami' ) )
 
 
+def runParallel( cmds, timeout ):
+    """Run commands concurrently, giving each at most timeout seconds
+       cmds: dict of key -> command list
+       returns: dict of key -> ( returncode, output ), the returncode
+                being None for commands that were killed at the timeout"""
+    reader = OutputReader()
+    for key, cmd in cmds.iteritems():
+        # Each command runs in its own process group, with its ssh
+        reader.add( key, Popen( cmd, stdout=PIPE, stderr=STDOUT,
+                                close_fds=True, preexec_fn=os.setpgrp ) )
+    results = {}
+    for key in reader.wait( timeout=timeout ):
+        reader.kill( key )
+        results[ key ] = ( None, '' )
+    for key in cmds:
+        results.setdefault( key, reader.result( key ) )
+    return results
+
+
+def rcmdAll( cmds, timeout=None ):
+    """Run commands on the servers of nodes, all at once
+       cmds: list of ( node, command string or list )
+       timeout: seconds each command may take, or None
+       returns: list of outputs, in the order of cmds"""
+    reader = OutputReader()
+    outputs = [ None ] * len( cmds )
+    for i, ( node, cmd ) in enumerate( cmds ):
+        if not getattr( node, 'agent', None ):
+            reader.add( i, node.rpopen( cmd ) )
+    # Nodes with an agent go through it while the others run
+    for i, ( node, cmd ) in enumerate( cmds ):
+        if getattr( node, 'agent', None ):
+            outputs[ i ] = node.rcmd( cmd )
+    late = reader.wait( timeout=timeout )
+    for i in late:
+        reader.kill( i )
+    if late:
+        raise Exception( 'rcmdAll: timed out after %ss: %s' % (
+            timeout, ', '.join( '%s: %s' % cmds[ i ] for i in late ) ) )
+    for i in reader.procs:
+        outputs[ i ] = reader.result( i )[ 1 ]
+    return outputs
+
+
+# Name of the file, in a run's log directory, recording what the run
+# created on its servers for clean.py
+CLEANUP_STATE = 'cleanup_state.json'
+
+
 class ClusterCleanup( object ):
-    "Cleanup callback"
+    """Cleanup callback. Once an experiment has recorded what it creates
+       with track(), only that is removed from each server; otherwise
+       every server gets a full mn -c. With a stateFile, what is tracked
+       is also written there as it is created, so that clean.py can remove
+       it after the experiment's own process is gone."""
 
     inited = False
     serveruser = {}
+    # What this experiment created on its servers
+    experiment = dict( nodes=set(), thriftPorts=set(), deviceIds=set(),
+                       taps=set() )
+    # Seconds each server is given to clean up
+    timeout = 60
+    # File the experiment is recorded in, or None
+    stateFile = None
+    # Tunnels are tracked from several threads at once
+    lock = Lock()
 
     @classmethod
     def add( cls, server, user='' ):
         "Add an entry to server: user dict"
         if not cls.inited:
             addCleanupCallback( cls.cleanup )
+            cls.inited = True
         if not user:
             user = findUser()
-        cls.serveruser[ server ] = user
+        with cls.lock:
+            if cls.serveruser.get( server ) != user:
+                cls.serveruser[ server ] = user
+                cls.save()
+
+    @classmethod
+    def track( cls, **kwargs ):
+        """Record what belongs to this experiment
+           nodes: names of its hosts and switches
+           thriftPorts, deviceIds: of its bmv2 switches
+           taps: indices of its tunnel tap devices"""
+        with cls.lock:
+            for key, values in kwargs.iteritems():
+                cls.experiment[ key ].update( values )
+            cls.save()
+
+    @classmethod
+    def save( cls ):
+        "Write the servers and what was tracked to stateFile, if any"
+        if not cls.stateFile:
+            return
+        state = dict( servers=cls.serveruser, experiment=dict(
+            ( key, sorted( values ) )
+            for key, values in cls.experiment.iteritems() ) )
+        with open( cls.stateFile + '.tmp', 'w' ) as f:
+            json.dump( state, f, indent=2, sort_keys=True )
+        os.rename( cls.stateFile + '.tmp', cls.stateFile )
+
+    @classmethod
+    def load( cls, path ):
+        """Read what an experiment recorded in path, to clean up after it
+           returns: False if there is no such file"""
+        if not os.path.isfile( path ):
+            return False
+        with open( path ) as f:
+            state = json.load( f )
+        cls.stateFile = path
+        for key, values in state[ 'experiment' ].iteritems():
+            cls.experiment[ str( key ) ] = set(
+                str( v ) if isinstance( v, basestring ) else v
+                for v in values )
+        for server, user in state[ 'servers' ].iteritems():
+            cls.add( str( server ), str( user ) )
+        return True
+
+    @classmethod
+    def forget( cls ):
+        "Forget the experiment once it is gone, removing its stateFile"
+        with cls.lock:
+            for values in cls.experiment.values():
+                values.clear()
+            if cls.stateFile and os.path.isfile( cls.stateFile ):
+                os.remove( cls.stateFile )
+
+    @classmethod
+    def cleanupCmd( cls ):
+        """Shell command removing what the experiment left on a server:
+           its bmv2 switches, node shells (and with them the nodes'
+           namespaces), ssh tunnels, interfaces, tap devices and bmv2
+           IPC files"""
+        exp = cls.experiment
+        ports = '|'.join( str( p ) for p in sorted( exp[ 'thriftPorts' ] ) )
+        nodes = '|'.join( sorted( exp[ 'nodes' ] ) )
+        taps = sorted( exp[ 'taps' ] )
+        cmds = []
+        if ports:
+            cmds.append( "pkill -9 -f -- '--thrift-port (%s)( |$)'" % ports )
+        if nodes:
+            cmds.append( "pkill -9 -f 'mininet:(%s)$'" % nodes )
+        if taps:
+            cmds.append( "pkill -9 -f 'Tunnel=Ethernet -w (%s) '" %
+                         '|'.join( '%d:%d' % ( i, i ) for i in taps ) )
+        intfs = []
+        if nodes:
+            intfs.append( '(%s)-eth[0-9]+' % nodes )
+        if taps:
+            intfs.append( 'tap(%s)' % '|'.join( str( i ) for i in taps ) )
+        if intfs:
+            cmds.append( "for intf in $( ip -o link show | "
+                         "sed -n 's/^[0-9]*: \\([^:@]*\\).*/\\1/p' | "
+                         "grep -E '^(%s)$' ); do ip link del $intf; done" %
+                         '|'.join( intfs ) )
+        if exp[ 'deviceIds' ]:
+            cmds.append( 'rm -f ' + ' '.join(
+                '/tmp/bm-%d-log.ipc /tmp/bmv2-%d-notifications.ipc' % ( i, i )
+                for i in sorted( exp[ 'deviceIds' ] ) ) )
+        # pkill fails when there is nothing to kill
+        return '; '.join( cmds + [ 'true' ] )
 
     @classmethod
     def cleanup( cls ):
-        "Clean up"
+        """Clean up all servers at once
+           returns: servers that failed to clean up"""
         info( '*** Cleaning up cluster\n' )
+        targeted = any( cls.experiment.values() )
+        script = cls.cleanupCmd() if targeted else 'mn -c'
+        cmds = {}
         for server, user in cls.serveruser.iteritems():
             if server == 'localhost':
-                # Handled by mininet.clean.cleanup()
-                continue
+                if not targeted:
+                    # Handled by mininet.clean.cleanup()
+                    continue
+                cmds[ server ] = [ 'sh', '-c', script ]
+            else:
+                remote = 'sudo sh -c %s' % quote( script )
+                cmds[ server ] = [ 'su', user, '-c',
+                                   'ssh -o BatchMode=yes -o ConnectTimeout=%d '
+                                   '%s@%s %s' % ( cls.timeout, user, server,
+                                                  quote( remote ) ) ]
+            debug( cmds[ server ], '\n' )
+        results = runParallel( cmds, cls.timeout )
+        for server in sorted( results ):
+            code, output = results[ server ]
+            if code is None:
+                error( '*** %s: cleanup timed out after %ds\n' %
+                       ( server, cls.timeout ) )
+            elif code:
+                error( '*** %s: cleanup failed (%d): %s\n' %
+                       ( server, code, output.strip() ) )
             else:
-                cmd = [ 'su', user, '-c',
-                        'ssh %s@%s sudo mn -c' % ( user, server ) ]
-                info( cmd, '\n' )
-                info( quietRun( cmd ) )
+                info( '%s ' % server )
+        info( '\n' )
+        return [ server for server in sorted( results )
+                 if results[ server ][ 0 ] != 0 ]
 
 # BL note: so little code is required for remote nodes,
 # we will probably just want to update the main Node()
@@ -160,13 +339,16 @@ class RemoteMixin( object ):
                 '-o', 'ForwardAgent=yes', '-tt' ]
 
     def __init__( self, name, server='localhost', user=None, serverIP=None,
-                  controlPath=False, splitInit=False, **kwargs):
+                  controlPath=False, splitInit=False, pool=None, agent=None,
+                  **kwargs):
         """Instantiate a remote node
            name: name of remote node
            server: remote server (optional)
            user: user on remote server (optional)
            controlPath: specify shared ssh control path (optional)
            splitInit: split initialization?
+           pool: SSHPool counting our commands (optional)
+           agent: Agent on our server to run rcmd() through (optional)
            **kwargs: see Node()"""
         # We connect to servers by IP address
         self.server = server if server else 'localhost'
@@ -179,6 +361,8 @@ class RemoteMixin( object ):
             controlPath = '/tmp/mn-%r@%h:%p'
         self.controlPath = controlPath
         self.splitInit = splitInit
+        self.pool = pool
+        self.agent = agent
         if self.user and self.server != 'localhost':
             self.dest = '%s@%s' % ( self.user, self.serverIP )
             self.dir = ['cd', '%s' % os.getcwd(), ';']
@@ -195,6 +379,8 @@ class RemoteMixin( object ):
             self.isRemote = False
         # Satisfy pylint
         self.shell, self.pid = None, None
+        # Links to other servers are set up concurrently
+        self.cmdLock = RLock()
         super( RemoteMixin, self ).__init__( name, **kwargs )
 
     # Determine IP address of local host
@@ -218,11 +404,13 @@ class RemoteMixin( object ):
         "Start a shell process for running commands"
         if self.isRemote:
             kwargs.update( mnopts='-c' )
-        super( RemoteMixin, self ).startShell( *args, **kwargs )
-        # Optional split initialization
-        self.sendCmd( 'echo $$' )
-        if not self.splitInit:
-            self.finishInit()
+        with timeline.timed( '%s shell' % self.name, kind='node',
+                             server=self.server ):
+            super( RemoteMixin, self ).startShell( *args, **kwargs )
+            # Optional split initialization
+            self.sendCmd( 'echo $$' )
+            if not self.splitInit:
+                self.finishInit()
 
     def finishInit( self ):
         "Wait for split initialization to complete"
@@ -241,18 +429,18 @@ class RemoteMixin( object ):
         """rcmd: run a command on underlying server
            in root namespace
            args: string or list of strings
+           timeout: seconds after which the command is killed (optional)
            returns: stdout and stderr"""
+        timeout = opts.pop( 'timeout', None )
+        if self.agent and timeout is None and opts in ( {}, { 'sudo': True } ):
+            cmd = cmd[ 0 ] if len( cmd ) == 1 else cmd
+            return self.agent.run( cmd if type( cmd ) is str
+                                   else ' '.join( cmd ) )
         popen = self.rpopen( *cmd, **opts )
-        # print 'RCMD: POPEN:', popen
-        # These loops are tricky to get right.
-        # Once the process exits, we can read
-        # EOF twice if necessary.
-        result = ''
-        while True:
-            poll = popen.poll()
-            result += popen.stdout.read()
-            if poll is not None:
-                break
+        code, result = readOutput( popen, timeout=timeout )
+        if code is None:
+            raise Exception( '%s: rcmd timed out after %ss: %s' %
+                             ( self, timeout, cmd ) )
         return result
 
     @staticmethod
@@ -268,6 +456,8 @@ class RemoteMixin( object ):
         if type( cmd ) is str:
             cmd = cmd.split()
         if self.isRemote:
+            if self.pool:
+                self.pool.count( self.server )
             if sudo:
                 cmd = [ 'sudo', '-E' ] + cmd
             if tt:
@@ -287,8 +477,17 @@ class RemoteMixin( object ):
         popen = super( RemoteMixin, self )._popen( cmd, **params )
         return popen
 
+    def cmd( self, *args, **kwargs ):
+        "Override: one command at a time through our shell"
+        with self.cmdLock:
+            return super( RemoteMixin, self ).cmd( *args, **kwargs )
+
     def popen( self, *args, **kwargs ):
-        "Override: disable -tt"
+        "Override: disable -tt, and keep to our cores if we are pinned"
+        if getattr( self, 'cpus', None ):
+            kwargs.setdefault( 'mncmd', [ 'mnexec', '-da', str( self.pid ),
+                                          'taskset', '-c',
+                                          cpu_list( self.cpus ) ] )
         return super( RemoteMixin, self).popen( *args, tt=False, **kwargs )
 
     def addIntf( self, *args, **kwargs ):
@@ -314,59 +513,41 @@ class RemoteP4Switch( RemoteMixin, P4Switch ):
     "Remote instance of P4Switch"
 
     def __init__( self, *args, **kwargs ):
-        # No batch startup yet
-        kwargs.update( batch=False )
+        # start() only launches the switch; batchStartup() waits for
+        # the Thrift ports of all switches at once
+        kwargs.setdefault( 'batch', True )
+        self.proc = None
         super( RemoteP4Switch, self ).__init__( *args, **kwargs )
 
     def start(self, controllers):
         "Start up a new P4 switch"
+        with timeline.timed('%s start' % self.name, kind='node', server=self.server):
+            self._start(controllers)
+
+    def _start(self, controllers):
         info("Starting P4 switch {}.\n".format(self.name))
-        args = [self.sw_path]
-        for port, intf in self.intfs.items():
-            if not intf.IP():
-                args.extend(['-i', str(port) + "@" + intf.name])
-        if self.pcap_dump:
-            args.append("--pcap")
-            # args.append("--useFiles")
-        if self.thrift_port:
-            args.extend(['--thrift-port', str(self.thrift_port)])
-        if self.nanomsg:
-            args.extend(['--nanolog', self.nanomsg])
-        args.extend(['--device-id', str(self.device_id)])
-        P4Switch.device_id += 1
-        args.append(self.json_path)
-        if self.enable_debugger:
-            args.append("--debugger")
-        if self.log_console:
-            args.append("--log-console")
-
-        pid = None
-        with tempfile.NamedTemporaryFile() as f:
-            #self.rcmd(' '.join(args) + ' > /dev/null 2>&1 &')
-#            info(' '.join(args) + '\n')
-            p = self.rpopen((' '.join(args)).split(), stdout=self.output)
-            #pid = int(f.read())
-        # debug("P4 switch {} PID is {}.\n".format(self.name, pid))
-        sleep(1)
-        if not self.check_switch_started(p.pid):
+        args = self.switch_args()
+        # Recorded before it runs, in case this process dies first
+        ClusterCleanup.track( nodes=[ self.name ],
+                              thriftPorts=[ self.thrift_port ],
+                              deviceIds=[ self.device_id ] )
+        self.launched = time()
+        self.proc = self.rpopen((' '.join(args)).split(), stdout=self.output)
+        if self.batch:
+            return
+        if not self.check_switch_started():
             error("P4 switch {} did not start correctly."
                   "Check the switch log file.\n".format(self.name))
             exit(1)
         info("P4 switch {} has been started.\n".format(self.name))
 
-    def check_switch_started(self, pid):
-        """While the process is running (pid exists), we check if the Thrift
-        server has been started. If the Thrift server is ready, we assume that
-        the switch was started successfully. This is only reliable if the Thrift
-        server is started at the end of the init process"""
-        while True:
-            if not os.path.exists(os.path.join("/proc", str(pid))):
-                return False
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(0.5)
-            result = sock.connect_ex((self.server, self.thrift_port))
-            if result == 0:
-                return  True
+    def thrift_address(self):
+        "Address the switch's Thrift server listens on"
+        return (self.serverIP if self.isRemote else 'localhost', self.thrift_port)
+
+    def is_running(self):
+        "Is the launched switch (or the ssh session running it) alive?"
+        return self.proc is not None and self.proc.poll() is None
 
     def stop(self):
         "Terminate P4 switch."
@@ -420,9 +601,47 @@ class RemoteP4Switch( RemoteMixin, P4Switch ):
 #        return switches
 
 
+class KernelTunnel( object ):
+    """Kernel (VXLAN or GRETAP) tunnel between two servers, standing in
+       for the ssh process of an ssh tunnel. The tunnel goes away with its
+       interfaces."""
+
+    def __init__( self, kind, index ):
+        self.kind = kind
+        self.index = index
+        self.pid = '%s %d' % ( kind, index )
+        self.returncode = None
+
+    def poll( self ):
+        "The tunnel lasts as long as its interfaces"
+        return None
+
+    def terminate( self ):
+        "Nothing to do; deleting the interfaces removes the tunnel"
+        pass
+
+
 class RemoteLink( TCLink ):
     "A RemoteLink is a link between nodes which may be on different servers"
 
+    # Every tunnel gets its own tap device and ssh tunnel index, so that
+    # tunnels can be set up concurrently
+    tapIndex = count( 9 )
+
+    # Cross-server link types: 'ssh' (ssh Ethernet tunnel), or a kernel
+    # tunnel, 'vxlan' or 'gretap'
+    tunnelTypes = ( 'ssh', 'vxlan', 'gretap' )
+    vxlanPort = 4789
+    # MTU of node interfaces, which kernel tunnels carry whole, and the
+    # bytes of headers each kernel tunnel adds to the frames: outer IPv4,
+    # UDP and VXLAN, or IPv4 and GRE with a key, and the inner Ethernet
+    # header
+    nodeMtu = 1500
+    tunnelOverhead = { 'vxlan': 50, 'gretap': 42 }
+    # ( server, dest ) -> ( source address, MTU ) of the underlay from a
+    # server to another, the same for every tunnel between them
+    underlays = {}
+
     def __init__( self, node1, node2, **kwargs ):
         """Initialize a RemoteLink
            see Link() for parameters"""
@@ -430,10 +649,18 @@ class RemoteLink( TCLink ):
         self.node1 = node1
         self.node2 = node2
         self.tunnel = None
+        self.tunnelType = kwargs.pop( 'tunnel', 'ssh' )
+        if self.tunnelType not in self.tunnelTypes:
+            raise Exception( 'RemoteLink: unknown tunnel type %s' %
+                             self.tunnelType )
         kwargs.setdefault( 'params1', {} )
         kwargs.setdefault( 'params2', {} )
         self.cmd = None  # satisfy pylint
+        start = time()
         TCLink.__init__( self, node1, node2, **kwargs )
+        timeline.record( '%s-%s' % ( node1, node2 ), start,
+                         time(), kind='link',
+                         tunnel=self.tunnel is not None )
 
     def stop( self ):
         "Stop this link"
@@ -474,8 +701,13 @@ class RemoteLink( TCLink ):
             printError: if true, print error"""
         intf = str( intf )
         cmd = 'ip link set %s netns %s' % ( intf, node.pid )
-        node.rcmd( cmd )
-        links = node.cmd( 'ip link show' )
+        if getattr( node, 'agent', None ):
+            # Move and check in a single batch
+            links = node.agent.batch(
+                [ cmd, { 'cmd': 'ip link show', 'ns': node.pid } ] )[ 1 ][ 'out' ]
+        else:
+            node.rcmd( cmd )
+            links = node.cmd( 'ip link show' )
         if not ' %s:' % intf in links:
             if printError:
                 error( '*** Error: RemoteLink.moveIntf: ' + intf +
@@ -493,19 +725,46 @@ class RemoteLink( TCLink ):
         if node2.server == 'localhost':
             return self.makeTunnel( node2, node1, intfname2, intfname1,
                                     addr2, addr1 )
-        # 1. Create tap interfaces
+        index = next( self.tapIndex )
+        tap = 'tap%d' % index
+        ClusterCleanup.track( taps=[ index ] )
+        if self.tunnelType == 'ssh':
+            tunnel = self.makeSshTunnel( node1, node2, tap, index )
+        else:
+            tunnel = self.makeKernelTunnel( node1, node2, tap, index )
+        # 3. Move interfaces if necessary
         for node in node1, node2:
-            # For now we are hard-wiring tap9, which we will rename
-            cmd = 'ip tuntap add dev tap9 mode tap user ' + node.user
-            result = node.rcmd( cmd )
+            if not self.moveIntf( tap, node ):
+                raise Exception( 'interface move failed on node %s' % node )
+        # 4. Rename tap interfaces to desired names
+        for node, intf, addr in ( ( node1, intfname1, addr1 ),
+                                  ( node2, intfname2, addr2 ) ):
+            if not addr:
+                result = node.cmd( 'ip link set', tap, 'name', intf )
+            else:
+                result = node.cmd( 'ip link set', tap, 'name', intf,
+                                   'address', addr )
+            if result:
+                raise Exception( 'error renaming %s: %s' % ( intf, result ) )
+        return tunnel
+
+    def makeSshTunnel( self, node1, node2, tap, index ):
+        """Make an ssh Ethernet tunnel between tap interfaces in the root
+           namespaces of two servers
+           returns: ssh Popen() object"""
+        # 1. Create tap interfaces
+        # The tap device is renamed once it is in its namespace
+        cmds = [ ( node, 'ip tuntap add dev %s mode tap user %s' %
+                   ( tap, node.user ) ) for node in ( node1, node2 ) ]
+        for ( node, _cmd ), result in zip( cmds, rcmdAll( cmds ) ):
             if result:
-                raise Exception( 'error creating tap9 on %s: %s' %
-                                 ( node, result ) )
+                raise Exception( 'error creating %s on %s: %s' %
+                                 ( tap, node, result ) )
         # 2. Create ssh tunnel between tap interfaces
         # -n: close stdin
         dest = '%s@%s' % ( node2.user, node2.serverIP )
-        cmd = [ 'ssh', '-n', '-o', 'Tunnel=Ethernet', '-w', '9:9',
-                dest, 'echo @' ]
+        cmd = [ 'ssh', '-n', '-o', 'Tunnel=Ethernet',
+                '-w', '%d:%d' % ( index, index ), dest, 'echo @' ]
         self.cmd = cmd
         tunnel = node1.rpopen( cmd, sudo=False )
         # When we receive the character '@', it means that our
@@ -518,22 +777,72 @@ class RemoteLink( TCLink ):
                              '%s:%s' % ( node1, node1.dest ), 'to',
                              '%s:%s\n' % ( node2, node2.dest ),
                              'command was:', cmd, '\n' )
-        # 3. Move interfaces if necessary
-        for node in node1, node2:
-            if not self.moveIntf( 'tap9', node ):
-                raise Exception( 'interface move failed on node %s' % node )
-        # 4. Rename tap interfaces to desired names
-        for node, intf, addr in ( ( node1, intfname1, addr1 ),
-                                  ( node2, intfname2, addr2 ) ):
-            if not addr:
-                result = node.cmd( 'ip link set tap9 name', intf )
-            else:
-                result = node.cmd( 'ip link set tap9 name', intf,
-                                   'address', addr )
-            if result:
-                raise Exception( 'error renaming %s: %s' % ( intf, result ) )
         return tunnel
 
+    @classmethod
+    def kernelTunnelCmd( cls, kind, intf, index, local, remote ):
+        """Command creating one end of a kernel tunnel
+           kind: 'vxlan' or 'gretap'
+           intf: interface name
+           index: VXLAN VNI or GRE key, the same at both ends
+           local, remote: underlay addresses of this and the other end"""
+        if kind == 'vxlan':
+            return ( 'ip link add %s mtu %d type vxlan id %d local %s '
+                     'remote %s dstport %d' % ( intf, cls.nodeMtu, index,
+                                                local, remote,
+                                                cls.vxlanPort ) )
+        if kind == 'gretap':
+            return ( 'ip link add %s mtu %d type gretap local %s remote %s '
+                     'key %d' % ( intf, cls.nodeMtu, local, remote, index ) )
+        raise Exception( 'unknown kernel tunnel type %s' % kind )
+
+    @classmethod
+    def underlay( cls, node, dest ):
+        """Address that node's server uses to reach dest, and the MTU of
+           the route: the path MTU it learned, else its interface's
+           returns: ( address, MTU )"""
+        key = ( node.server, dest )
+        if key not in cls.underlays:
+            output = node.rcmd( 'ip route get %s' % dest )
+            src = re.search( r'\bsrc (\S+)', output )
+            dev = re.search( r'\bdev (\S+)', output )
+            if not src or not dev:
+                raise Exception( 'no route from %s to %s: %s' %
+                                 ( node.server, dest, output ) )
+            mtu = re.search( r'\bmtu (\d+)', output )
+            mtu = ( mtu.group( 1 ) if mtu else
+                    node.rcmd( 'cat /sys/class/net/%s/mtu' % dev.group( 1 ) ) )
+            cls.underlays[ key ] = ( src.group( 1 ), int( mtu ) )
+        return cls.underlays[ key ]
+
+    def makeKernelTunnel( self, node1, node2, tap, index ):
+        """Make a VXLAN or GRETAP tunnel between interfaces in the root
+           namespaces of two servers
+           returns: KernelTunnel"""
+        local1, mtu1 = self.underlay( node1, node2.serverIP )
+        local2, mtu2 = self.underlay( node2, local1 )
+        # Fragmenting frames, or dropping them, would skew measurements
+        need = self.nodeMtu + self.tunnelOverhead[ self.tunnelType ]
+        for node, dest, mtu in ( ( node1, local2, mtu1 ),
+                                 ( node2, local1, mtu2 ) ):
+            if mtu < need:
+                raise Exception(
+                    '%s tunnels need an MTU of %d, the %d of node '
+                    'interfaces and %d of headers, but %s reaches %s with '
+                    '%d; raise it, or use ssh tunnels' % (
+                        self.tunnelType, need, self.nodeMtu,
+                        need - self.nodeMtu, node.server, dest, mtu ) )
+        cmds = [ ( node, self.kernelTunnelCmd( self.tunnelType, tap, index,
+                                               local, remote ) )
+                 for node, local, remote in ( ( node1, local1, local2 ),
+                                              ( node2, local2, local1 ) ) ]
+        self.cmd = cmds[ 0 ][ 1 ]
+        for ( node, _cmd ), result in zip( cmds, rcmdAll( cmds ) ):
+            if result:
+                raise Exception( 'error creating %s on %s: %s' %
+                                 ( tap, node, result ) )
+        return KernelTunnel( self.tunnelType, index )
+
     def status( self ):
         "Detailed representation of link"
         if self.tunnel:
@@ -734,6 +1043,530 @@ class HostSwitchBinPlacer( Placer ):
         return server
 
 
+class PartitionPlacer( Placer ):
+    """Place switches by partitioning the switch graph into balanced
+       parts joined by as few, and as lightly loaded, links as possible;
+       place hosts with their switches"""
+
+    def __init__( self, *args, **kwargs ):
+        """traffic: dict of ( node1, node2 ) -> expected traffic between
+                    hosts or switches, used to weigh links (optional)
+           costs: dict of node -> { resource: amount } the node needs
+                  (default: one 'switches' per switch)
+           capacities: dict of server -> { resource: amount }, or
+                       server -> relative capacity (default: equal)
+           utilization: fraction of each server's capacity to fill
+           imbalance: fraction by which parts may exceed their share"""
+        self.traffic = kwargs.pop( 'traffic', None ) or {}
+        self.costs = kwargs.pop( 'costs', None )
+        self.capacities = kwargs.pop( 'capacities', None )
+        self.utilization = kwargs.pop( 'utilization', 1.0 )
+        self.imbalance = kwargs.pop( 'imbalance', 0.05 )
+        # Only capacities given per resource are absolute amounts
+        self.absolute = bool( self.capacities ) and all(
+            isinstance( c, dict ) for c in self.capacities.values() )
+        Placer.__init__( self, *args, **kwargs )
+        self.hset = frozenset( self.hosts )
+        self.sset = frozenset( self.switches )
+        self.placement = self.calculatePlacement()
+
+    def switchGraph( self ):
+        """returns: adjacency dict of switch -> { switch: 1 } and
+           dict of host -> switch it's attached to"""
+        adj = dict( ( sw, {} ) for sw in self.switches )
+        switchFor = {}
+        for src, dst in self.links:
+            if src in self.sset and dst in self.sset:
+                adj[ src ][ dst ] = adj[ dst ][ src ] = 1
+            elif src in self.hset and dst in self.sset:
+                switchFor[ src ] = dst
+            elif dst in self.hset and src in self.sset:
+                switchFor[ dst ] = src
+        return adj, switchFor
+
+    @staticmethod
+    def spread( adj, src, dsts, load ):
+        """Add the traffic from src to each switch in dsts to load,
+           split evenly over all shortest paths
+           dsts: dict of switch -> traffic
+           load: dict of ( sw1, sw2 ) -> traffic, updated"""
+        # Breadth-first search, counting shortest paths
+        dist, sigma, preds, order = { src: 0 }, { src: 1 }, { src: [] }, [ src ]
+        for node in order:
+            for nbr in sorted( adj[ node ] ):
+                if nbr not in dist:
+                    dist[ nbr ] = dist[ node ] + 1
+                    sigma[ nbr ], preds[ nbr ] = 0, []
+                    order.append( nbr )
+                if dist[ nbr ] == dist[ node ] + 1:
+                    sigma[ nbr ] += sigma[ node ]
+                    preds[ nbr ].append( node )
+        # Push traffic back from the destinations towards src
+        flow = dict( ( sw, t ) for sw, t in dsts.iteritems() if sw in dist )
+        for node in reversed( order ):
+            f = flow.get( node, 0 )
+            if not f:
+                continue
+            for pred in preds[ node ]:
+                share = f * sigma[ pred ] / float( sigma[ node ] )
+                key = tuple( sorted( ( pred, node ) ) )
+                load[ key ] = load.get( key, 0 ) + share
+                flow[ pred ] = flow.get( pred, 0 ) + share
+
+    def weighLinks( self, adj, switchFor ):
+        """Weigh switch links by the traffic expected over them: every
+           link weighs 1, plus its share of the traffic, scaled so that
+           all traffic weighs as much as all links"""
+        demand = {}
+        for ( a, b ), t in self.traffic.iteritems():
+            a, b = switchFor.get( a, a ), switchFor.get( b, b )
+            if a != b and a in adj and b in adj:
+                demand.setdefault( a, {} )
+                demand[ a ][ b ] = demand[ a ].get( b, 0 ) + t
+        load = {}
+        for src in sorted( demand ):
+            self.spread( adj, src, demand[ src ], load )
+        total = sum( load.values() )
+        if not total:
+            return
+        scale = sum( len( nbrs ) for nbrs in adj.values() ) / 2.0 / total
+        for ( a, b ), t in load.iteritems():
+            adj[ a ][ b ] = adj[ b ][ a ] = 1 + scale * t
+
+    def weights( self, switchFor ):
+        """Resources needed by each switch, with its hosts
+           returns: dict of switch -> { resource: amount }"""
+        if not self.costs:
+            return dict( ( sw, { 'switches': 1.0 } ) for sw in self.switches )
+        weight = dict( ( sw, {} ) for sw in self.switches )
+        for node, cost in self.costs.iteritems():
+            sw = switchFor.get( node, node )
+            if sw not in weight:
+                continue
+            for r, amount in cost.iteritems():
+                weight[ sw ][ r ] = weight[ sw ].get( r, 0 ) + amount
+        return weight
+
+    def targets( self, weight ):
+        """Share of each resource for each server, in proportion to its
+           capacity, and the most each server may take. With absolute
+           capacities only the scarcest resource is shared out; the
+           others are only held to the utilization target.
+           returns: ( dict of server -> { resource: share },
+                      dict of server -> { resource: limit } )"""
+        total = {}
+        for w in weight.values():
+            for r, amount in w.iteritems():
+                total[ r ] = total.get( r, 0 ) + amount
+        caps = self.capacities or {}
+        caps = dict( ( s, caps.get( s, 1 if not caps else 0 ) )
+                     for s in self.servers )
+        # A single number is a relative capacity for every resource
+        caps = dict( ( s, c if isinstance( c, dict ) else
+                       dict( ( r, c ) for r in total ) )
+                     for s, c in caps.iteritems() )
+        # Resources not every server reports a capacity for are not
+        # limited
+        capTotal = dict( ( r, float( sum( c[ r ] for c in caps.values() ) ) )
+                         for r in total
+                         if all( r in c for c in caps.values() ) )
+        capTotal = dict( ( r, t ) for r, t in capTotal.iteritems() if t )
+        if not capTotal:
+            raise Exception( 'PartitionPlacer: no server capacity' )
+        scarcest = max( sorted( capTotal ),
+                        key=lambda r: total[ r ] / capTotal[ r ] )
+        share = dict( ( s, {} ) for s in self.servers )
+        limit = dict( ( s, {} ) for s in self.servers )
+        for r in capTotal:
+            for s in self.servers:
+                cap = caps[ s ][ r ]
+                if self.absolute and r != scarcest:
+                    share[ s ][ r ] = limit[ s ][ r ] = cap * self.utilization
+                    continue
+                share[ s ][ r ] = total[ r ] * cap / capTotal[ r ]
+                # Parts may exceed their share by the imbalance, but not
+                # the utilization target unless the share already does
+                limit[ s ][ r ] = share[ s ][ r ] * ( 1 + self.imbalance )
+                if self.absolute:
+                    limit[ s ][ r ] = max( share[ s ][ r ],
+                                           min( limit[ s ][ r ],
+                                                cap * self.utilization ) )
+        return share, limit
+
+    @staticmethod
+    def fits( load, weight, limit ):
+        "Can a part with load take weight without exceeding limit?"
+        return all( load.get( r, 0 ) + w <= limit[ r ] + 1e-9
+                    for r, w in weight.iteritems()
+                    if w > 0 and r in limit )
+
+    @staticmethod
+    def fill( load, limit ):
+        "Fraction of its most used resource a part has reached"
+        return max( [ load.get( r, 0 ) / limit[ r ]
+                      for r in limit if limit[ r ] ] or [ 0 ] )
+
+    def grow( self, adj, weight, share, limit ):
+        "Initial partition: grow each part from a seed, greedily"
+        part = {}
+        load = dict( ( s, {} ) for s in self.servers )
+
+        def add( node, server ):
+            part[ node ] = server
+            for r, w in weight[ node ].iteritems():
+                load[ server ][ r ] = load[ server ].get( r, 0 ) + w
+
+        order = sorted( self.servers,
+                        key=lambda s: -sum( share[ s ].values() ) )
+        for server in order:
+            gain = {}
+            while len( part ) < len( adj ):
+                if gain:
+                    node = max( sorted( gain ), key=lambda n: gain[ n ] )
+                else:
+                    # Seed: the free switch least tied to placed ones
+                    free = [ n for n in sorted( adj ) if n not in part ]
+                    node = min( free, key=lambda n: sum(
+                        w for m, w in adj[ n ].iteritems() if m in part ) )
+                if not self.fits( load[ server ], weight[ node ],
+                                  share[ server ] ):
+                    break
+                add( node, server )
+                gain.pop( node, None )
+                for nbr, w in adj[ node ].iteritems():
+                    if nbr not in part:
+                        gain[ nbr ] = gain.get( nbr, 0 ) + w
+        # Switches left over go where they are tied to, or to the part
+        # with the most room left
+        for node in sorted( adj ):
+            if node in part:
+                continue
+            fitting = [ s for s in order
+                        if self.fits( load[ s ], weight[ node ], limit[ s ] ) ]
+            if fitting:
+                server = max( fitting, key=lambda s: sum(
+                    w for m, w in adj[ node ].iteritems()
+                    if part.get( m ) == s ) )
+            else:
+                server = min( order, key=lambda s: self.fill( load[ s ],
+                                                              limit[ s ] ) )
+            add( node, server )
+        return part, load
+
+    def refine( self, adj, weight, part, load, limit, rounds=100,
+                candidates=8 ):
+        """Improve a partition with the best single moves and pairwise
+           swaps that keep parts within their limits, while they reduce
+           the weight of the cut"""
+
+        def ext( node ):
+            "Gain of moving node to each other part"
+            tie = dict( ( s, 0 ) for s in self.servers )
+            for nbr, w in adj[ node ].iteritems():
+                tie[ part[ nbr ] ] += w
+            own = tie[ part[ node ] ]
+            return dict( ( s, tie[ s ] - own ) for s in self.servers
+                         if s != part[ node ] )
+
+        def delta( add, remove ):
+            "Weight of add minus the weight of remove"
+            d = dict( add )
+            for r, w in remove.iteritems():
+                d[ r ] = d.get( r, 0 ) - w
+            return d
+
+        def shift( node, server ):
+            for r, w in weight[ node ].iteritems():
+                load[ part[ node ] ][ r ] -= w
+                load[ server ][ r ] = load[ server ].get( r, 0 ) + w
+            part[ node ] = server
+
+        for _ in range( rounds ):
+            gains = dict( ( n, ext( n ) ) for n in part )
+            best, move = 0, None
+            for node in sorted( part ):
+                for server, g in gains[ node ].iteritems():
+                    if g > best and self.fits( load[ server ], weight[ node ],
+                                               limit[ server ] ):
+                        best, move = g, ( 'move', node, server )
+            members = dict( ( s, [] ) for s in self.servers )
+            for node in sorted( part ):
+                members[ part[ node ] ].append( node )
+            for p in self.servers:
+                for q in self.servers:
+                    if p >= q:
+                        continue
+                    # Only the most promising switches of each side
+                    topP = sorted( members[ p ],
+                                   key=lambda n: -gains[ n ][ q ] )[ :candidates ]
+                    topQ = sorted( members[ q ],
+                                   key=lambda n: -gains[ n ][ p ] )[ :candidates ]
+                    for a in topP:
+                        for b in topQ:
+                            g = ( gains[ a ][ q ] + gains[ b ][ p ] -
+                                  2 * adj[ a ].get( b, 0 ) )
+                            if ( g > best and
+                                 self.fits( load[ p ],
+                                            delta( weight[ b ], weight[ a ] ),
+                                            limit[ p ] ) and
+                                 self.fits( load[ q ],
+                                            delta( weight[ a ], weight[ b ] ),
+                                            limit[ q ] ) ):
+                                best, move = g, ( 'swap', a, b )
+            if not move:
+                break
+            kind, a, b = move
+            if kind == 'swap':
+                pa, pb = part[ a ], part[ b ]
+                shift( a, pb )
+                shift( b, pa )
+            else:
+                shift( a, b )
+        return part
+
+    def calculatePlacement( self ):
+        "Pre-calculate node placement"
+        adj, switchFor = self.switchGraph()
+        self.weighLinks( adj, switchFor )
+        weight = self.weights( switchFor )
+        share, limit = self.targets( weight )
+        placement, load = self.grow( adj, weight, share, limit )
+        placement = self.refine( adj, weight, placement, load, limit )
+        cut = [ ( a, b ) for a in adj for b in adj[ a ]
+                if a < b and placement[ a ] != placement[ b ] ]
+        info( '*** PartitionPlacer: %d switch links between servers, '
+              'cut weight %.1f\n' % ( len( cut ),
+                                      sum( adj[ a ][ b ] for a, b in cut ) ) )
+        if self.absolute:
+            self.checkLoad( load )
+        # Co-locate hosts with their switches
+        for h in self.hosts:
+            if h not in switchFor:
+                raise Exception(
+                    "PartitionPlacer: cannot place isolated host " + h )
+            placement[ h ] = placement[ switchFor[ h ] ]
+        return placement
+
+    def checkLoad( self, load ):
+        """Warn about servers loaded past the utilization target of their
+           capacity. Resources the whole cluster has too little of are
+           left to placement.check_capacity() to warn about."""
+        fitting = [ r for r in sorted( self.capacities.values()[ 0 ] )
+                    if all( r in c for c in self.capacities.values() ) and
+                    sum( l.get( r, 0 ) for l in load.values() ) <=
+                    sum( c[ r ] for c in self.capacities.values() ) *
+                    self.utilization + 1e-9 ]
+        for server in self.servers:
+            cap = self.capacities.get( server, {} )
+            over = [ r for r in fitting
+                     if load[ server ].get( r, 0 ) >
+                     cap.get( r, 0 ) * self.utilization + 1e-9 ]
+            if over:
+                warn( '*** PartitionPlacer: %s is loaded past %d%% of its '
+                      'capacity: %s\n' % ( server, self.utilization * 100,
+                      ', '.join( '%s %.2f/%.2f' % ( r, load[ server ][ r ],
+                                                    cap.get( r, 0 ) )
+                                 for r in over ) ) )
+
+    def place( self, node ):
+        """Partition placement: switches by the partition, and hosts
+           with their switches"""
+        return self.placement.get( node, self.servers[ 0 ] )
+
+
+def makePlacer( placement, servers, topo, hostsConfig=None,
+                switchesConfig=None, **extra ):
+    """Instantiate a placement algorithm for a topology
+       placement: Placer() subclass
+       servers: list of servers
+       topo: Topo() to place
+       hostsConfig, switchesConfig: manifest node configs
+       (only used by UserdefinedPlacer)
+       extra: parameters for the placement algorithm"""
+    params = dict( servers=servers,
+                   nodes=topo.nodes(),
+                   hosts=topo.hosts(),
+                   switches=topo.switches(),
+                   links=topo.links() )
+    if placement == UserdefinedPlacer:
+        params.update( hostsConfig=hostsConfig,
+                       switchesConfig=switchesConfig )
+    params.update( extra )
+    return placement( **params )
+
+
+class SSHPool( object ):
+    """Long-lived multiplexed ssh master connections, one per server.
+       Nodes given a master's control path run their ssh commands over it
+       instead of opening a connection of their own each time."""
+
+    # Seconds to wait for a master connection to come up
+    timeout = 30
+
+    def __init__( self, user, serverIP, cdir, sshcmd ):
+        """user: user for server ssh
+           serverIP: dict of server -> IP address
+           cdir: directory for control sockets
+           sshcmd: base ssh command"""
+        self.user = user
+        self.serverIP = serverIP
+        self.cdir = cdir
+        self.sshcmd = sshcmd
+        self.masters = {}
+        self.handshake = {}
+        self.commands = {}
+        self.lock = Lock()
+
+    def dest( self, server ):
+        "user@IP for a server"
+        return '%s@%s' % ( self.user, self.serverIP[ server ] )
+
+    def controlPath( self, server ):
+        "Control socket of a server's master connection, or None"
+        if server not in self.masters:
+            return None
+        return os.path.join( self.cdir, self.dest( server ) )
+
+    def _check( self, server ):
+        "Is a server's master connection accepting sessions?"
+        cmd = ( [ 'sudo', '-E', '-u', self.user ] + self.sshcmd +
+                [ '-o', 'ControlPath=' + os.path.join( self.cdir,
+                                                       self.dest( server ) ),
+                  '-O', 'check', self.dest( server ) ] )
+        _out, _err, code = errRun( cmd )
+        return code == 0
+
+    def start( self, servers ):
+        """Open master connections to servers, all in parallel
+           returns: list of servers whose master failed"""
+        servers = [ s for s in servers if s and s != 'localhost' ]
+        start = time()
+        for server in servers:
+            cpath = os.path.join( self.cdir, self.dest( server ) )
+            cmd = ( [ 'sudo', '-E', '-u', self.user ] + self.sshcmd +
+                    [ '-M', '-N', '-o', 'ControlPath=' + cpath,
+                      '-o', 'ControlPersist=no',
+                      '-o', 'ServerAliveInterval=30', self.dest( server ) ] )
+            debug( ' '.join( cmd ), '\n' )
+            self.masters[ server ] = Popen( cmd, stdin=PIPE, close_fds=True )
+            self.commands.setdefault( server, 0 )
+        pending, failed = set( servers ), []
+        while pending and time() - start < self.timeout:
+            for server in list( pending ):
+                if self.masters[ server ].poll() is not None:
+                    failed.append( server )
+                elif not self._check( server ):
+                    continue
+                else:
+                    self.handshake[ server ] = time() - start
+                    info( '%s (%.2fs) ' % ( server, self.handshake[ server ] ) )
+                pending.remove( server )
+            if pending:
+                sleep( .05 )
+        failed += pending
+        for server in failed:
+            error( '\n*** ssh master connection to %s failed\n' % server )
+            self.stop( [ server ] )
+        return failed
+
+    def count( self, server ):
+        "Count a command run on a server"
+        with self.lock:
+            self.commands[ server ] = self.commands.get( server, 0 ) + 1
+
+    def stats( self ):
+        """returns: dict of server -> { commands, handshake, saved }: the
+           commands run, the time a master connection took to come up,
+           and the handshake time saved by sharing it"""
+        return dict( ( server, dict( commands=self.commands.get( server, 0 ),
+                                     handshake=self.handshake[ server ],
+                                     saved=self.commands.get( server, 0 ) *
+                                     self.handshake[ server ] ) )
+                     for server in self.handshake )
+
+    def stop( self, servers=None ):
+        "Close master connections"
+        servers = list( servers if servers is not None else self.masters )
+        for server in servers:
+            master = self.masters.pop( server, None )
+            self.handshake.pop( server, None )
+            if master and master.poll() is None:
+                master.terminate()
+                master.wait()
+
+
+def parseCpus( cpus ):
+    "Parse a cpuset list ( '0-2,5' ) into a list of core ids"
+    result = []
+    for part in cpus.strip().split( ',' ):
+        if '-' in part:
+            first, last = part.split( '-' )
+            result += range( int( first ), int( last ) + 1 )
+        elif part:
+            result.append( int( part ) )
+    return result
+
+
+class CoreAllocator( object ):
+    """Split the cores of a server between its switches and hosts.
+       The first reserved cores are left to the system (sshd, tunnels,
+       agents), every switch gets cores of its own in name order, and the
+       hosts share what remains, at least hostCores of it. When there are
+       not enough cores for that, the switches share theirs round robin."""
+
+    def __init__( self, reserved=1, switchCores=1, hostCores=1 ):
+        """reserved: cores left to the system
+           switchCores: cores of a switch, unless it asks for others
+           hostCores: cores always left to the hosts"""
+        self.reserved = reserved
+        self.switchCores = switchCores
+        self.hostCores = hostCores
+
+    def allocate( self, cpus, switches ):
+        """cpus: core ids of the server
+           switches: list of ( switch name, cores or None for default )
+           returns: { reserved, hosts, switches: { name: cores }, shared },
+                    or None if the server is too small to pin anything"""
+        cpus = sorted( cpus )
+        reserved = cpus[ :self.reserved ]
+        pool = cpus[ self.reserved : len( cpus ) - self.hostCores ]
+        if not pool or not switches:
+            return None
+        hosts = cpus[ len( reserved ) + len( pool ): ]
+        wanted = [ ( name, min( cores or self.switchCores, len( pool ) ) )
+                   for name, cores in sorted( switches ) ]
+        shared = sum( cores for _name, cores in wanted ) > len( pool )
+        if not shared:
+            # Unused switch cores go to the hosts
+            used = sum( cores for _name, cores in wanted )
+            hosts = pool[ used: ] + hosts
+        assigned, i = {}, 0
+        for name, cores in wanted:
+            assigned[ name ] = [ pool[ ( i + j ) % len( pool ) ]
+                                 for j in range( cores ) ]
+            i += cores
+        return dict( reserved=reserved, hosts=hosts, switches=assigned,
+                     shared=shared )
+
+
+def coreMapReport( coreMap ):
+    "Return a printable report of the cores of each server's nodes"
+    lines = [ '*** Core allocation' ]
+    for server in sorted( coreMap ):
+        m = coreMap[ server ]
+        lines.append( '  %s: %d cores, reserved %s, hosts %s%s' % (
+            server, len( m[ 'cpus' ] ), cpu_list( m[ 'reserved' ] ) or '-',
+            cpu_list( m[ 'hosts' ] ) or '-',
+            ', switches share cores' if m[ 'shared' ] else '' ) )
+        for name in sorted( m[ 'switches' ] ):
+            sw = m[ 'switches' ][ name ]
+            lines.append( '    %-16s %-10s%s' % (
+                name, cpu_list( sw[ 'cores' ] ),
+                ' nice %d' % sw[ 'nice' ] if sw[ 'nice' ] is not None
+                else '' ) )
+    return '\n'.join( lines )
+
+
 # The MininetCluster class is not strictly necessary.
 # However, it has several purposes:
 # 1. To set up ssh connection sharing/multiplexing
@@ -750,6 +1583,9 @@ class MininetCluster( Mininet ):
     # ForwardAgent yes: forward authentication credentials
     sshcmd = [ 'ssh', '-o', 'BatchMode=yes', '-o', 'ForwardAgent=yes' ]
 
+    # Seconds each server is given to pass the precheck
+    checkTimeout = 30
+
     def __init__( self, *args, **kwargs ):
         """servers: a list of servers to use (note: include
            localhost or None to use local system as well)
@@ -768,15 +1604,36 @@ class MininetCluster( Mininet ):
             self.serverIP = { server: RemoteMixin.findServerIP( server )
                               for server in self.servers }
         self.user = params.pop( 'user', findUser() )
+        # Make sure control directory exists, and belongs to the user
+        # our ssh connections run as
+        self.cdir = os.environ[ 'HOME' ] + '/.ssh/mn'
+        errRun( [ 'sudo', '-E', '-u', self.user, 'mkdir', '-p', self.cdir ] )
+        self.pool = SSHPool( self.user, self.serverIP, self.cdir, self.sshcmd )
+        self.connections = {}
         if params.pop( 'precheck' ):
             self.precheck()
-        self.connections = {}
+        else:
+            self.startConnections()
+        self.agents = {}
+        if params.pop( 'agent', False ):
+            self.startAgents()
         self.placement = params.pop( 'placement', SwitchBinPlacer )
         self.hostsConfig = params.pop( 'hostsConfig', None )
         self.switchesConfig = params.pop( 'switchesConfig', None )
-        # Make sure control directory exists
-        self.cdir = os.environ[ 'HOME' ] + '/.ssh/mn'
-        errRun( [ 'mkdir', '-p', self.cdir ] )
+        self.placementParams = params.pop( 'placementParams', {} )
+        # Core pinning: True, or a dict of CoreAllocator parameters
+        # ( reserved, switch_cores, host_cores ) and a default 'nice'
+        # for switches; switchesConfig may set a switch's 'cores' and
+        # 'nice'
+        self.pinning = params.pop( 'pinning', None )
+        self.coreMap = {}
+        # Tunnels set up at once between any two servers; each one costs
+        # an unauthenticated ssh connection, which sshd's MaxStartups
+        # limits (10 by default)
+        self.tunnelsPerPair = params.pop( 'tunnelsPerPair', 4 )
+        # Cross-server link type, see RemoteLink.tunnelTypes
+        self.tunnelType = params.pop( 'tunnel', 'ssh' )
+        self.pendingLinks = None
         Mininet.__init__( self, *args, **params )
 
     def popen( self, cmd ):
@@ -787,6 +1644,63 @@ class MininetCluster( Mininet ):
         signal( SIGINT, old )
         return conn
 
+    def addLink( self, node1, node2, *args, **params ):
+        """Override: while building from a topology, links between
+           servers are deferred to addTunnels(); their parameters are
+           updated from the link's cross_server parameters, if any"""
+        node1 = node1 if not isinstance( node1, basestring ) else self[ node1 ]
+        node2 = node2 if not isinstance( node2, basestring ) else self[ node2 ]
+        cross = params.pop( 'cross_server', None )
+        if cross and ( getattr( node1, 'server', 'localhost' ) !=
+                       getattr( node2, 'server', 'localhost' ) ):
+            params.update( cross )
+        if issubclass( params.get( 'cls' ) or self.link, RemoteLink ):
+            params.setdefault( 'tunnel', self.tunnelType )
+        if ( self.pendingLinks is not None and
+             getattr( node1, 'server', 'localhost' ) !=
+             getattr( node2, 'server', 'localhost' ) ):
+            self.pendingLinks.append( ( node1, node2, args, params ) )
+            return None
+        return Mininet.addLink( self, node1, node2, *args, **params )
+
+    def addTunnels( self, links ):
+        """Add links between servers in parallel, setting up at most
+           tunnelsPerPair tunnels at once between any two servers
+           links: list of ( node1, node2, args, params ) for addLink()"""
+        queues = {}
+        for link in reversed( links ):
+            pair = tuple( sorted( ( link[ 0 ].server, link[ 1 ].server ) ) )
+            queues.setdefault( pair, [] ).append( link )
+        errors = []
+
+        def worker( queue ):
+            "Add the links of a queue until it is empty"
+            while True:
+                try:
+                    node1, node2, args, params = queue.pop()
+                except IndexError:
+                    return
+                try:
+                    Mininet.addLink( self, node1, node2, *args, **params )
+                    info( '(%s, %s) ' % ( node1, node2 ) )
+                except Exception as e:  # pylint: disable=broad-except
+                    errors.append( ( node1, node2, e ) )
+
+        threads = [ Thread( target=worker, args=( queue, ) )
+                    for queue in queues.values()
+                    for _ in range( min( self.tunnelsPerPair,
+                                         len( queue ) ) ) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            for node1, node2, e in errors:
+                error( '*** Error adding link %s-%s: %s\n' %
+                       ( node1, node2, e ) )
+            raise Exception( 'addTunnels: %d of %d links failed' %
+                             ( len( errors ), len( links ) ) )
+
     def baddLink( self, *args, **kwargs ):
         "break addlink for testing"
         pass
@@ -794,23 +1708,35 @@ class MininetCluster( Mininet ):
     def precheck( self ):
         """Pre-check to make sure connection works and that
            we can call sudo without a password"""
-        result = 0
+        result = 1 if self.startConnections() else 0
         info( '*** Checking servers\n' )
+        checks = {}
         for server in self.servers:
             ip = self.serverIP[ server ]
             if not server or server == 'localhost':
                 continue
             info( server, '' )
             dest = '%s@%s' % ( self.user, ip )
-            cmd = [ 'sudo', '-E', '-u', self.user ]
-            cmd += self.sshcmd + [ '-n', dest, 'sudo true' ]
+            cmd = [ 'sudo', '-E', '-u', self.user ] + self.sshcmd
+            if self.pool.controlPath( server ):
+                cmd += [ '-o', 'ControlPath=' + self.pool.controlPath( server ) ]
+            cmd += [ '-n', dest, 'sudo -n true' ]
             debug( ' '.join( cmd ), '\n' )
-            _out, _err, code = errRun( cmd )
-            if code != 0:
+            checks[ server ] = cmd
+        # All servers are checked at once
+        results = runParallel( checks, self.checkTimeout )
+        for server in sorted( results ):
+            code, _output = results[ server ]
+            if code is None:
+                error( '\nstartConnection: server connection check to %s '
+                       'timed out after %ds using command:\n%s\n'
+                       % ( server, self.checkTimeout,
+                           ' '.join( checks[ server ] ) ) )
+            elif code != 0:
                 error( '\nstartConnection: server connection check failed '
                        'to %s using command:\n%s\n'
-                        % ( server, ' '.join( cmd ) ) )
-            result |= code
+                        % ( server, ' '.join( checks[ server ] ) ) )
+            result |= 1 if code != 0 else 0
         if result:
             error( '*** Server precheck failed.\n'
                    '*** Make sure that the above ssh command works'
@@ -820,6 +1746,52 @@ class MininetCluster( Mininet ):
             sys.exit( 1 )
         info( '\n' )
 
+    def startConnections( self ):
+        """Open a shared ssh master connection to every server
+           returns: list of servers that could not be connected to"""
+        info( '*** Opening ssh connections\n' )
+        failed = self.pool.start( self.servers )
+        info( '\n' )
+        for server in self.servers:
+            cfile = self.pool.controlPath( server )
+            if cfile:
+                self.connections[ ( None, server ) ] = (
+                    self.pool.dest( server ), cfile,
+                    self.pool.masters[ server ] )
+        return failed
+
+    def startAgents( self ):
+        "Start a command agent on every server, for nodes to use"
+        info( '*** Starting agents\n' )
+        for server in self.servers:
+            sshcmd = None
+            if server != 'localhost':
+                sshcmd = [ 'sudo', '-E', '-u', self.user ] + self.sshcmd
+                if self.pool.controlPath( server ):
+                    sshcmd += [ '-o', 'ControlPath=' +
+                                self.pool.controlPath( server ) ]
+                sshcmd += [ self.pool.dest( server ) ]
+            self.agents[ server ] = Agent( server, sshcmd )
+            info( server, '' )
+        info( '\n' )
+
+    def stop( self ):
+        "Stop network, then close our agents and ssh connections"
+        Mininet.stop( self )
+        # Everything the network created is gone
+        ClusterCleanup.forget()
+        for server in sorted( self.agents ):
+            agent = self.agents[ server ]
+            info( '*** %s agent: %d commands in %d batches\n' %
+                  ( server, agent.commands, agent.batches ) )
+            agent.stop()
+        stats = self.pool.stats()
+        for server in sorted( stats ):
+            info( '*** %s: %d ssh commands, %.2fs of handshakes saved\n' %
+                  ( server, stats[ server ][ 'commands' ],
+                    stats[ server ][ 'saved' ] ) )
+        self.pool.stop()
+
     def modifiedaddHost( self, *args, **kwargs ):
         "Slightly modify addHost"
         assert self  # please pylint
@@ -833,20 +1805,10 @@ class MininetCluster( Mininet ):
             # No shirt, no shoes, no service
             return
         nodes = self.topo.nodes()
-        if self.placement == UserdefinedPlacer:
-            placer = self.placement( servers=self.servers,
-                                     nodes=self.topo.nodes(),
-                                     hosts=self.topo.hosts(),
-                                     switches=self.topo.switches(),
-                                     links=self.topo.links(),
-                                     hostsConfig=self.hostsConfig,
-                                     switchesConfig=self.switchesConfig )
-        else:
-            placer = self.placement( servers=self.servers,
-                                 nodes=self.topo.nodes(),
-                                 hosts=self.topo.hosts(),
-                                 switches=self.topo.switches(),
-                                 links=self.topo.links() )
+        placer = makePlacer( self.placement, self.servers, self.topo,
+                             hostsConfig=self.hostsConfig,
+                             switchesConfig=self.switchesConfig,
+                             **self.placementParams )
         for node in nodes:
             config = self.topo.nodeInfo( node )
             # keep local server name consistent accross nodes
@@ -861,6 +1823,9 @@ class MininetCluster( Mininet ):
                         key, ( None, None, None ) )
             if cfile:
                 config.setdefault( 'controlPath', cfile )
+            config.setdefault( 'pool', self.pool )
+            if server in self.agents:
+                config.setdefault( 'agent', self.agents[ server ] )
 
     def addController( self, *args, **kwargs ):
         "Patch to update IP address to global IP address"
@@ -877,7 +1842,85 @@ class MininetCluster( Mininet ):
         info( '*** Placing nodes\n' )
         self.placeNodes()
         info( '\n' )
-        Mininet.buildFromTopo( self, *args, **kwargs )
+        self.pendingLinks = []
+        try:
+            Mininet.buildFromTopo( self, *args, **kwargs )
+            links = self.pendingLinks
+        finally:
+            self.pendingLinks = None
+        if links:
+            info( '*** Adding %d links between servers\n' % len( links ) )
+            with timeline.timed( 'tunnels' ):
+                self.addTunnels( links )
+            info( '\n' )
+
+    def pinCores( self ):
+        """Pin the switches of each server to cores of their own and
+           confine its hosts to the rest, before the switches start
+           returns: core map, server -> { cpus, reserved, hosts,
+                    switches: { name: { cores, nice } }, shared }"""
+        conf = self.pinning if isinstance( self.pinning, dict ) else {}
+        allocator = CoreAllocator( reserved=conf.get( 'reserved', 1 ),
+                                   switchCores=conf.get( 'switch_cores', 1 ),
+                                   hostCores=conf.get( 'host_cores', 1 ) )
+        switchesConfig = self.switchesConfig or {}
+        hosts, switches = {}, {}
+        for host in self.hosts:
+            hosts.setdefault( host.server, [] ).append( host )
+        for switch in self.switches:
+            if isinstance( switch, P4Switch ):
+                switches.setdefault( switch.server, [] ).append( switch )
+        # The cores each server lets us use, from the affinity of its init
+        servers = sorted( switches )
+        outputs = rcmdAll( [ ( switches[ server ][ 0 ],
+                               [ 'taskset', '-c', '-p', '1' ] )
+                             for server in servers ] )
+        coreMap, pins = {}, []
+        for server, output in zip( servers, outputs ):
+            cpus = parseCpus( output.strip().split( ':' )[ -1 ] )
+            m = allocator.allocate( cpus, [
+                ( sw.name, switchesConfig.get( sw.name, {} ).get( 'cores' ) )
+                for sw in switches[ server ] ] )
+            if m is None:
+                warn( '*** %s: %d cores are too few to pin its nodes\n' %
+                      ( server, len( cpus ) ) )
+                continue
+            if m[ 'shared' ]:
+                warn( '*** %s: not enough cores for every switch to have '
+                      'its own; switches share cores\n' % server )
+            for sw in switches[ server ]:
+                sw.cpus = m[ 'switches' ][ sw.name ]
+                sw.nice = switchesConfig.get( sw.name, {} ).get(
+                    'nice', conf.get( 'nice' ) )
+                m[ 'switches' ][ sw.name ] = dict( cores=sw.cpus,
+                                                   nice=sw.nice )
+            # Host shells are moved now; what they run inherits their
+            # cores, and popen() runs under taskset
+            for host in hosts.get( server, [] ) if m[ 'hosts' ] else []:
+                host.cpus = m[ 'hosts' ]
+                pins.append( ( host, [ 'taskset', '-a', '-p', '-c',
+                                       cpu_list( host.cpus ),
+                                       str( host.pid ) ] ) )
+            m[ 'cpus' ] = cpus
+            coreMap[ server ] = m
+        rcmdAll( pins )
+        return coreMap
+
+    def build( self ):
+        "Build the network, recording what it creates for cleanup"
+        try:
+            Mininet.build( self )
+            if self.pinning:
+                self.coreMap = self.pinCores()
+                info( coreMapReport( self.coreMap ) + '\n' )
+        finally:
+            # Whatever was created before any error is still tracked
+            ClusterCleanup.track(
+                nodes=[ n.name for n in self.hosts + self.switches ],
+                thriftPorts=[ s.thrift_port for s in self.switches
+                              if getattr( s, 'thrift_port', None ) ],
+                deviceIds=[ s.device_id for s in self.switches
+                            if hasattr( s, 'device_id' ) ] )
 
 
 def testNsTunnels():
@@ -890,6 +1933,41 @@ def testNsTunnels():
     net.pingAll()
     net.stop()
 
+def testKernelTunnels( kind='vxlan' ):
+    """Test kernel tunnels on a single machine, with network namespaces
+       standing in for two servers and for a node on each of them"""
+    servers = { 'mnsrv1': '10.99.0.1', 'mnsrv2': '10.99.0.2' }
+    nodes = { 'mnsrv1': ( 'mnnode1', '10.98.0.1' ),
+              'mnsrv2': ( 'mnnode2', '10.98.0.2' ) }
+    def run( ns, cmd ):
+        "Run cmd in namespace ns"
+        return quietRun( 'ip netns exec %s %s' % ( ns, cmd ) )
+    for ns in servers.keys() + [ n for n, _ip in nodes.values() ]:
+        quietRun( 'ip netns add %s' % ns )
+    # Underlay between the servers, with room for the tunnel headers
+    mtu = RemoteLink.nodeMtu + RemoteLink.tunnelOverhead[ kind ]
+    quietRun( 'ip link add mnu1 netns mnsrv1 type veth '
+              'peer name mnu2 netns mnsrv2' )
+    for server, intf in ( ( 'mnsrv1', 'mnu1' ), ( 'mnsrv2', 'mnu2' ) ):
+        run( server, 'ip addr add %s/24 dev %s' % ( servers[ server ], intf ) )
+        run( server, 'ip link set %s mtu %d up' % ( intf, mtu ) )
+    # Tunnel ends, created in each server's namespace and moved into
+    # its node's namespace the way RemoteLink.moveIntf does it
+    for server, other in ( ( 'mnsrv1', 'mnsrv2' ), ( 'mnsrv2', 'mnsrv1' ) ):
+        node, ip = nodes[ server ]
+        print run( server, RemoteLink.kernelTunnelCmd(
+            kind, 'tap9', 9, servers[ server ], servers[ other ] ) ),
+        run( server, 'ip link set tap9 netns %s' % node )
+        run( node, 'ip link set tap9 name %s-eth0' % node )
+        run( node, 'ip addr add %s/24 dev %s-eth0' % ( ip, node ) )
+        run( node, 'ip link set %s-eth0 up' % node )
+    print run( 'mnnode1', 'ping -c 3 %s' % nodes[ 'mnsrv2' ][ 1 ] )
+    # Full-size packets, which must not be fragmented
+    print run( 'mnnode1', 'ping -c 3 -M do -s %d %s' % (
+        RemoteLink.nodeMtu - 28, nodes[ 'mnsrv2' ][ 1 ] ) )
+    for ns in servers.keys() + [ n for n, _ip in nodes.values() ]:
+        quietRun( 'ip netns del %s' % ns )
+
 # Manual topology creation with net.add*()
 #
 # This shows how node options may be used to manage
@@ -1016,4 +2094,5 @@ if __name__ == '__main__':
     # testRemoteNet()
     # testMininetCluster()
     # testRemoteSwitches()
+    # testKernelTunnels()
     signalTest()
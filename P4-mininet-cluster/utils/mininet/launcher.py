@@ -0,0 +1,102 @@
+"""
+launcher.py: synchronized start of host workload commands
+
+Starting the workload of each host in turn spreads the start times over
+seconds on a cluster, since every remote popen() has to open its own ssh
+session. Here every command is dispatched at once, wrapped so that it
+sleeps on its host until a shared absolute start time. Each wrapped
+command writes the time at which it actually started to a stamp file on
+its host, from which the start skew of every host is reported once the
+workload is done.
+
+Start times are taken from each server's own clock, so the reported skew
+includes any clock offset between servers.
+"""
+
+import os
+from pipes import quote
+from time import time
+
+from mininet.log import info
+
+import timeline
+
+STAMP_FILE = '/tmp/p4app-start-%s'
+
+_waitCmd = ( "python -c 'import time; "
+             "time.sleep( max( 0, %f - time.time() ) )'" )
+
+
+def syncCmd( cmd, startAt, stampFile ):
+    """Wrap a shell command so that it starts at an absolute time
+       cmd: shell command
+       startAt: start time, in seconds since the epoch
+       stampFile: file the actual start time is written to
+       returns: shell command"""
+    return '%s; date +%%s.%%N > %s; %s' % ( _waitCmd % startAt,
+                                            stampFile, cmd )
+
+
+def launch( entries, delay=2.0 ):
+    """Start the commands of several hosts together
+       entries: list of ( host, cmd, offset, popen params ), where offset
+                is the start time of cmd relative to the shared start
+       delay: seconds from now to the shared start, enough for every
+              command to be dispatched and reach its host
+       returns: list of ( Popen, host name, scheduled start time )"""
+    startAt = time() + delay
+    launched = []
+    for host, cmd, offset, params in entries:
+        scheduled = startAt + offset
+        wrapped = syncCmd( cmd, scheduled, STAMP_FILE % host.name )
+        # Remote commands go through ssh, which joins its arguments
+        # before the server's shell parses them again
+        if getattr( host, 'isRemote', False ):
+            wrapped = quote( wrapped )
+        shell = os.environ.get( 'SHELL', 'sh' )
+        p = host.popen( [ shell, '-c', wrapped ], **params )
+        launched.append( ( p, host.name, scheduled ) )
+    info( '*** Dispatched %d commands in %.3fs, starting at %.3f\n' %
+          ( len( entries ), time() - startAt + delay, startAt ) )
+    return launched
+
+
+def startSkew( net, launched ):
+    """Collect the actual start time of launched commands
+       net: Mininet network
+       launched: list returned by launch()
+       returns: dict of host name -> seconds started after the
+                scheduled time, None when the command never started"""
+    hosts = []
+    for _p, name, _scheduled in launched:
+        host = net.get( name )
+        host.sendCmd( 'cat %s 2>/dev/null; rm -f %s' %
+                      ( STAMP_FILE % name, STAMP_FILE % name ) )
+        hosts.append( host )
+    skew = {}
+    for host, ( _p, name, scheduled ) in zip( hosts, launched ):
+        output = host.waitOutput().strip()
+        try:
+            started = float( output.split()[ -1 ] )
+        except ( IndexError, ValueError ):
+            skew[ name ] = None
+            continue
+        skew[ name ] = started - scheduled
+        timeline.record( '%s workload start' % name, scheduled, started,
+                         kind='node', skew=skew[ name ] )
+    return skew
+
+
+def skewReport( skew ):
+    "Return a printable report of the start skew of each host"
+    lines = [ '*** Workload start skew' ]
+    for name in sorted( skew ):
+        if skew[ name ] is None:
+            lines.append( '  %-16s %10s' % ( name, 'not started' ) )
+        else:
+            lines.append( '  %-16s %+9.2fms' % ( name, skew[ name ] * 1000 ) )
+    started = [ s for s in skew.values() if s is not None ]
+    if started:
+        lines.append( '  %-16s %10.2fms' %
+                      ( 'spread', ( max( started ) - min( started ) ) * 1000 ) )
+    return '\n'.join( lines )
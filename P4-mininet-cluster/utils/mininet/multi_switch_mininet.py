@@ -23,7 +23,7 @@ import argparse
 import json
 import importlib
 import re
-from time import sleep
+from time import sleep, time
 
 from mininet.net import Mininet
 from mininet.topo import Topo
@@ -31,9 +31,15 @@ from mininet.link import TCLink
 from mininet.log import setLogLevel, info
 from mininet.cli import CLI
 
-from cluster import RemoteP4Switch, RemoteP4Host
+from cluster import RemoteP4Switch, RemoteP4Host, ClusterCleanup, CLEANUP_STATE
 import apptopo
 import appcontroller
+from addressing import write_table
+from bootstrap import runBootstrap
+import launcher
+from placement import placer_config
+from supervisor import Supervisor, statusReport, writeStatus
+import timeline
 from p4_mininet import P4Host
 
 from cluster import MininetCluster, UserdefinedPlacer, SwitchBinPlacer, RemoteLink, RoundRobinPlacer
@@ -69,6 +75,24 @@ def run_command(command):
     return os.WEXITSTATUS(os.system(command))
 
 
+def trial_config(conf, trial):
+    """Target configuration for one trial of a keep-warm run. The trial's
+    parameters, hosts and switches settings are merged into the target's;
+    its timeout, start_delay and after settings replace the target's.
+    Anything that shapes the network itself (links, latencies, servers)
+    is fixed for all trials."""
+    trial_conf = dict(conf)
+    trial_conf['parameters'] = dict(conf.get('parameters', {}))
+    trial_conf['parameters'].update(trial.get('parameters', {}))
+    for key in ['hosts', 'switches']:
+        trial_conf[key] = dict(conf.get(key, {}))
+        for name, settings in trial.get(key, {}).iteritems():
+            trial_conf[key][name] = dict(trial_conf[key].get(name, {}))
+            trial_conf[key][name].update(settings)
+    for key in ['timeout', 'start_delay', 'after']:
+        if key in trial: trial_conf[key] = trial[key]
+    return trial_conf
+
 def main():
 
     with open(args.manifest, 'r') as f:
@@ -102,11 +126,16 @@ def main():
         if os.path.exists(args.log_dir): raise Exception('Log dir exists and is not a dir')
         os.mkdir(args.log_dir)
     os.environ['P4APP_LOGDIR'] = args.log_dir
+    if 'P4APP_TIMELINE' in os.environ:
+        timeline.load(os.environ['P4APP_TIMELINE'])
 
 
-    links = [l[:2] for l in conf['links']]
-    latencies = dict([(''.join(sorted(l[:2])), l[2]) for l in conf['links'] if len(l)>=3])
-    losses = dict([(''.join(sorted(l[:2])), int(l[3])) for l in conf['links'] if len(l)>=4])
+    # Links are [a, b, latency, loss], optionally ending with a dict of
+    # link settings (see apptopo.LINK_DEFAULTS)
+    link_fields = [[x for x in l if not isinstance(x, dict)] for l in conf['links']]
+    links = [l[:2] for l in link_fields]
+    latencies = dict([(''.join(sorted(l[:2])), l[2]) for l in link_fields if len(l)>=3])
+    losses = dict([(''.join(sorted(l[:2])), int(l[3])) for l in link_fields if len(l)>=4])
 
     for host_name in sorted(conf['hosts'].keys()):
         host = conf['hosts'][host_name]
@@ -128,36 +157,59 @@ def main():
 
     switch_info = dict(zip(args.switches, args.json))
     topo = AppTopo(links, switch_info, args, bmv2_log, pcap_dump, latencies, losses, manifest, target=args.target, log_dir=args.log_dir, NUM_END_HOSTS=NUM_END_HOSTS)
+    # Address lookup table for the controller, converters and capture tools
+    if hasattr(topo, 'address_plan'):
+        write_table(topo, os.path.join(args.log_dir, 'addresses.json'))
     print [x.encode('ascii') for x in conf['servers']]
     servers = [x.encode('ascii') for x in conf['servers']]
+    placer, placer_params = placer_config(conf, topo, os.path.dirname(os.path.abspath(args.manifest)))
+    # What the network creates is recorded there for clean.py, until it is stopped
+    ClusterCleanup.stateFile = os.path.join(args.log_dir, CLEANUP_STATE)
     net = MininetCluster(topo = topo,
                   link = RemoteLink,
                   host = RemoteP4Host,
                   controller = None,
                   servers = servers,
-                  placement = UserdefinedPlacer,
+                  placement = placer,
+                  placementParams = placer_params,
                   hostsConfig = conf['hosts'],
-                  switchesConfig = conf['switches'])
+                  switchesConfig = conf['switches'],
+                  tunnel = conf.get('tunnel', 'ssh'),
+                  agent = conf.get('agent', False),
+                  pinning = conf.get('cpu_pinning'))
 #    net = Mininet(topo = topo,
 #                  link = TCLink,
 #                  host = P4Host,
 #                  controller = None)
-    net.start()
+    if net.coreMap:
+        with open(os.path.join(args.log_dir, 'core_map.json'), 'w') as f:
+            json.dump(net.coreMap, f, indent=2, sort_keys=True)
+
+    with timeline.timed('network start'):
+        net.start()
 
     sleep(1)
 
+    # Host configuration and 'before' commands are collected per host and
+    # run as one batch per host, with all hosts working concurrently
+    bootstrap = {}
+
     controller = None
     if args.auto_control_plane or 'controller_module' in conf:
         controller = AppController(manifest=manifest, target=args.target,
                                      topo=topo, net=net, links=links)
-        controller.start()
+        with timeline.timed('control plane'):
+            controller.start(bootstrap=bootstrap)
 
     if 'before' in conf and 'cmd' in conf['before']:
         cmds = conf['before']['cmd'] if type(conf['before']['cmd']) == list else [conf['before']['cmd']]
         for cmd in cmds:
             print cmd[0] + ' ' + cmd[1]
-            h = net.get(cmd[0])
-            h.cmd(cmd[1])
+            bootstrap.setdefault(cmd[0], []).append(cmd[1])
+
+    if bootstrap:
+        with timeline.timed('before commands'):
+            runBootstrap(net, bootstrap)
 
     for h in net.hosts:
         h.describe()
@@ -169,71 +221,112 @@ def main():
     if args.cli or ('cli' in conf and conf['cli']):
         CLI(net)
 
-    stdout_files = dict()
     return_codes = []
-    host_procs = []
-
 
     def formatCmd(cmd):
         for h in net.hosts:
             cmd = cmd.replace(h.name, h.defaultIntf().updateIP())
         return cmd
 
-    def _wait_for_exit(p, host):
-        print p.communicate()
-        if p.returncode is None:
-            p.wait()
-            print p.communicate()
-        return_codes.append(p.returncode)
-        if host_name in stdout_files:
-            stdout_files[host_name].flush()
-            stdout_files[host_name].close()
-
-    print '\n'.join(map(lambda (k,v): "%s: %s"%(k,v), params.iteritems())) + '\n'
-
-    for host_name in sorted(conf['hosts'].keys()):
-        host = conf['hosts'][host_name]
-        if 'cmd' not in host: continue
-
-        h = net.get(host_name)
-        stdout_filename = os.path.join(args.log_dir, h.name + '.stdout')
-        stdout_files[h.name] = open(stdout_filename, 'w')
-        cmd = formatCmd(host['cmd'])
-        print h.name, cmd
-        p = h.popen(cmd, stdout=stdout_files[h.name], shell=True, preexec_fn=os.setpgrp)
-        if 'startup_sleep' in host: sleep(host['startup_sleep'])
-
-        if 'wait' in host and host['wait']:
-            _wait_for_exit(p, host_name)
-        else:
-            host_procs.append((p, host_name))
-
-    for p, host_name in host_procs:
-        if 'wait' in conf['hosts'][host_name] and conf['hosts'][host_name]['wait']:
-            _wait_for_exit(p, host_name)
-
-
-    for p, host_name in host_procs:
-        if 'wait' in conf['hosts'][host_name] and conf['hosts'][host_name]['wait']:
-            continue
-        if p.returncode is None:
-            run_command('pkill -INT -P %d' % p.pid)
-            sleep(0.2)
-            rc = run_command('pkill -0 -P %d' % p.pid) # check if it's still running
-            if rc == 0: # the process group is still running, send TERM
-                sleep(1) # give it a little more time to exit gracefully
-                run_command('pkill -TERM -P %d' % p.pid)
-        _wait_for_exit(p, host_name)
-
-    if 'after' in conf and 'cmd' in conf['after']:
-        cmds = conf['after']['cmd'] if type(conf['after']['cmd']) == list else [conf['after']['cmd']]
-        for cmd in cmds:
-            os.system(cmd)
+    def run_workload(conf, log_dir, label='workload'):
+        stdout_files = dict()
+        params = conf['parameters'] if 'parameters' in conf else {}
+        os.environ.update(dict(map(lambda (k,v): (k, str(v)), params.iteritems())))
+        os.environ['P4APP_LOGDIR'] = log_dir
+
+        print '\n'.join(map(lambda (k,v): "%s: %s"%(k,v), params.iteritems())) + '\n'
+
+        workload_start = time()
+
+        # Every host process is supervised together: 'timeout' in a host's
+        # config limits its own run time, 'timeout' in the target the whole
+        # workload's
+        supervisor = Supervisor(deadline=workload_start + conf['timeout'] if 'timeout' in conf else None)
+
+        def _supervise(procs):
+            for p, name, scheduled in procs:
+                supervisor.add(name, p, timeout=conf['hosts'][name].get('timeout'), start=scheduled)
+
+        # All commands up to the next host that must be waited on start
+        # together at a shared time; startup_sleep delays the following hosts
+        # relative to it instead of holding up the dispatch.
+        start_delay = float(conf.get('start_delay', 2.0))
+        launched = []
+        group = []
+        offset = 0
+        for host_name in sorted(conf['hosts'].keys()):
+            host = conf['hosts'][host_name]
+            if 'cmd' not in host: continue
+
+            h = net.get(host_name)
+            stdout_filename = os.path.join(log_dir, h.name + '.stdout')
+            stdout_files[h.name] = open(stdout_filename, 'w')
+            cmd = formatCmd(host['cmd'])
+            print h.name, cmd
+            group.append((h, cmd, offset, dict(stdout=stdout_files[h.name], preexec_fn=os.setpgrp)))
+            if 'startup_sleep' in host: offset += host['startup_sleep']
+
+            if 'wait' in host and host['wait']:
+                procs = launcher.launch(group, start_delay)
+                launched += procs
+                _supervise(procs)
+                supervisor.wait([host_name])
+                group = []
+                offset = 0
+
+        if group:
+            procs = launcher.launch(group, start_delay)
+            launched += procs
+            _supervise(procs)
+
+        # Hosts that are not waited on run until the workload is done
+        supervisor.stop()
+        timeline.record(label, workload_start, time())
+        if launched:
+            print launcher.skewReport(launcher.startSkew(net, launched))
+        for f in stdout_files.values():
+            f.close()
+        results = supervisor.results()
+        print statusReport(results)
+        writeStatus(results, os.path.join(log_dir, 'host_status.json'))
+
+        if 'after' in conf and 'cmd' in conf['after']:
+            cmds = conf['after']['cmd'] if type(conf['after']['cmd']) == list else [conf['after']['cmd']]
+            for cmd in cmds:
+                os.system(cmd)
+
+        return [r['returncode'] for r in results.values()]
+
+    if 'trials' not in conf:
+        return_codes += run_workload(conf, args.log_dir)
+    else:
+        # Keep the network warm: every trial runs on the same network, with
+        # the switches' state reset and changed tables reloaded in between
+        for i, trial in enumerate(conf['trials']):
+            name = trial.get('name', 'trial%d' % i)
+            trial_dir = os.path.join(args.log_dir, name)
+            if not os.path.isdir(trial_dir): os.mkdir(trial_dir)
+            trial_conf = trial_config(conf, trial)
+            print "**********"
+            print "Trial %s" % name
+            if controller:
+                with timeline.timed('%s reset' % name):
+                    controller.prepare_trial(trial_conf, reset=i > 0)
+            elif i > 0:
+                print "No controller; switch state is not reset between trials"
+            return_codes += run_workload(trial_conf, trial_dir, label='%s workload' % name)
+
+    teardown_start = time()
 
     if controller: controller.stop()
 
     net.stop()
 
+    timeline.record('teardown', teardown_start, time())
+    print 'Timeline written to %s' % timeline.save(
+        os.path.join(args.log_dir, timeline.TIMELINE_FILE))
+    print timeline.summary()
+
 #    if bmv2_log:
 #        os.system('bash -c "cp /tmp/p4s.s*.log \'%s\'"' % args.log_dir)
 #    if pcap_dump:
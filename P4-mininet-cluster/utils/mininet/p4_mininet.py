@@ -18,11 +18,14 @@ from mininet.node import Switch, Host
 from mininet.log import setLogLevel, info, error, debug
 from mininet.moduledeps import pathCheck
 from sys import exit
-from time import sleep
+from time import time
+import errno
 import os
-import tempfile
+import select
 import socket
 
+import timeline
+
 class P4Host(Host):
     def config(self, **params):
         r = super(P4Host, self).config(**params)
@@ -50,6 +53,87 @@ class P4Host(Host):
             print "Default route to switch: %s (%s)" % (sw_addr, sw_mac)
         print "**********"
 
+def cpu_list(cpus):
+    """Core ids as a taskset/cpuset list, with runs of cores as ranges
+    ([0, 1, 2, 5] -> "0-2,5")"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges)
+
+def wait_thrift_ready(switches, timeout=60, initial_delay=0.05, max_delay=1.0,
+                      probe_timeout=0.5):
+    """Probe the Thrift ports of launched switches, all at once, until
+    they accept connections. Each switch is probed again after a delay
+    that doubles from initial_delay up to max_delay, for as long as its
+    process runs and the timeout allows.
+    returns: dict of switch -> seconds from launch to ready, or None for
+    the switches that exited or never became ready"""
+    now = time()
+    deadline = now + timeout
+    pending = dict((sw, dict(next=now, delay=initial_delay)) for sw in switches)
+    probes = {}  # fd -> (switch, socket, started)
+    poller = select.poll()
+    ready = {}
+
+    def retry(sw):
+        state = pending[sw]
+        state['next'] = time() + state['delay']
+        state['delay'] = min(state['delay'] * 2, max_delay)
+
+    def done(sw, t):
+        ready[sw] = t - sw.launched if t is not None else None
+        del pending[sw]
+
+    while pending:
+        now = time()
+        probing = set(sw for sw, _sock, _started in probes.values())
+        for sw in pending.keys():
+            if sw in probing or pending[sw]['next'] > now: continue
+            if not sw.is_running():
+                done(sw, None)
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex(sw.thrift_address())
+            if err == 0:
+                sock.close()
+                done(sw, now)
+            elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                probes[sock.fileno()] = (sw, sock, now)
+                poller.register(sock, select.POLLOUT)
+            else:
+                sock.close()
+                retry(sw)
+        if now >= deadline:
+            for sw in pending.keys(): done(sw, None)
+            break
+        if not pending: break
+        # Sleep until a probe completes or the next one is due
+        due = [state['next'] for sw, state in pending.iteritems() if sw not in probing]
+        due += [started + probe_timeout for _sw, _sock, started in probes.values()]
+        wait = max(0, min(due + [deadline]) - time())
+        for fd, _event in poller.poll(wait * 1000):
+            sw, sock, _started = probes.pop(fd)
+            poller.unregister(fd)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            sock.close()
+            if err == 0 and sw in pending: done(sw, time())
+            elif sw in pending: retry(sw)
+        for fd, (sw, sock, started) in probes.items():
+            if time() - started >= probe_timeout:
+                del probes[fd]
+                poller.unregister(fd)
+                sock.close()
+                if sw in pending: retry(sw)
+    for _sw, sock, _started in probes.values():
+        sock.close()
+    return ready
+
+
 class P4Switch(Switch):
     """P4 virtual switch"""
     device_id = 0
@@ -62,6 +146,9 @@ class P4Switch(Switch):
                  verbose = False,
                  device_id = None,
                  enable_debugger = False,
+                 batch = False,
+                 cpus = None,
+                 nice = None,
                  **kwargs):
         Switch.__init__(self, name, **kwargs)
         assert(sw_path)
@@ -90,28 +177,59 @@ class P4Switch(Switch):
             self.device_id = P4Switch.device_id
             P4Switch.device_id += 1
         self.nanomsg = "ipc:///tmp/bm-{}-log.ipc".format(self.device_id)
+        # With batch, start() only launches the switch, and batchStartup()
+        # waits for all switches to be ready at once
+        self.batch = batch
+        self.launched = None
+        self.sw_pid = None
+        # Cores the switch is pinned to, and its scheduling priority
+        self.cpus = cpus
+        self.nice = nice
 
     @classmethod
     def setup(cls):
         pass
 
-    def check_switch_started(self, pid):
-        """While the process is running (pid exists), we check if the Thrift
+    def check_switch_started(self):
+        """While the switch is running (see is_running()), we check if the Thrift
         server has been started. If the Thrift server is ready, we assume that
         the switch was started successfully. This is only reliable if the Thrift
         server is started at the end of the init process"""
-        while True:
-            if not os.path.exists(os.path.join("/proc", str(pid))):
-                return False
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(0.5)
-            result = sock.connect_ex(("localhost", self.thrift_port))
-            if result == 0:
-                return  True
+        return wait_thrift_ready([self])[self] is not None
 
-    def start(self, controllers):
-        "Start up a new P4 switch"
-        info("Starting P4 switch {}.\n".format(self.name))
+    def thrift_address(self):
+        "Address the switch's Thrift server listens on"
+        return ("localhost", self.thrift_port)
+
+    def is_running(self):
+        "Is the launched switch process still running?"
+        return os.path.exists(os.path.join("/proc", str(self.sw_pid)))
+
+    @classmethod
+    def batchStartup(cls, switches, **_kwargs):
+        """Wait for switches launched by start() with batch to be ready,
+        all at once, and report how long each took
+        returns: switches that are ready"""
+        switches = [sw for sw in switches if sw.batch and sw.launched]
+        if not switches: return switches
+        with timeline.timed('switches ready'):
+            ready = wait_thrift_ready(switches)
+        for sw in switches:
+            timeline.record('%s ready' % sw.name, sw.launched,
+                            sw.launched + (ready[sw] or 0), kind='node',
+                            server=getattr(sw, 'server', 'localhost'),
+                            ready=ready[sw] is not None)
+            if ready[sw] is None:
+                error("P4 switch {} did not start correctly. "
+                      "Check the switch log file.\n".format(sw.name))
+            else:
+                info("P4 switch {} ready in {:.3f}s\n".format(sw.name, ready[sw]))
+        if None in ready.values():
+            exit(1)
+        return switches
+
+    def switch_args(self):
+        "Command line of the switch"
         args = [self.sw_path]
         for port, intf in self.intfs.items():
             if not intf.IP():
@@ -130,20 +248,26 @@ class P4Switch(Switch):
             args.append("--debugger")
         if self.log_console:
             args.append("--log-console")
-        info(' '.join(args) + "\n")
+        if self.nice is not None:
+            args = ['nice', '-n', str(self.nice)] + args
+        if self.cpus:
+            args = ['taskset', '-c', cpu_list(self.cpus)] + args
+        return args
 
-        pid = None
-        with tempfile.NamedTemporaryFile() as f:
-            print ' '.join(args) + ' > /dev/null 2>&1 &'
-            self.cmd(' '.join(args) + ' > /dev/null 2>&1 &')
-            # self.cmd(' '.join(args) + ' >' + self.log_file + ' 2>&1 & echo $! >> ' + f.name)
-            # pid = int(f.read())
-        # debug("P4 switch {} PID is {}.\n".format(self.name, pid))
-        sleep(1)
-        # if not self.check_switch_started(pid):
-        #     error("P4 switch {} did not start correctly."
-        #           "Check the switch log file.\n".format(self.name))
-        #     exit(1)
+    def start(self, controllers):
+        "Start up a new P4 switch"
+        info("Starting P4 switch {}.\n".format(self.name))
+        args = self.switch_args()
+        info(' '.join(args) + "\n")
+        self.launched = time()
+        self.sw_pid = int(self.cmd(' '.join(args) + ' > /dev/null 2>&1 & echo $!').split()[-1])
+        debug("P4 switch {} PID is {}.\n".format(self.name, self.sw_pid))
+        if self.batch:
+            return
+        if not self.check_switch_started():
+            error("P4 switch {} did not start correctly."
+                  "Check the switch log file.\n".format(self.name))
+            exit(1)
         info("P4 switch {} has been started.\n".format(self.name))
 
     def stop(self):
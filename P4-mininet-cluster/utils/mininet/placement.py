@@ -0,0 +1,251 @@
+# Placement of a multiswitch target's nodes on its servers.
+#
+# Picks the placement algorithm a target asks for ("placement" in
+# p4app.json) and gives it what it needs: the traffic between end hosts,
+# from the workload's .dat files, and the capacity of each server (cores
+# and memory, from the manifest or probed over ssh). Under a cost model of
+# bmv2, the nodes' needs are estimated and checked against that capacity:
+#
+#     placer, params = placer_config(conf, topo, base_dir)
+#     net = MininetCluster(..., placement=placer, placementParams=params)
+
+import os
+import subprocess
+from threading import Thread
+
+from mininet.log import warn
+
+from cluster import (UserdefinedPlacer, PartitionPlacer, SwitchBinPlacer,
+                     RoundRobinPlacer, RandomPlacer, findUser)
+
+# Values of a target's "placement" in p4app.json
+PLACERS = {
+    'userdefined': UserdefinedPlacer,
+    'partition': PartitionPlacer,
+    'switchbin': SwitchBinPlacer,
+    'roundrobin': RoundRobinPlacer,
+    'random': RandomPlacer,
+}
+
+
+# Cost model of a node, overridable by a target's "bmv2_cost" in p4app.json.
+# A bmv2 switch forwards a few tens of thousands of packets per second per
+# core; besides the workload, every port carries some steady traffic of
+# its own (probes, ARP).
+BMV2_COST = {
+    'idle_cores': 0.05,       # cores a bmv2 instance uses with no traffic
+    'pps_per_core': 20000,    # packets per second one core of bmv2 forwards
+    'port_pps': 100,          # packets per second on each port, always
+    'host_pps': 4000,         # packets per second a sending host offers
+    'memory': 100,            # MB of memory of a bmv2 instance
+    'host_cores': 0.02,       # cores of an idle host namespace
+    'workload_cores': 0.25,   # cores of a host running a workload
+    'host_memory': 10,        # MB of memory of a host
+}
+
+# Fraction of each server's capacity placement may fill by default
+UTILIZATION = 0.8
+
+
+def _mapping(mapping):
+    if mapping is None: return None
+    if isinstance(mapping, basestring): mapping = mapping.split(',')
+    return [int(n) for n in mapping]
+
+
+def dat_traffic(path, start, numhosts, src_mapping=None, dst_mapping=None):
+    """Bytes sent between end hosts by a workload .dat file (lines of
+    "time src dst size"). Sources and destinations are numbered the way
+    convert-dat-to-sh.py numbers them: host h<start+n> for node n, with
+    destinations after the numhosts/2 sources unless mappings are given.
+    returns: dict of (src host, dst host) -> bytes"""
+    src_nodes, dst_nodes = _mapping(src_mapping), _mapping(dst_mapping)
+    traffic = {}
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4: continue
+            src, dst, size = int(fields[1]), int(fields[2]), float(fields[3])
+            src = src_nodes[src] if src_nodes else src + 1
+            dst = dst_nodes[dst] if dst_nodes else numhosts / 2 + dst + 1
+            key = ('h%d' % (start + src), 'h%d' % (start + dst))
+            traffic[key] = traffic.get(key, 0) + size
+    return traffic
+
+
+def probe_capacity(servers, user=None, timeout=10):
+    """Cores and memory of each server, probed over ssh (localhost is
+    probed directly). Servers that cannot be reached are left out.
+    returns: dict of server -> { "cores", "memory" (MB) }"""
+    probe = "nproc; awk '/^MemTotal:/ { print $2 }' /proc/meminfo"
+    user = user or findUser()
+    capacity = {}
+
+    def run(server):
+        cmd = ['sh', '-c', probe]
+        if server != 'localhost':
+            cmd = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=%d' % timeout,
+                   '%s@%s' % (user, server), probe]
+            if os.getuid() == 0 and user != 'root':
+                cmd = ['sudo', '-E', '-u', user] + cmd
+        try:
+            out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   close_fds=True).communicate()[0].split()
+            capacity[server] = dict(cores=int(out[0]), memory=int(out[1]) / 1024)
+        except (OSError, IndexError, ValueError):
+            warn('*** Could not probe the capacity of %s\n' % server)
+
+    threads = [Thread(target=run, args=(server,)) for server in servers]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return capacity
+
+
+def server_capacity(conf, servers, probe=False):
+    """Cores and memory of each server, from the target's "server_capacity":
+    { server: { "cores", "memory" (MB) } }, where a "default" entry applies
+    to servers not listed, or from the older "server_cores" (a number or
+    { server: cores }). With probe, or "server_capacity": "probe", servers
+    the manifest says nothing about are probed over ssh.
+    returns: dict of server -> { resource: amount }"""
+    spec = conf.get('server_capacity', {})
+    if spec == 'probe':
+        spec, probe = {}, True
+    cores = conf.get('server_cores')
+    capacity = {}
+    for server in servers:
+        c = dict(spec.get('default', {}))
+        c.update(spec.get(server, {}))
+        if 'cores' not in c:
+            if isinstance(cores, dict) and server in cores:
+                c['cores'] = cores[server]
+            elif cores is not None and not isinstance(cores, dict):
+                c['cores'] = cores
+        if c:
+            capacity[server] = dict((r, float(v)) for r, v in c.iteritems())
+    missing = [server for server in servers if 'cores' not in capacity.get(server, {})]
+    if probe and missing:
+        for server, c in probe_capacity(missing).iteritems():
+            capacity.setdefault(server, {}).update((r, float(v)) for r, v in c.iteritems())
+    return capacity
+
+
+def switch_rates(topo, traffic, model):
+    """Packets per second each switch forwards: every port's steady
+    traffic, plus the workload of hosts sending at model's host_pps,
+    split between their destinations by bytes and spread over all
+    shortest paths between their switches.
+    returns: dict of switch -> packets per second"""
+    switches = set(topo.switches())
+    adj = dict((sw, {}) for sw in switches)
+    degree = dict((sw, 0) for sw in switches)
+    switch_for = {}
+    for a, b in topo.links():
+        for x, y in ((a, b), (b, a)):
+            if x in switches:
+                degree[x] += 1
+                if y in switches: adj[x][y] = 1
+                else: switch_for[y] = x
+    rates = dict((sw, degree[sw] * model['port_pps']) for sw in switches)
+    sent = {}
+    for (src, dst), size in traffic.iteritems():
+        sent[src] = sent.get(src, 0) + size
+    demand, load = {}, {}
+    for (src, dst), size in traffic.iteritems():
+        a, b = switch_for.get(src), switch_for.get(dst)
+        if a is None or b is None or not sent[src]: continue
+        pps = model['host_pps'] * size / float(sent[src])
+        # Traffic enters the network at a and leaves it at b
+        rates[a] += pps / 2
+        rates[b] += pps / 2
+        demand.setdefault(a, {})
+        demand[a][b] = demand[a].get(b, 0) + pps
+    for src in sorted(demand):
+        PartitionPlacer.spread(adj, src, demand[src], load)
+    # Each packet on a switch link goes through the switches at both ends,
+    # entering one and leaving the other
+    for (a, b), pps in load.iteritems():
+        rates[a] += pps / 2
+        rates[b] += pps / 2
+    return rates
+
+
+def node_costs(conf, topo, traffic=None, model=None):
+    """Cores and memory each node needs under the cost model
+    returns: dict of node -> { "cores", "memory" (MB) }"""
+    model = dict(BMV2_COST, **(model if model is not None else conf.get('bmv2_cost', {})))
+    rates = switch_rates(topo, traffic or {}, model)
+    costs = {}
+    for sw in topo.switches():
+        costs[sw] = dict(cores=model['idle_cores'] + rates[sw] / float(model['pps_per_core']),
+                         memory=model['memory'])
+    for h in topo.hosts():
+        busy = 'cmd' in conf.get('hosts', {}).get(h, {})
+        costs[h] = dict(cores=model['workload_cores'] if busy else model['host_cores'],
+                        memory=model['host_memory'])
+    return costs
+
+
+def check_capacity(costs, capacity, servers, utilization=UTILIZATION):
+    """Warn when the servers together cannot run the nodes within the
+    utilization target. Resources are only checked when the capacity of
+    every server is known.
+    returns: True if they can"""
+    ok = True
+    for r in ('cores', 'memory'):
+        if not all(r in capacity.get(server, {}) for server in servers): continue
+        have = sum(capacity[server][r] for server in servers)
+        need = sum(c.get(r, 0) for c in costs.values())
+        if need > have * utilization:
+            warn('*** The cluster is too small for this topology: nodes need %.1f %s, '
+                 'the servers have %.1f at %d%% utilization (%.1f in all)\n' % (
+                     need, r, have * utilization, utilization * 100, have))
+            ok = False
+    return ok
+
+
+def conf_traffic(conf, topo, base_dir):
+    """Traffic between end hosts from a target's optional "traffic":
+    { "dat": path or list of paths, "start", "numhosts", "src_mapping",
+    "dst_mapping" }. start defaults to the highest switch number and
+    numhosts to the number of end hosts.
+    returns: dict of (src host, dst host) -> bytes"""
+    traffic = {}
+    if 'traffic' not in conf: return traffic
+    t = conf['traffic']
+    start = int(t.get('start', max(int(sw[1:]) for sw in topo.switches())))
+    numhosts = int(t.get('numhosts', len([h for h in topo.hosts() if int(h[1:]) > start])))
+    files = t['dat'] if isinstance(t['dat'], list) else [t['dat']]
+    for dat in files:
+        for key, size in dat_traffic(os.path.join(base_dir, dat), start, numhosts,
+                                     t.get('src_mapping'), t.get('dst_mapping')).iteritems():
+            traffic[key] = traffic.get(key, 0) + size
+    return traffic
+
+
+def placer_config(conf, topo, base_dir, capacity=None):
+    """Placement algorithm for a target and its parameters, from the
+    target's "placement" (default "userdefined") and its "traffic" (see
+    conf_traffic()).
+    When the capacity of the servers is known (capacity, by default
+    server_capacity()), the nodes are checked against the target's
+    "utilization" (default UTILIZATION), and "partition" packs nodes by
+    their cost under the cost model instead of by count.
+    returns: (Placer class, dict of extra parameters)"""
+    name = conf.get('placement', 'userdefined')
+    if name not in PLACERS:
+        raise Exception('Unknown placement "%s", expected one of %s' % (name, ', '.join(sorted(PLACERS))))
+    params = {}
+    traffic = conf_traffic(conf, topo, base_dir)
+    servers = conf['servers']
+    if capacity is None:
+        capacity = server_capacity(conf, servers)
+    if capacity:
+        utilization = float(conf.get('utilization', UTILIZATION))
+        costs = node_costs(conf, topo, traffic)
+        check_capacity(costs, capacity, servers, utilization)
+        if name == 'partition' and all(server in capacity for server in servers):
+            params.update(costs=costs, capacities=capacity, utilization=utilization)
+    if name == 'partition' and traffic:
+        params['traffic'] = traffic
+    return PLACERS[name], params
@@ -0,0 +1,145 @@
+#!/usr/bin/env python2
+
+# Dry-run planner for multiswitch targets.
+#
+# Builds the AppTopo graph of a p4app.json target and runs the placement
+# algorithm without starting any node, then reports what each server will
+# have to run.
+
+import argparse
+import json
+import multiprocessing
+import os
+
+from mininet.log import setLogLevel
+
+import apptopo
+from cluster import makePlacer
+from placement import placer_config, conf_traffic, server_capacity, node_costs, UTILIZATION
+
+parser = argparse.ArgumentParser(description='Mininet cluster planner')
+parser.add_argument('--manifest', '-m', help='Path to manifest file',
+                    type=str, action="store", required=True)
+parser.add_argument('--target', '-t', help='Target in manifest file to plan',
+                    type=str, action="store", required=True)
+parser.add_argument('--thrift-port', help='First thrift port assigned to switches',
+                    type=int, action="store", default=9090)
+parser.add_argument('--cores', help=('Cores per server, used when the manifest has '
+                                     'no server_capacity or server_cores. Defaults to this machine\'s'),
+                    type=int, action="store", default=multiprocessing.cpu_count())
+parser.add_argument('--probe', help='Probe the cores and memory of servers over ssh',
+                    action="store_true", default=False)
+parser.add_argument('--output', '-o', help='Also write the plan as JSON to this file',
+                    type=str, action="store", required=False)
+
+
+def count_entries(conf, sw_name, base_dir):
+    "Number of table entries the controller would install on a switch"
+    if 'switches' not in conf or sw_name not in conf['switches']:
+        return 0
+    entries = conf['switches'][sw_name].get('entries', [])
+    if type(entries) == list:
+        return len(entries)
+    with open(os.path.join(base_dir, entries), 'r') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def make_plan(conf, topo, placer, base_dir, thrift_port, capacity, costs):
+    """Place every node of topo and tally the per-server resource usage.
+       returns: dict server -> usage"""
+    servers = conf['servers']
+    utilization = float(conf.get('utilization', UTILIZATION))
+    placement = dict((node, placer.place(node)) for node in topo.nodes())
+    usage = dict((server, dict(bmv2=0, namespaces=0, veth_pairs=0, tunnels=0,
+                               thrift_ports=[], entries=0, workloads=0,
+                               demand=0.0, memory=0.0,
+                               cores=int(capacity[server]['cores']),
+                               memory_total=capacity[server].get('memory')))
+                 for server in servers)
+
+    # Switches get consecutive thrift ports in the order Mininet creates them
+    for idx, sw in enumerate(topo.switches()):
+        u = usage[placement[sw]]
+        u['bmv2'] += 1
+        u['thrift_ports'].append(thrift_port + idx)
+        u['entries'] += count_entries(conf, sw, base_dir)
+
+    for h in topo.hosts():
+        u = usage[placement[h]]
+        u['namespaces'] += 1
+        if 'cmd' in conf['hosts'].get(h, {}):
+            u['workloads'] += 1
+
+    for a, b in topo.links():
+        if placement[a] == placement[b]:
+            usage[placement[a]]['veth_pairs'] += 1
+        else:
+            usage[placement[a]]['tunnels'] += 1
+            usage[placement[b]]['tunnels'] += 1
+
+    # Cores and memory by the cost model; tunnels only add load in
+    # proportion to their traffic, so they are reported but not counted.
+    for node, cost in costs.iteritems():
+        u = usage[placement[node]]
+        u['demand'] += cost['cores']
+        u['memory'] += cost['memory']
+
+    for server, u in usage.iteritems():
+        u['saturated'] = (u['demand'] > u['cores'] * utilization or
+                          (u['memory_total'] is not None and
+                           u['memory'] > u['memory_total'] * utilization))
+    return placement, usage
+
+
+def print_plan(servers, usage, placement, topo):
+    cross = sum(1 for a, b in topo.links() if placement[a] != placement[b])
+    print '%-12s %5s %5s %5s %7s %7s %8s %6s %8s  %s' % (
+        'server', 'bmv2', 'netns', 'veth', 'tunnels', 'entries', 'demand', 'cores', 'mem(MB)',
+        'thrift ports')
+    for server in servers:
+        u = usage[server]
+        ports = ('%d-%d' % (min(u['thrift_ports']), max(u['thrift_ports']))
+                 if u['thrift_ports'] else '-')
+        print '%-12s %5d %5d %5d %7d %7d %8.2f %6d %8d  %s%s' % (
+            server, u['bmv2'], u['namespaces'], u['veth_pairs'], u['tunnels'],
+            u['entries'], u['demand'], u['cores'], u['memory'], ports,
+            '  <-- over the utilization target' if u['saturated'] else '')
+    print '%d nodes, %d links, %d cross-server tunnels' % (
+        len(topo.nodes()), len(topo.links()), cross)
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.manifest, 'r') as f:
+        manifest = json.load(f)
+    conf = manifest['targets'][args.target]
+    base_dir = os.path.dirname(os.path.abspath(args.manifest))
+
+    links = [l[:2] for l in conf['links']]
+    switch_info = dict((sw, p4file + '.json') for sw, p4file in conf['configs'].iteritems())
+    args.behavioral_exe = 'simple_switch'
+    topo = apptopo.AppTopo(links, switch_info, args, False, False, manifest=manifest,
+                           target=args.target, NUM_END_HOSTS=int(conf.get('NUM_END_HOSTS', 0)))
+
+    servers = [x.encode('ascii') for x in conf['servers']]
+    conf['servers'] = servers
+    capacity = server_capacity(conf, servers, args.probe)
+    placement, placer_params = placer_config(conf, topo, base_dir, capacity)
+    placer = makePlacer(placement, servers, topo, hostsConfig=conf['hosts'],
+                        switchesConfig=conf['switches'], **placer_params)
+    for server in servers:
+        capacity.setdefault(server, {}).setdefault('cores', args.cores)
+    costs = node_costs(conf, topo, conf_traffic(conf, topo, base_dir))
+    placement, usage = make_plan(conf, topo, placer, base_dir, args.thrift_port, capacity, costs)
+    print_plan(servers, usage, placement, topo)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(placement=placement, servers=usage), f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    setLogLevel('warning')
+    exit(main())
@@ -0,0 +1,166 @@
+"""
+reader.py: non-blocking output collection for many processes
+
+Reading a command's output with read() blocks until it ends, one command
+at a time, and polling in a loop burns the master's CPU while remote
+commands are in flight. An OutputReader waits on the pipes of any number
+of processes with a single poll(), drains whatever each one has written
+as it arrives, and feeds their input without ever blocking on a full
+pipe, so hundreds of commands can be waited on at once:
+
+    reader = OutputReader()
+    reader.add( 's1', p1, data='table_add ...\n' )
+    reader.add( 's2', p2 )
+    late = reader.wait( timeout=10 )    # keys still running at the timeout
+    for key in late:
+        reader.kill( key )
+    code, output = reader.result( 's1' )
+"""
+
+import errno
+import fcntl
+import os
+import select
+import signal
+from time import time
+
+# Bytes read from or written to a pipe at a time
+CHUNK = 65536
+
+
+class OutputReader( object ):
+    "Collect the output of many processes with a single poll()"
+
+    def __init__( self ):
+        self.poller = select.poll()
+        self.procs = {}
+        self.output = {}
+        self.ended = set()
+        # fd -> ( key, file ) for outputs, and
+        # fd -> ( key, file, data, offset ) for inputs
+        self.outputs = {}
+        self.inputs = {}
+
+    def add( self, key, proc, data=None ):
+        """Collect the output of a process
+           key: name for the process
+           proc: Popen object with stdout=PIPE
+           data: string to write to its stdin (stdin=PIPE), which is
+                 then closed"""
+        self.procs[ key ] = proc
+        self.output[ key ] = []
+        fd = proc.stdout.fileno()
+        self.outputs[ fd ] = ( key, proc.stdout )
+        self.poller.register( fd, select.POLLIN )
+        if data is not None:
+            fd = proc.stdin.fileno()
+            # Writes only take what fits in the pipe
+            fcntl.fcntl( fd, fcntl.F_SETFL,
+                         fcntl.fcntl( fd, fcntl.F_GETFL ) | os.O_NONBLOCK )
+            self.inputs[ fd ] = ( key, proc.stdin, data, 0 )
+            self.poller.register( fd, select.POLLOUT )
+
+    def _write( self, fd ):
+        "Write the next chunk of a process's input"
+        key, f, data, offset = self.inputs[ fd ]
+        try:
+            offset += os.write( fd, data[ offset : offset + CHUNK ] )
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            # The process stopped reading (EPIPE); its output tells why
+            offset = len( data )
+        if offset < len( data ):
+            self.inputs[ fd ] = ( key, f, data, offset )
+            return
+        self.poller.unregister( fd )
+        del self.inputs[ fd ]
+        f.close()
+
+    def _read( self, fd ):
+        """Read what a process has written
+           returns: key of the process if its output ended"""
+        key, f = self.outputs[ fd ]
+        data = os.read( fd, CHUNK )
+        if data:
+            self.output[ key ].append( data )
+            return None
+        self.poller.unregister( fd )
+        del self.outputs[ fd ]
+        f.close()
+        self.procs[ key ].wait()
+        self.ended.add( key )
+        return key
+
+    def poll( self, timeout=None ):
+        """Handle the pipes that are ready, waiting for one at most
+           timeout seconds (None: until one is)
+           returns: keys of the processes whose output ended"""
+        try:
+            events = self.poller.poll(
+                None if timeout is None else max( 0, timeout ) * 1000 )
+        except select.error as e:
+            if e.args[ 0 ] == errno.EINTR:
+                return []
+            raise
+        ended = []
+        for fd, _event in events:
+            if fd in self.inputs:
+                self._write( fd )
+            elif fd in self.outputs:
+                key = self._read( fd )
+                if key is not None:
+                    ended.append( key )
+        return ended
+
+    def wait( self, keys=None, timeout=None ):
+        """Wait for the output of processes to end
+           keys: processes to wait for, default all
+           timeout: seconds to wait at most, or None
+           returns: keys of the processes still running at the timeout"""
+        keys = set( keys if keys is not None else self.procs )
+        deadline = time() + timeout if timeout is not None else None
+        while keys - self.ended:
+            left = deadline - time() if deadline is not None else None
+            if left is not None and left <= 0:
+                break
+            self.poll( left )
+        return sorted( keys - self.ended )
+
+    def kill( self, key ):
+        "Kill a process (and its process group, if it leads one)"
+        proc = self.procs[ key ]
+        if key not in self.ended:
+            try:
+                if os.getpgid( proc.pid ) == proc.pid:
+                    os.killpg( proc.pid, signal.SIGKILL )
+                else:
+                    proc.kill()
+            except OSError:
+                pass
+            proc.wait()
+        # Its pipes may still be held open by other processes
+        for fds in self.outputs, self.inputs:
+            for fd in [ fd for fd in fds if fds[ fd ][ 0 ] == key ]:
+                self.poller.unregister( fd )
+                fds.pop( fd )[ 1 ].close()
+        self.ended.add( key )
+
+    def result( self, key ):
+        """returns: ( returncode, output so far ) of a process, the
+           returncode being None while it is running"""
+        return self.procs[ key ].poll(), ''.join( self.output[ key ] )
+
+
+def readOutput( proc, data=None, timeout=None ):
+    """Collect the output of a single process
+       data: string to write to its stdin
+       timeout: seconds after which the process is killed, or None
+       returns: ( returncode, output ), the returncode being None if the
+                process was killed at the timeout"""
+    reader = OutputReader()
+    reader.add( proc, proc, data )
+    if reader.wait( timeout=timeout ):
+        reader.kill( proc )
+        return None, reader.result( proc )[ 1 ]
+    return reader.result( proc )
@@ -0,0 +1,171 @@
+"""
+supervisor.py: deadlines and teardown for host processes
+
+A Supervisor keeps track of the workload processes of all hosts at once.
+A single polling loop reaps the processes that exit and moves the ones
+past their deadline (their own, or the global one) through a sequence of
+escalating signals, so that a hung host neither blocks the others nor
+delays the teardown of the rest by more than the grace periods.
+
+    sup = Supervisor( deadline=time() + 600 )
+    sup.add( 'h1', p1, timeout=60 )
+    sup.add( 'h2', p2 )
+    sup.wait( [ 'h1' ] )    # h1 runs to completion (or its deadline)
+    sup.stop()              # everything else is signaled in parallel
+    sup.results()           # { 'h1': { 'status': 'exited', ... }, ... }
+
+Signals go to the children of each process with pkill -P, as the
+workload runs under a shell; the process itself is killed at the end.
+"""
+
+import json
+import signal
+from subprocess import Popen
+from time import sleep, time
+
+from mininet.log import info, warn
+
+import timeline
+
+# Signals sent to a process past its deadline, each followed by the number
+# of seconds it is given to exit before the next one
+ESCALATION = ( ( 'INT', 1.2 ), ( 'TERM', 2.0 ), ( 'KILL', 1.0 ) )
+
+
+class Supervisor( object ):
+    "Run host processes to completion or to their deadline"
+
+    def __init__( self, deadline=None, escalation=ESCALATION,
+                  interval=0.05 ):
+        """deadline: global deadline (seconds since the epoch) or None
+           escalation: sequence of ( signal name, grace period )
+           interval: seconds between polls"""
+        self.deadline = deadline
+        self.escalation = escalation
+        self.interval = interval
+        self.procs = {}
+        self.signalers = []
+
+    def add( self, name, proc, timeout=None, start=None ):
+        """Supervise a process
+           name: host name
+           proc: Popen object
+           timeout: seconds the process may run, or None
+           start: time the process started, default now"""
+        start = start if start is not None else time()
+        self.procs[ name ] = dict(
+            proc=proc, start=start, end=None, signals=[], next=None,
+            stopped=False,
+            deadline=start + timeout if timeout is not None else None )
+
+    def _deadline( self, entry ):
+        "Earliest of a process's own and the global deadline"
+        deadlines = [ d for d in ( entry[ 'deadline' ], self.deadline )
+                      if d is not None ]
+        return min( deadlines ) if deadlines else None
+
+    def _signal( self, name, entry, now ):
+        "Send the next signal of the escalation to a process"
+        step = len( entry[ 'signals' ] )
+        if step >= len( self.escalation ):
+            return
+        sig, grace = self.escalation[ step ]
+        proc = entry[ 'proc' ]
+        info( '*** %s: sending SIG%s\n' % ( name, sig ) )
+        self.signalers.append(
+            Popen( [ 'pkill', '-%s' % sig, '-P', str( proc.pid ) ] ) )
+        if sig == 'KILL':
+            try:
+                proc.send_signal( signal.SIGKILL )
+            except OSError:
+                pass
+        entry[ 'signals' ].append( sig )
+        entry[ 'next' ] = now + grace
+
+    def poll( self, now=None ):
+        """Reap exited processes and signal the ones past their deadline
+           returns: names of the processes still running"""
+        now = now if now is not None else time()
+        running = []
+        for name, entry in self.procs.iteritems():
+            if entry[ 'end' ] is not None:
+                continue
+            if entry[ 'proc' ].poll() is not None:
+                entry[ 'end' ] = now
+                timeline.record( '%s workload' % name, entry[ 'start' ], now,
+                                 kind='node',
+                                 returncode=entry[ 'proc' ].returncode,
+                                 signals=entry[ 'signals' ] )
+                continue
+            running.append( name )
+            deadline = self._deadline( entry )
+            if entry[ 'next' ] is not None:
+                if now >= entry[ 'next' ]:
+                    if len( entry[ 'signals' ] ) < len( self.escalation ):
+                        self._signal( name, entry, now )
+                    else:
+                        # Nothing left to send; stop waiting for it
+                        warn( '*** %s did not exit after SIG%s\n' %
+                              ( name, entry[ 'signals' ][ -1 ] ) )
+                        entry[ 'end' ] = now
+                        running.remove( name )
+            elif deadline is not None and now >= deadline:
+                self._signal( name, entry, now )
+        self.signalers = [ p for p in self.signalers if p.poll() is None ]
+        return running
+
+    def wait( self, names=None ):
+        """Wait for processes to exit, enforcing the deadlines of all
+           names: processes to wait for, default all"""
+        names = set( names if names is not None else self.procs )
+        while names & set( self.poll() ):
+            sleep( self.interval )
+
+    def stop( self, names=None ):
+        """Stop processes now, all in parallel
+           names: processes to stop, default all"""
+        names = names if names is not None else self.procs.keys()
+        now = time()
+        for name in names:
+            entry = self.procs[ name ]
+            if entry[ 'end' ] is None and entry[ 'next' ] is None:
+                entry[ 'deadline' ] = now
+                entry[ 'stopped' ] = True
+        self.wait( names )
+
+    def results( self ):
+        """returns: dict of name -> { status, returncode, duration,
+           signals }, status being one of 'exited', 'stopped' (by stop()),
+           'timeout' (past its deadline) or 'hung' (never exited)"""
+        results = {}
+        for name, entry in self.procs.iteritems():
+            end = entry[ 'end' ] if entry[ 'end' ] is not None else time()
+            returncode = entry[ 'proc' ].returncode
+            if returncode is None:
+                status = 'hung'
+            elif not entry[ 'signals' ]:
+                status = 'exited'
+            else:
+                status = 'stopped' if entry[ 'stopped' ] else 'timeout'
+            results[ name ] = dict( status=status, returncode=returncode,
+                                    duration=end - entry[ 'start' ],
+                                    signals=entry[ 'signals' ] )
+        return results
+
+
+def statusReport( results ):
+    "Return a printable report of the results of a Supervisor"
+    lines = [ '*** Host process status' ]
+    for name in sorted( results ):
+        r = results[ name ]
+        lines.append( '  %-16s %-8s rc=%-5s %8.2fs  %s' % (
+            name, r[ 'status' ], r[ 'returncode' ], r[ 'duration' ],
+            ' '.join( 'SIG%s' % sig for sig in r[ 'signals' ] ) ) )
+    return '\n'.join( lines )
+
+
+def writeStatus( results, path ):
+    "Write the results of a Supervisor to path as JSON"
+    with open( path, 'w' ) as f:
+        json.dump( results, f, indent=2, sort_keys=True )
+    return path
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import agent
+
+# Commands Popen() cannot run: exec takes no NUL bytes
+BAD = u'echo a\x00b'
+
+
+def serve(requests):
+    "Run requests through agent.serve(); returns its responses"
+    fin, fout = StringIO(), StringIO()
+    for request in requests:
+        agent.writeFrame(fin, request)
+    fin.seek(0)
+    agent.serve(fin, fout)
+    fout.seek(0)
+    responses = []
+    while True:
+        response = agent.readFrame(fout)
+        if response is None:
+            return responses
+        responses.append(response)
+
+
+class TestServe(unittest.TestCase):
+
+    def test_bad_then_good(self):
+        responses = serve([{'cmds': [{'cmd': BAD}, {'cmd': 'echo ok'}]},
+                           {'cmds': [{'cmd': 'echo still ok'}]}])
+        bad, good = responses[0]['results']
+        self.assertEqual(bad['code'], 127)
+        self.assertIn('TypeError', bad['out'])
+        self.assertEqual(good, {'out': 'ok\n', 'code': 0})
+        self.assertEqual(responses[1]['results'], [{'out': 'still ok\n', 'code': 0}])
+
+    def test_non_ascii(self):
+        result = serve([{'cmds': [{'cmd': u'echo café'}]}])[0]['results'][0]
+        self.assertEqual(result, {'out': u'café\n', 'code': 0})
+
+    def test_parallel(self):
+        results = serve([{'cmds': [{'cmd': BAD}, {'cmd': 'exit 3'}, {'cmd': 'echo ok'}],
+                          'parallel': True}])[0]['results']
+        self.assertEqual([r['code'] for r in results], [127, 3, 0])
+
+
+class TestAgent(unittest.TestCase):
+    "A real agent process on localhost, without sudo"
+
+    def setUp(self):
+        self.agent = agent.Agent(sudo=False)
+
+    def tearDown(self):
+        self.agent.stop()
+
+    def test_survives_bad_command(self):
+        results = self.agent.batch([BAD, u'echo café'])
+        self.assertEqual(results[0]['code'], 127)
+        self.assertEqual(results[1], {'out': 'café\n', 'code': 0})
+        self.assertEqual(self.agent.run('echo ok'), 'ok\n')
+        self.assertIsNone(self.agent.proc.poll())
+        self.assertEqual((self.agent.batches, self.agent.commands), (2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
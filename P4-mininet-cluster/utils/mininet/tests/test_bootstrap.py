@@ -0,0 +1,117 @@
+import os
+import pty
+import select
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bootstrap
+
+
+class PtyShell(object):
+    """Shell on a terminal, the way Mininet runs a node's shell, with ip
+    and arp replaced by functions that print their batches"""
+
+    def __init__(self, name):
+        self.name = name
+        master, slave = pty.openpty()
+        self.shell = subprocess.Popen(['bash', '--norc', '--noediting', '-is', 'mininet:' + name],
+                                      stdin=slave, stdout=slave, stderr=slave, close_fds=True)
+        os.close(slave)
+        self.fd = master
+        self.sendCmd("stty -echo; PS1=$'\\177'; "
+                     "ip() { echo \"ip $*\"; cat; }; arp() { echo \"arp $*\"; cat; }")
+        self.waitOutput()
+
+    def sendCmd(self, cmd):
+        os.write(self.fd, cmd + '\n')
+
+    def waitOutput(self, timeout=10):
+        out = ''
+        while not out.endswith('\x7f'):
+            if not select.select([self.fd], [], [], timeout)[0]:
+                raise Exception('%s: no prompt after %r' % (self.name, out[-200:]))
+            out += os.read(self.fd, 65536)
+        return out.rstrip('\x7f').replace('\r\n', '\n')
+
+    def stop(self):
+        self.shell.kill()
+        self.shell.wait()
+        os.close(self.fd)
+
+
+class FakeNet(object):
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def get(self, name):
+        return self.nodes[name]
+
+
+def host_cmds(n):
+    "About 50 * n bytes of bootstrap commands"
+    return ['ip route add 10.0.%d.%d/32 via 10.0.0.1 dev eth0' % (i / 256, i % 256) for i in range(n)]
+
+
+class TestBatchScript(unittest.TestCase):
+
+    def test_keeps_order(self):
+        cmds = ['ip route add 10.0.1.0/24 dev eth0', 'ip link set eth0 up',
+                'export NEXT=$(echo 10.0.2.1)', 'ip route add 10.0.2.0/24 via 10.0.1.1',
+                'arp -s 10.0.1.1 00:00:00:00:00:01', 'arp -s 10.0.1.2 00:00:00:00:00:02',
+                'arp -i eth0 -s 10.0.1.3 00:00:00:00:00:03', 'echo "$NEXT" &']
+        self.assertEqual(bootstrap.batchScript(cmds).split('\n'), [
+            "ip -force -batch - <<'BOOTSTRAP_BATCH_END'",
+            'route add 10.0.1.0/24 dev eth0', 'link set eth0 up', 'BOOTSTRAP_BATCH_END',
+            'export NEXT=$(echo 10.0.2.1)',
+            "ip -force -batch - <<'BOOTSTRAP_BATCH_END'",
+            'route add 10.0.2.0/24 via 10.0.1.1', 'BOOTSTRAP_BATCH_END',
+            "arp -f /dev/stdin <<'BOOTSTRAP_BATCH_END'",
+            '10.0.1.1 00:00:00:00:00:01', '10.0.1.2 00:00:00:00:00:02', 'BOOTSTRAP_BATCH_END',
+            "ip -force -batch - <<'BOOTSTRAP_BATCH_END'",
+            'neigh replace 10.0.1.3 lladdr 00:00:00:00:00:03 dev eth0 nud permanent',
+            'BOOTSTRAP_BATCH_END',
+            'echo "$NEXT" &', ''])
+
+    def test_short_lines(self):
+        script = bootstrap.batchScript(host_cmds(400)) + "echo 'quoted \\\\ text'\n"
+        cmds = bootstrap.scriptCmds(script, '/tmp/x.sh')
+        self.assertGreater(len(cmds), 1)
+        for cmd in cmds:
+            self.assertLessEqual(len(cmd), bootstrap.MAX_LINE)
+
+
+class TestRunBootstrap(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = dict((name, PtyShell(name)) for name in ('h1', 'h2', 'h3'))
+
+    def tearDown(self):
+        for node in self.nodes.values():
+            node.stop()
+
+    def test_long_bootstraps(self):
+        cmds = {
+            # Over 15KB, several times what a terminal line takes
+            'h1': host_cmds(320) + ['echo "it\'s \\\\done"'],
+            'h2': ['export A=first', 'ip route add 10.0.0.0/8 dev eth0', 'echo $A; A=second',
+                   'arp -s 10.0.0.1 00:00:00:00:00:01', 'echo $A'],
+            'h3': [],
+        }
+        self.assertGreater(len('\n'.join(cmds['h1'])), 15000)
+        output = bootstrap.runBootstrap(FakeNet(self.nodes), cmds)
+        self.assertEqual(sorted(output), ['h1', 'h2'])
+        lines = output['h1'].strip().split('\n')
+        self.assertEqual(lines[0], 'ip -force -batch -')
+        self.assertEqual(lines[1:-1], [c[3:] for c in host_cmds(320)])
+        self.assertEqual(lines[-1], 'it\'s \\done')
+        self.assertEqual(output['h2'].strip().split('\n'), [
+            'ip -force -batch -', 'route add 10.0.0.0/8 dev eth0', 'first',
+            'arp -f /dev/stdin', '10.0.0.1 00:00:00:00:00:01', 'second'])
+        self.assertFalse([f for f in os.listdir('/tmp') if f.startswith('bootstrap-h')])
+
+
+if __name__ == '__main__':
+    unittest.main()
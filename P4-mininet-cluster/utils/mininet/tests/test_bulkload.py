@@ -0,0 +1,240 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bulkload
+from bulkload import WINDOW, BulkLoader, FakeConnection, FakeThriftServer, parse_register, snapshot
+
+
+def route(i, table='ipv4_lpm'):
+    return 'table_add %s set_nhop 10.%d.%d.0/24 => %d' % (table, i / 256 % 256, i % 256, i % 16)
+
+
+class TestBulkLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = dict((sw, FakeThriftServer()) for sw in ('s1', 's2', 's3'))
+        self.loader = BulkLoader(lambda sw: FakeConnection('127.0.0.1', self.servers[sw].port))
+
+    def tearDown(self):
+        for server in self.servers.values():
+            server.stop()
+
+    def assertClean(self, result):
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['mismatches'], {})
+
+    def test_counts(self):
+        cmds = {'s1': [route(i) for i in range(10)] + [route(i, 'acl') for i in range(3)],
+                's2': ['table_set_default ipv4_lpm drop'] + [route(i) for i in range(5)],
+                's3': []}
+        results = self.loader.load(cmds)
+        self.assertEqual(sorted(results), ['s1', 's2'])
+        for result in results.values():
+            self.assertClean(result)
+        self.assertEqual(results['s1']['commands'], 13)
+        self.assertEqual(len(self.servers['s1'].tables['ipv4_lpm']), 10)
+        self.assertEqual(len(self.servers['s1'].tables['acl']), 3)
+        self.assertEqual(len(self.servers['s2'].tables['ipv4_lpm']), 5)
+        self.assertEqual(self.servers['s2'].defaults, {'ipv4_lpm': ['drop']})
+        self.assertEqual(self.servers['s3'].tables, {})
+
+    def test_counts_from_existing_entries(self):
+        self.loader.load({'s1': [route(i) for i in range(4)]})
+        cmds = ['table_delete ipv4_lpm 1', route(100)]
+        self.assertClean(self.loader.load_switch('s1', cmds, counts={'ipv4_lpm': 4}))
+        self.assertEqual(len(self.servers['s1'].tables['ipv4_lpm']), 4)
+
+    def test_duplicate(self):
+        cmds = [route(0), route(1), route(0), route(2)]
+        result = self.loader.load_switch('s1', cmds)
+        self.assertEqual(result['errors'], [(route(0), 'error DUPLICATE_ENTRY')])
+        self.assertEqual(result['mismatches'], {'ipv4_lpm': (4, 3)})
+
+    def test_mismatch(self):
+        self.loader.load({'s1': [route(i) for i in range(3)]})
+        # The loader is not told about the entries s1 already has
+        result = self.loader.load({'s1': [route(i) for i in range(3, 5)]})['s1']
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['mismatches'], {'ipv4_lpm': (2, 5)})
+        self.assertIn('ipv4_lpm: 5 entries, expected 2', bulkload.load_report({'s1': result}))
+
+    def test_more_than_window(self):
+        n = 3 * WINDOW + 7
+        cmds = ['table_clear ipv4_lpm'] + [route(i) for i in range(n)]
+        # Duplicates in the second and last windows
+        cmds.insert(WINDOW + 10, route(5))
+        cmds.append(route(n - 1))
+        result = self.loader.load_switch('s1', cmds)
+        self.assertEqual(result['errors'], [(route(5), 'error DUPLICATE_ENTRY'),
+                                            (route(n - 1), 'error DUPLICATE_ENTRY')])
+        self.assertEqual(result['mismatches'], {'ipv4_lpm': (n + 2, n)})
+        keys = sorted(self.servers['s1'].tables['ipv4_lpm'].values())
+        self.assertEqual(keys, sorted(tuple(route(i).split()[3:4]) for i in range(n)))
+
+    def test_modify(self):
+        cmds = [route(0), route(1), 'table_modify ipv4_lpm set_nhop 2 7', 'table_modify ipv4_lpm drop 9']
+        result = self.loader.load_switch('s1', cmds)
+        self.assertEqual(result['errors'], [('table_modify ipv4_lpm drop 9', 'error INVALID_HANDLE')])
+        self.assertEqual(result['mismatches'], {})
+        server = self.servers['s1']
+        self.assertEqual(server.actions, {1: ['set_nhop', '0'], 2: ['set_nhop', '7']})
+        self.assertEqual(server.defaults, {})
+
+    def test_unreachable(self):
+        self.servers['s1'].stop()
+        result = self.loader.load_switch('s1', [route(0)])
+        self.assertEqual(len(result['errors']), 1)
+        self.assertEqual(result['errors'][0][0], None)
+
+
+class ClosingConnection(FakeConnection):
+
+    def __init__(self, host, port):
+        FakeConnection.__init__(self, host, port)
+        self.closed = False
+
+    def close(self):
+        FakeConnection.close(self)
+        self.closed = True
+
+
+class TestRegisters(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = dict((sw, FakeThriftServer(registers={'reg': 8, 'other': 4})) for sw in ('s1', 's2'))
+        self.conns = []
+        for sw, server in self.servers.items():
+            server.registers['reg'][:] = [i * 10 + int(sw[1]) for i in range(8)]
+            server.registers['other'][:] = [7, 0, 0, 9]
+
+    def tearDown(self):
+        for conn in self.conns:
+            if not conn.closed: conn.close()
+        for server in self.servers.values():
+            server.stop()
+
+    def connect(self, sw):
+        conn = ClosingConnection('127.0.0.1', self.servers[sw].port)
+        self.conns.append(conn)
+        return conn
+
+    def values(self, array):
+        return [int(v) for v in array]
+
+    def test_read_register(self):
+        conn = self.connect('s1')
+        self.assertEqual(self.values(conn.read_register('reg')), [1, 11, 21, 31, 41, 51, 61, 71])
+        self.assertEqual(self.values(conn.read_register('reg', 2, 5)), [21, 31, 41])
+        self.assertEqual(self.values(conn.read_register('reg', 6)), [61, 71])
+        self.assertEqual(self.values(conn.read_register('reg', 3, 3)), [])
+        self.assertRaises(Exception, conn.read_register, 'missing')
+        # The connection is still usable after the error
+        self.assertEqual(self.values(conn.read_register('other')), [7, 0, 0, 9])
+
+    def test_parse_register(self):
+        output = 'Obtaining JSON from switch...\nDone\nRuntimeCmd: reg= 5, 0, 12\nRuntimeCmd: \n'
+        self.assertEqual(parse_register(output, 'reg'), [5, 0, 12])
+        self.assertEqual(parse_register('RuntimeCmd: empty= \n', 'empty'), [])
+        self.assertRaises(Exception, parse_register, output, 'eg')
+
+    def test_snapshot_whole(self):
+        values = snapshot(self.connect, ['s1', 's2'], ['reg', 'other'])
+        self.assertEqual(sorted(values), ['s1', 's2'])
+        for sw in ('s1', 's2'):
+            self.assertEqual(sorted(values[sw]), ['other', 'reg'])
+            self.assertEqual(self.values(values[sw]['reg']), self.servers[sw].registers['reg'])
+            self.assertEqual(self.values(values[sw]['other']), [7, 0, 0, 9])
+        self.assertEqual(len(self.conns), 2)
+        self.assertTrue(all(conn.closed for conn in self.conns))
+
+    def test_snapshot_ranges(self):
+        values = snapshot(self.connect, ['s1', 's2'], {'reg': (1, 3), 'other': (3, None)})
+        self.assertEqual(self.values(values['s1']['reg']), [11, 21])
+        self.assertEqual(self.values(values['s2']['reg']), [12, 22])
+        self.assertEqual(self.values(values['s2']['other']), [9])
+
+    def test_snapshot_kept_open(self):
+        conns = dict((sw, self.connect(sw)) for sw in self.servers)
+        snapshot(conns.get, ['s1'], ['reg'], close=False)
+        self.servers['s1'].registers['reg'][0] = 100
+        values = snapshot(conns.get, ['s1', 's2'], {'reg': (0, 1)}, close=False)
+        self.assertEqual(self.values(values['s1']['reg']), [100])
+        self.assertEqual(self.values(values['s2']['reg']), [2])
+        self.assertFalse(any(conn.closed for conn in conns.values()))
+
+    def test_snapshot_error(self):
+        try:
+            snapshot(self.connect, ['s1', 's2'], ['reg', 'missing'])
+            self.fail('no exception')
+        except Exception as e:
+            self.assertIn('s1 (', str(e))
+            self.assertIn('INVALID_REGISTER_NAME', str(e))
+        self.assertTrue(all(conn.closed for conn in self.conns))
+
+
+class TestPrograms(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = dict(('s%d' % i, FakeThriftServer(program='ab'[i % 2])) for i in range(1, 7))
+        self.loader = BulkLoader(self.connect)
+        self.conns = []
+
+    def tearDown(self):
+        for conn in self.conns:
+            conn.close()
+        for server in self.servers.values():
+            server.stop()
+        self.assertEqual(bulkload._program, dict(config=None, connections=0))
+
+    def connect(self, sw):
+        return FakeConnection('127.0.0.1', self.servers[sw].port)
+
+    def test_load(self):
+        cmds = dict((sw, [route(i) for i in range(WINDOW * 2)]) for sw in self.servers)
+        results = self.loader.load(cmds)
+        self.assertEqual(sorted(results), sorted(self.servers))
+        for sw, result in results.iteritems():
+            self.assertEqual(result['errors'], [], sw)
+            self.assertEqual(result['mismatches'], {}, sw)
+            self.assertEqual(len(self.servers[sw].tables['ipv4_lpm']), WINDOW * 2)
+        # One program after the other
+        spans = sorted((min(results[sw]['start'] for sw in group), max(results[sw]['end'] for sw in group))
+                       for group in (('s1', 's3', 's5'), ('s2', 's4', 's6')))
+        self.assertLessEqual(spans[0][1], spans[1][0])
+
+    def test_take_turns(self):
+        a, b = self.connect('s2'), self.connect('s1')
+        self.conns += [a, b]
+        self.assertEqual((a.program, b.program), ('a', 'b'))
+        a.send(route(0))
+        self.assertRaises(Exception, b.call, route(0))
+        self.assertIn('different programs', self.loader.load_switch('s3', [route(0)])['errors'][0][1])
+        a.close()
+        self.assertEqual(bulkload._program, dict(config=None, connections=0))
+        b.call(route(1))
+        self.assertEqual(bulkload._program, dict(config='b', connections=1))
+        self.assertEqual(b.flush(), [])
+        self.assertEqual(len(self.servers['s1'].tables['ipv4_lpm']), 1)
+        self.assertEqual(len(self.servers['s2'].tables['ipv4_lpm']), 1)
+
+    def test_snapshot(self):
+        for sw, server in self.servers.items():
+            server.registers['reg'] = [int(sw[1])] * 4
+        # Kept open, as AppController keeps them
+        conns = dict((sw, self.connect(sw)) for sw in self.servers)
+        self.conns += conns.values()
+        for _ in range(2):
+            values = snapshot(conns.get, sorted(self.servers), {'reg': (1, 3)}, close=False)
+            self.assertEqual(dict((sw, [int(v) for v in values[sw]['reg']]) for sw in values),
+                             dict((sw, [int(sw[1])] * 2) for sw in self.servers))
+        self.assertEqual(bulkload._program, dict(config=None, connections=0))
+        # Tables of both programs load while they are open
+        results = self.loader.load(dict((sw, [route(0)]) for sw in self.servers))
+        self.assertFalse(any(r['errors'] or r['mismatches'] for r in results.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
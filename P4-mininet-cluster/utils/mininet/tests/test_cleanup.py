@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import clean
+from cluster import CLEANUP_STATE, ClusterCleanup
+
+
+class TestCleanupState(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, CLEANUP_STATE)
+        self.saved = (ClusterCleanup.stateFile, dict(ClusterCleanup.serveruser))
+        self.reset()
+
+    def tearDown(self):
+        self.reset()
+        ClusterCleanup.stateFile, ClusterCleanup.serveruser = self.saved
+        shutil.rmtree(self.dir)
+
+    def reset(self):
+        ClusterCleanup.stateFile = None
+        ClusterCleanup.serveruser = {}
+        for values in ClusterCleanup.experiment.values():
+            values.clear()
+
+    def record(self):
+        ClusterCleanup.stateFile = self.path
+        ClusterCleanup.add('localhost', 'mn')
+        ClusterCleanup.add('server2', 'mn')
+        ClusterCleanup.track(nodes=['s1'], thriftPorts=[9090], deviceIds=[0])
+        ClusterCleanup.track(nodes=['s7'], thriftPorts=[9731], deviceIds=[12])
+        ClusterCleanup.track(taps=[9])
+        ClusterCleanup.track(taps=[14])
+        ClusterCleanup.track(nodes=['h1', 's1', 's7'])
+
+    def test_written_as_tracked(self):
+        self.record()
+        with open(self.path) as f:
+            state = json.load(f)
+        self.assertEqual(state, {
+            'servers': {'localhost': 'mn', 'server2': 'mn'},
+            'experiment': {'nodes': ['h1', 's1', 's7'], 'thriftPorts': [9090, 9731],
+                           'deviceIds': [0, 12], 'taps': [9, 14]}})
+
+    def test_load(self):
+        self.record()
+        self.reset()
+        self.assertTrue(ClusterCleanup.load(self.path))
+        self.assertEqual(ClusterCleanup.serveruser, {'localhost': 'mn', 'server2': 'mn'})
+        cmd = ClusterCleanup.cleanupCmd()
+        # Exactly what was recorded, not ranges around it
+        self.assertIn("'--thrift-port (9090|9731)( |$)'", cmd)
+        self.assertIn("'mininet:(h1|s1|s7)$'", cmd)
+        self.assertIn("'Tunnel=Ethernet -w (9:9|14:14) '", cmd)
+        self.assertIn('tap(9|14)', cmd)
+        self.assertIn('/tmp/bm-12-log.ipc', cmd)
+        self.assertNotIn('/tmp/bm-1-log.ipc', cmd)
+
+    def test_forget(self):
+        self.record()
+        ClusterCleanup.forget()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(any(ClusterCleanup.experiment.values()))
+
+    def test_clean_without_state(self):
+        argv = sys.argv
+        sys.argv = ['clean.py', '--state', self.path]
+        try:
+            self.assertEqual(clean.main(), 0)
+        finally:
+            sys.argv = argv
+        self.assertFalse(ClusterCleanup.load(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
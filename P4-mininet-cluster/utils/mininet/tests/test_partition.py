@@ -0,0 +1,132 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mininet.log import setLogLevel
+
+import cluster
+from cluster import PartitionPlacer, RoundRobinPlacer
+
+
+def two_clusters(size=6):
+    """Two cliques of switches joined by a single link, with a host on
+    every switch
+    returns: (switches, hosts, links)"""
+    switches = ['s%d' % i for i in range(1, 2 * size + 1)]
+    links = []
+    for group in switches[:size], switches[size:]:
+        links += [(a, b) for i, a in enumerate(group) for b in group[i + 1:]]
+    links.append((switches[size - 1], switches[size]))
+    hosts = ['h%d' % i for i in range(1, 2 * size + 1)]
+    links += zip(hosts, switches)
+    return switches, hosts, links
+
+
+def cut(placer, links, switches):
+    return len([(a, b) for a, b in links if a in switches and b in switches
+                and placer.place(a) != placer.place(b)])
+
+
+def counts(placer, nodes):
+    result = {}
+    for node in nodes:
+        server = placer.place(node)
+        result[server] = result.get(server, 0) + 1
+    return result
+
+
+class TestPartitionPlacer(unittest.TestCase):
+
+    def setUp(self):
+        setLogLevel('error')
+
+    def test_fewer_cut_links(self):
+        switches, hosts, links = two_clusters()
+        args = dict(servers=['a', 'b'], nodes=switches + hosts, hosts=hosts,
+                    switches=switches, links=links)
+        placer = PartitionPlacer(**args)
+        self.assertEqual(cut(placer, links, switches), 1)
+        self.assertEqual(counts(placer, switches), {'a': 6, 'b': 6})
+        self.assertLess(cut(placer, links, switches), cut(RoundRobinPlacer(**args), links, switches))
+
+    def test_hosts_with_their_switches(self):
+        switches, hosts, links = two_clusters()
+        placer = PartitionPlacer(servers=['a', 'b'], hosts=hosts, switches=switches, links=links)
+        for h, sw in zip(hosts, switches):
+            self.assertEqual(placer.place(h), placer.place(sw))
+
+    def test_relative_capacities(self):
+        switches, hosts, links = two_clusters()
+        placer = PartitionPlacer(servers=['a', 'b'], hosts=hosts, switches=switches, links=links,
+                                 capacities={'a': 1, 'b': 3})
+        # 3 and 9 switches, give or take the allowed imbalance
+        n = counts(placer, switches)
+        self.assertTrue(2 <= n['a'] <= 4, n)
+        self.assertEqual(n['a'] + n['b'], 12)
+
+    def test_absolute_capacities(self):
+        switches, hosts, links = two_clusters()
+        costs = dict((sw, {'cores': 1.0}) for sw in switches)
+        costs.update((h, {'cores': 0.0}) for h in hosts)
+        placer = PartitionPlacer(servers=['a', 'b'], hosts=hosts, switches=switches, links=links,
+                                 costs=costs, capacities={'a': {'cores': 4.0}, 'b': {'cores': 16.0}})
+        n = counts(placer, switches)
+        self.assertLessEqual(n['a'], 4)
+        self.assertEqual(n['a'] + n['b'], 12)
+
+    def test_traffic(self):
+        # A ring of 8 switches split in two: the cut avoids the busy links
+        switches = ['s%d' % i for i in range(1, 9)]
+        links = [(switches[i], switches[(i + 1) % 8]) for i in range(8)]
+        busy = [('s1', 's2'), ('s5', 's6')]
+        placer = PartitionPlacer(servers=['a', 'b'], switches=switches, links=links,
+                                 traffic=dict((l, 1000.0) for l in busy))
+        for a, b in busy:
+            self.assertEqual(placer.place(a), placer.place(b))
+        self.assertEqual(cut(placer, links, switches), 2)
+
+
+class TestLoadWarnings(unittest.TestCase):
+
+    def setUp(self):
+        self.warnings = []
+        self.warn, cluster.warn = cluster.warn, self.warnings.append
+
+    def tearDown(self):
+        cluster.warn = self.warn
+
+    def place(self, servers, cost, n, utilization=1.0):
+        switches, hosts, links = two_clusters(n / 2)
+        costs = dict((sw, {'cores': cost}) for sw in switches)
+        return PartitionPlacer(servers=sorted(servers), hosts=hosts, switches=switches, links=links,
+                               costs=costs, capacities=servers, utilization=utilization)
+
+    def test_lightly_loaded(self):
+        # Parts beyond their balanced share, far within capacity
+        self.place(dict((s, {'cores': 4.0}) for s in 'abcd'), 0.11, 10)
+        self.assertEqual(self.warnings, [])
+
+    def test_past_capacity(self):
+        # Two 3-core switches fit in the cluster, but not on one server
+        placer = self.place({'a': {'cores': 4.0}, 'b': {'cores': 4.0}, 'c': {'cores': 4.0}}, 3.0, 4)
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn('past 100% of its capacity: cores 6.00/4.00', self.warnings[0])
+        self.assertEqual(max(counts(placer, placer.switches).values()), 2)
+
+    def test_past_utilization(self):
+        # 2.8 of the 3 cores to use fit in the cluster; one switch too many
+        # for either server
+        self.place({'a': {'cores': 4.0}, 'b': {'cores': 2.0}}, 0.7, 4, utilization=0.5)
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn('past 50% of its capacity', self.warnings[0])
+
+    def test_cluster_too_small(self):
+        # Left to placement.check_capacity()
+        self.place({'a': {'cores': 4.0}, 'b': {'cores': 4.0}}, 3.0, 4)
+        self.assertEqual(self.warnings, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
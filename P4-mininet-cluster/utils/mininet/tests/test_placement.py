@@ -0,0 +1,96 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mininet.log import setLogLevel
+from mininet.topo import Topo
+
+import placement
+from cluster import CoreAllocator, parseCpus
+
+
+class TestParseCpus(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(parseCpus('0-2,5'), [0, 1, 2, 5])
+        self.assertEqual(parseCpus('0-1,4-5\n'), [0, 1, 4, 5])
+        self.assertEqual(parseCpus('7'), [7])
+        self.assertEqual(parseCpus(''), [])
+
+
+class TestCoreAllocator(unittest.TestCase):
+
+    def check_disjoint(self, m, cpus):
+        switch_cores = [c for cores in m['switches'].values() for c in cores]
+        if not m['shared']:
+            self.assertEqual(len(switch_cores), len(set(switch_cores)))
+        groups = [set(m['reserved']), set(m['hosts']), set(switch_cores)]
+        for i, a in enumerate(groups):
+            for b in groups[i + 1:]:
+                self.assertFalse(a & b)
+        self.assertTrue(set.union(*groups) <= set(cpus))
+
+    def test_dedicated(self):
+        cpus = parseCpus('0-7')
+        m = CoreAllocator().allocate(cpus, [('s2', 2), ('s1', None), ('s3', None)])
+        self.assertEqual(m['reserved'], [0])
+        self.assertEqual(m['switches'], {'s1': [1], 's2': [2, 3], 's3': [4]})
+        self.assertEqual(m['hosts'], [5, 6, 7])
+        self.assertFalse(m['shared'])
+        self.check_disjoint(m, cpus)
+
+    def test_shared(self):
+        cpus = range(4)
+        switches = [('s%d' % i, None) for i in range(1, 6)]
+        m = CoreAllocator(reserved=1, hostCores=1).allocate(cpus, switches)
+        self.assertTrue(m['shared'])
+        self.assertEqual(m['hosts'], [3])
+        # The switches take turns on the cores between
+        self.assertEqual([m['switches'][sw][0] for sw, _ in switches], [1, 2, 1, 2, 1])
+        self.check_disjoint(m, cpus)
+
+    def test_too_small(self):
+        self.assertIsNone(CoreAllocator().allocate([0, 1], [('s1', None)]))
+        self.assertIsNone(CoreAllocator().allocate(range(8), []))
+
+
+class TestCosts(unittest.TestCase):
+
+    def setUp(self):
+        setLogLevel('error')
+        self.topo = Topo()
+        for sw in 's1', 's2':
+            self.topo.addSwitch(sw)
+        self.topo.addLink('s1', 's2')
+        for h, sw in ('h1', 's1'), ('h2', 's2'):
+            self.topo.addHost(h)
+            self.topo.addLink(h, sw)
+
+    def test_node_costs(self):
+        conf = {'hosts': {'h1': {'cmd': 'run'}}}
+        model = dict(placement.BMV2_COST, port_pps=0)
+        idle = placement.node_costs(conf, self.topo, model=model)
+        self.assertAlmostEqual(idle['s1']['cores'], model['idle_cores'])
+        self.assertEqual(idle['h1']['cores'], model['workload_cores'])
+        self.assertEqual(idle['h2']['cores'], model['host_cores'])
+        self.assertEqual(idle['s1']['memory'], model['memory'])
+        busy = placement.node_costs(conf, self.topo, {('h1', 'h2'): 1000.0}, model)
+        # Traffic from h1 to h2 goes through both switches
+        extra = model['host_pps'] / float(model['pps_per_core'])
+        for sw in 's1', 's2':
+            self.assertAlmostEqual(busy[sw]['cores'], model['idle_cores'] + extra)
+
+    def test_check_capacity(self):
+        costs = {'s1': {'cores': 3.0, 'memory': 100}, 's2': {'cores': 3.0, 'memory': 100}}
+        self.assertTrue(placement.check_capacity(costs, {'a': {'cores': 4}, 'b': {'cores': 4}}, ['a', 'b']))
+        self.assertFalse(placement.check_capacity(costs, {'a': {'cores': 4}, 'b': {'cores': 3}}, ['a', 'b']))
+        # Resources are only checked when every server's is known
+        self.assertTrue(placement.check_capacity(costs, {'a': {'cores': 1}}, ['a', 'b']))
+        self.assertFalse(placement.check_capacity(costs, {'a': {'memory': 100}, 'b': {'memory': 100}},
+                                                  ['a', 'b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import supervisor
+
+# Short grace periods, to keep the tests quick
+ESCALATION = (('INT', 0.4), ('TERM', 0.4), ('KILL', 0.4))
+
+
+def workload(ignore):
+    """A shell running sleep as its child, the way a host's workload runs,
+    with the signals in ignore ignored by the child"""
+    trap = "trap '' %s; " % ' '.join(ignore) if ignore else ''
+    return subprocess.Popen(['sh', '-c', trap + 'sleep 30; true'], stderr=open(os.devnull, 'w'))
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sup = supervisor.Supervisor(escalation=ESCALATION, interval=0.02)
+
+    def tearDown(self):
+        for entry in self.sup.procs.values():
+            if entry['proc'].poll() is None:
+                entry['proc'].kill()
+                entry['proc'].wait()
+        shutil.rmtree(self.dir)
+
+    def run_to_end(self, name, ignore, timeout=0.3):
+        start = time()
+        self.sup.add(name, workload(ignore), timeout=timeout, start=start)
+        self.sup.wait([name])
+        return time() - start
+
+    def test_exits(self):
+        self.sup.add('h1', subprocess.Popen(['true']), timeout=5)
+        self.sup.wait()
+        r = self.sup.results()['h1']
+        self.assertEqual((r['status'], r['returncode'], r['signals']), ('exited', 0, []))
+
+    def test_int(self):
+        elapsed = self.run_to_end('h1', [])
+        r = self.sup.results()['h1']
+        self.assertEqual((r['status'], r['signals']), ('timeout', ['INT']))
+        self.assertTrue(0.3 <= elapsed < 0.3 + 0.4, elapsed)
+
+    def test_int_ignored(self):
+        elapsed = self.run_to_end('h1', ['INT'])
+        r = self.sup.results()['h1']
+        self.assertEqual((r['status'], r['signals']), ('timeout', ['INT', 'TERM']))
+        # SIGTERM comes after the grace period of SIGINT
+        self.assertTrue(0.3 + 0.4 <= elapsed < 0.3 + 0.8, elapsed)
+
+    def test_escalates_to_kill(self):
+        elapsed = self.run_to_end('h1', ['INT', 'TERM'])
+        r = self.sup.results()['h1']
+        self.assertEqual((r['status'], r['signals']), ('timeout', ['INT', 'TERM', 'KILL']))
+        self.assertEqual(r['returncode'], -9)
+        self.assertTrue(0.3 + 0.8 <= elapsed < 0.3 + 1.2, elapsed)
+        self.assertAlmostEqual(r['duration'], elapsed, delta=0.1)
+
+    def test_stop_in_parallel(self):
+        start = time()
+        for name in ('h1', 'h2', 'h3'):
+            self.sup.add(name, workload(['INT']), start=start)
+        done = subprocess.Popen(['true'])
+        # Exited before stop(), which would otherwise race it
+        done.wait()
+        self.sup.add('h4', done, start=start)
+        self.sup.stop()
+        elapsed = time() - start
+        # Every process goes through INT and TERM at the same time
+        self.assertLess(elapsed, 0.4 + 0.4)
+        results = self.sup.results()
+        for name in ('h1', 'h2', 'h3'):
+            self.assertEqual((results[name]['status'], results[name]['signals']), ('stopped', ['INT', 'TERM']))
+        self.assertEqual(results['h4']['status'], 'exited')
+
+        path = supervisor.writeStatus(results, os.path.join(self.dir, 'host_status.json'))
+        with open(path) as f:
+            status = json.load(f)
+        self.assertEqual(sorted(status), ['h1', 'h2', 'h3', 'h4'])
+        self.assertEqual(status['h1']['signals'], ['INT', 'TERM'])
+        self.assertEqual(sorted(status['h1']), ['duration', 'returncode', 'signals', 'status'])
+        self.assertIn('h1       ', supervisor.statusReport(results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import cluster
+from cluster import ClusterCleanup, KernelTunnel, RemoteLink
+
+
+class FakeNode(object):
+    "The parts of a RemoteNode that making a tunnel uses, recording commands"
+
+    def __init__(self, name, server, serverIP, src, mtu=1550, route=''):
+        """mtu: MTU of its server's interface to the other server
+        route: what ip route get adds to the route, like a path MTU"""
+        self.name = name
+        self.server = server
+        self.serverIP = serverIP
+        self.src = src
+        self.mtu = mtu
+        self.route = route
+        self.pid = 100
+        self.user = 'mn'
+        self.cmds = []
+        self.intfs = set()
+
+    def rcmd(self, cmd):
+        self.cmds.append(cmd)
+        if cmd.startswith('ip route get'):
+            return '%s via 10.0.0.254 dev eth0 src %s uid 0\n    cache %s\n' % (cmd.split()[-1], self.src, self.route)
+        if cmd == 'cat /sys/class/net/eth0/mtu':
+            return '%d\n' % self.mtu
+        if cmd.startswith('ip link set') and ' netns ' in cmd:
+            self.intfs.add(cmd.split()[3])
+        return ''
+
+    def cmd(self, *args):
+        cmd = ' '.join(args)
+        self.cmds.append(cmd)
+        if cmd == 'ip link show':
+            return ''.join('2: %s: <BROADCAST>\n' % intf for intf in self.intfs)
+        return ''
+
+    def __str__(self):
+        return self.name
+
+
+def make_link(kind):
+    "A RemoteLink that only makes tunnels"
+    link = RemoteLink.__new__(RemoteLink)
+    link.tunnelType = kind
+    link.cmd = None
+    return link
+
+
+class TestKernelTunnelCmd(unittest.TestCase):
+
+    def test_vxlan(self):
+        self.assertEqual(RemoteLink.kernelTunnelCmd('vxlan', 'tap12', 12, '192.168.0.1', '192.168.0.2'),
+                         'ip link add tap12 mtu 1500 type vxlan id 12 local 192.168.0.1 remote 192.168.0.2 '
+                         'dstport 4789')
+
+    def test_gretap(self):
+        self.assertEqual(RemoteLink.kernelTunnelCmd('gretap', 'tap12', 12, '192.168.0.1', '192.168.0.2'),
+                         'ip link add tap12 mtu 1500 type gretap local 192.168.0.1 remote 192.168.0.2 key 12')
+
+    def test_unknown(self):
+        self.assertRaises(Exception, RemoteLink.kernelTunnelCmd, 'ipip', 'tap12', 12, 'a', 'b')
+
+
+class TestMakeKernelTunnel(unittest.TestCase):
+
+    def setUp(self):
+        self.rcmdAll = cluster.rcmdAll
+        self.sent = []
+        self.results = None
+
+        def rcmdAll(cmds, timeout=None):
+            self.sent.append(cmds)
+            return self.results or [''] * len(cmds)
+        cluster.rcmdAll = rcmdAll
+        RemoteLink.underlays = {}
+        self.node1 = FakeNode('h1', 'localhost', '192.168.0.1', '192.168.0.1')
+        self.node2 = FakeNode('s2', 'server2', '192.168.0.2', '192.168.0.2')
+
+    def tearDown(self):
+        cluster.rcmdAll = self.rcmdAll
+        RemoteLink.underlays = {}
+
+    def test_both_ends(self):
+        link = make_link('vxlan')
+        tunnel = link.makeKernelTunnel(self.node1, self.node2, 'tap20', 20)
+        self.assertIsInstance(tunnel, KernelTunnel)
+        self.assertEqual((tunnel.kind, tunnel.index, tunnel.poll()), ('vxlan', 20, None))
+        # Each end is local to its own server and remote to the other,
+        # with the same VNI, created at the same time
+        self.assertEqual(self.sent, [[
+            (self.node1, 'ip link add tap20 mtu 1500 type vxlan id 20 local 192.168.0.1 remote 192.168.0.2 '
+                         'dstport 4789'),
+            (self.node2, 'ip link add tap20 mtu 1500 type vxlan id 20 local 192.168.0.2 remote 192.168.0.1 '
+                         'dstport 4789')]])
+        self.assertEqual(self.node1.cmds, ['ip route get 192.168.0.2', 'cat /sys/class/net/eth0/mtu'])
+        self.assertEqual(self.node2.cmds, ['ip route get 192.168.0.1', 'cat /sys/class/net/eth0/mtu'])
+        # The underlay is only looked up for the first tunnel between two servers
+        link.makeKernelTunnel(self.node1, self.node2, 'tap21', 21)
+        self.assertEqual(len(self.node1.cmds) + len(self.node2.cmds), 4)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_underlay_mtu(self):
+        # Enough for VXLAN's 50 bytes of headers on 1500-byte frames, not
+        # for GRETAP's 42 on one side
+        self.node1.mtu = 1550
+        self.node2.mtu = 1545
+        self.assertRaises(Exception, make_link('vxlan').makeKernelTunnel, self.node1, self.node2, 'tap22', 22)
+        make_link('gretap').makeKernelTunnel(self.node1, self.node2, 'tap23', 23)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_underlay_too_small(self):
+        self.node2.mtu = 1500
+        try:
+            make_link('gretap').makeKernelTunnel(self.node1, self.node2, 'tap24', 24)
+            self.fail('no exception')
+        except Exception as e:
+            self.assertIn('MTU of 1542', str(e))
+            self.assertIn('server2 reaches 192.168.0.1 with 1500', str(e))
+        self.assertEqual(self.sent, [])
+
+    def test_path_mtu(self):
+        # A path MTU the server learned takes precedence
+        self.node1.route = 'expires 598sec mtu 1400'
+        self.assertRaises(Exception, make_link('vxlan').makeKernelTunnel, self.node1, self.node2, 'tap25', 25)
+        self.assertNotIn('cat /sys/class/net/eth0/mtu', self.node1.cmds)
+
+    def test_error(self):
+        self.results = ['', 'RTNETLINK answers: File exists']
+        link = make_link('gretap')
+        self.assertRaises(Exception, link.makeKernelTunnel, self.node1, self.node2, 'tap21', 21)
+
+    def test_make_tunnel(self):
+        link = make_link('gretap')
+        tracked = set(ClusterCleanup.experiment['taps'])
+        link.makeTunnel(self.node1, self.node2, 'h1-eth0', 's2-eth3', addr1='00:00:00:00:00:01')
+        index = int(self.sent[0][0][1].split()[3][3:])
+        self.assertEqual(ClusterCleanup.experiment['taps'] - tracked, set([index]))
+        tap = 'tap%d' % index
+        self.assertIn('ip link set %s netns 100' % tap, self.node1.cmds)
+        self.assertIn('ip link set %s name h1-eth0 address 00:00:00:00:00:01' % tap, self.node1.cmds)
+        self.assertIn('ip link set %s name s2-eth3' % tap, self.node2.cmds)
+
+
+class TestTapIndex(unittest.TestCase):
+
+    def test_unique_across_threads(self):
+        indices = []
+
+        def take():
+            for _ in range(500):
+                indices.append(next(RemoteLink.tapIndex))
+        threads = [threading.Thread(target=take) for _ in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(len(set(indices)), 8 * 500)
+        self.assertTrue(min(indices) >= 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
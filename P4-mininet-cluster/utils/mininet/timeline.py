@@ -0,0 +1,89 @@
+"""
+timeline.py: wall-clock instrumentation for emulation runs
+
+Phases (compile, network start, table loading, ...) and per-node steps
+(switch startup, tunnel creation, ...) are recorded as events with a start
+and end time. The events of all processes taking part in a run are merged
+into a single JSON file (TIMELINE_FILE in the log directory); a parent
+process hands its events to the next one through the P4APP_TIMELINE
+environment variable.
+
+    { "events": [ { "name": ..., "kind": "phase" | "node" | "link",
+                    "start": ..., "end": ..., "duration": ...,
+                    "pid": ..., "load": ... }, ... ] }
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+TIMELINE_FILE = 'timeline.json'
+
+_events = []
+_lock = threading.Lock()
+
+
+def record( name, start, end, kind='phase', **extra ):
+    "Record an event that ran from start to end (seconds since the epoch)"
+    event = dict( name=name, kind=kind, start=start, end=end,
+                  duration=end - start, pid=os.getpid() )
+    if kind == 'phase':
+        event[ 'load' ] = os.getloadavg()[ 0 ]
+    event.update( extra )
+    with _lock:
+        _events.append( event )
+    return event
+
+
+@contextmanager
+def timed( name, kind='phase', **extra ):
+    "Context manager recording the wall-clock time spent in its body"
+    start = time.time()
+    try:
+        yield
+    finally:
+        record( name, start, time.time(), kind=kind, **extra )
+
+
+def events():
+    "Return a copy of the events recorded so far"
+    with _lock:
+        return list( _events )
+
+
+def load( path ):
+    "Merge events saved by an earlier process of this run"
+    if not os.path.isfile( path ):
+        return
+    with open( path, 'r' ) as f:
+        saved = json.load( f ).get( 'events', [] )
+    with _lock:
+        _events[ 0:0 ] = saved
+
+
+def save( path ):
+    "Write all recorded events, sorted by start time, to path"
+    with open( path, 'w' ) as f:
+        json.dump( { 'events': sorted( events(), key=lambda e: e[ 'start' ] ) },
+                   f, indent=2 )
+    return path
+
+
+def summary( top=5 ):
+    "Return a printable summary of phases and the slowest nodes and links"
+    evs = events()
+    lines = [ '*** Timeline summary' ]
+    for e in sorted( [ e for e in evs if e[ 'kind' ] == 'phase' ],
+                     key=lambda e: e[ 'start' ] ):
+        lines.append( '  %-32s %8.2fs' % ( e[ 'name' ], e[ 'duration' ] ) )
+    for kind, title in ( ( 'node', 'nodes' ), ( 'link', 'links' ) ):
+        slowest = sorted( [ e for e in evs if e[ 'kind' ] == kind ],
+                          key=lambda e: e[ 'duration' ], reverse=True )[ :top ]
+        if not slowest:
+            continue
+        lines.append( '*** Slowest %s' % title )
+        for e in slowest:
+            lines.append( '  %-32s %8.2fs' % ( e[ 'name' ], e[ 'duration' ] ) )
+    return '\n'.join( lines )
@@ -17,10 +17,18 @@ from __future__ import print_function
 
 import argparse
 from collections import OrderedDict
+import hashlib
 import json
+import multiprocessing
 import os
+import re
+import shutil
+import signal
+import subprocess
 import sys
 import tarfile
+import tempfile
+import time
 
 parser = argparse.ArgumentParser(description='p4apprunner')
 parser.add_argument('--build-dir', help='Directory to build in.',
@@ -29,13 +37,35 @@ parser.add_argument('--quiet', help='Suppress log messages.',
                     action='store_true', required=False, default=False)
 parser.add_argument('--manifest', help='Path to manifest file.',
                     type=str, action='store', required=False, default='./p4app.json')
-parser.add_argument('app', help='.p4app package to run.', type=str)
+parser.add_argument('--jobs', '-j', help=('Number of P4 programs to compile in '
+                                          'parallel. Defaults to the number of cores.'),
+                    type=int, action='store', required=False,
+                    default=multiprocessing.cpu_count())
+parser.add_argument('--compile-cache', help='Directory of the persistent compile cache.',
+                    type=str, action='store', required=False,
+                    default=os.path.expanduser('~/.p4apprunner/compile-cache'))
+parser.add_argument('--compile-cache-size', help='Size limit of the compile cache in MB.',
+                    type=int, action='store', required=False, default=512)
+parser.add_argument('--no-compile-cache', help='Always recompile, bypassing the compile cache.',
+                    action='store_true', required=False, default=False)
+parser.add_argument('--plan', help=('Only plan the cluster placement of the target and '
+                                     'report per-server resource usage.'),
+                    action='store_true', required=False, default=False)
+parser.add_argument('--cleanup', help=('Only remove what runs of the target left on its '
+                                        'servers, on all servers at once.'),
+                    action='store_true', required=False, default=False)
+parser.add_argument('app', help=('.p4app package to run, or an app directory to '
+                                  'sync into the build directory incrementally.'),
+                    type=str)
 parser.add_argument('target', help=('Target to run. Defaults to the first target '
                                     'in the package.'),
                     nargs='?', type=str)
 
 args = parser.parse_args()
 
+sys.path.append(os.path.join(sys.path[0], 'mininet'))
+import timeline
+
 def log(*items):
     if args.quiet != True:
         print(*items)
@@ -53,6 +83,189 @@ class Manifest:
         self.target = target
         self.target_config = target_config
 
+_include_regex = re.compile(r'^\s*#\s*include\s+"([^"]+)"', re.MULTILINE)
+
+def _hash_source(digest, p4file, seen):
+    p4file = os.path.abspath(p4file)
+    if p4file in seen or not os.path.isfile(p4file):
+        return
+    seen.add(p4file)
+    with open(p4file, 'rb') as f:
+        source = f.read()
+    digest.update(source)
+    for include in _include_regex.findall(source):
+        _hash_source(digest, os.path.join(os.path.dirname(p4file), include), seen)
+
+def source_digest(p4file):
+    """Hash of a P4 program's contents, including local #include files but
+    not its file name"""
+    digest = hashlib.sha1()
+    _hash_source(digest, p4file, set())
+    return digest.hexdigest()
+
+class CompileCache:
+    """Content-addressed store of compiled programs. Entries are keyed by a
+    hash of the P4 source (plus local #include files), the compiler version
+    and the compiler arguments, and evicted least-recently-used first once
+    the cache grows beyond max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        try:
+            self.compiler_version = subprocess.check_output(
+                ['p4c-bm2-ss', '--version'], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            self.compiler_version = ''
+
+    def key(self, p4file, compiler_args):
+        digest = hashlib.sha1()
+        digest.update(self.compiler_version)
+        digest.update('\0'.join(compiler_args))
+        digest.update(source_digest(p4file))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.p4.json')
+
+    def fetch(self, key, output_file):
+        """Copy a cached program to output_file. Returns False on a miss."""
+        cached = self.path(key)
+        if not os.path.isfile(cached):
+            return False
+        shutil.copyfile(cached, output_file)
+        os.utime(cached, None)
+        return True
+
+    def store(self, key, output_file):
+        # Write to a temporary name first so that concurrent runs never see
+        # a partially copied entry.
+        tmp_file = '%s.%d.tmp' % (self.path(key), os.getpid())
+        shutil.copyfile(output_file, tmp_file)
+        os.rename(tmp_file, self.path(key))
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.p4.json') and os.path.isfile(path):
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+# Name of the file, kept in the build directory, that records what has
+# already been unpacked there by a previous run.
+PACKAGE_STATE_FILE = '.p4app-state.json'
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_package_state():
+    if not os.path.isfile(PACKAGE_STATE_FILE):
+        return {}
+    with open(PACKAGE_STATE_FILE, 'r') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+def save_package_state(state):
+    with open(PACKAGE_STATE_FILE + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(PACKAGE_STATE_FILE + '.tmp', PACKAGE_STATE_FILE)
+
+def sync_app_dir(app_dir):
+    """Mirror app_dir into the current (build) directory, copying only files
+    whose content hash changed since the last sync. Size and mtime are
+    checked first so unchanged files are not even re-hashed."""
+    old_state = load_package_state()
+    state = {}
+    build_dir = os.path.realpath(os.getcwd())
+    copied = 0
+    for root, dirs, files in os.walk(app_dir):
+        dirs[:] = [d for d in dirs
+                   if os.path.realpath(os.path.join(root, d)) != build_dir]
+        for name in files:
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, app_dir)
+            st = os.stat(src)
+            prev = old_state.get(rel)
+            if prev and prev['size'] == st.st_size and prev['mtime'] == st.st_mtime \
+                    and os.path.exists(rel):
+                state[rel] = prev
+                continue
+            sha1 = file_digest(src)
+            if not (prev and prev.get('sha1') == sha1 and os.path.exists(rel)):
+                if os.path.dirname(rel) and not os.path.isdir(os.path.dirname(rel)):
+                    os.makedirs(os.path.dirname(rel))
+                shutil.copy2(src, rel)
+                copied += 1
+            state[rel] = dict(size=st.st_size, mtime=st.st_mtime, sha1=sha1)
+
+    removed = 0
+    for rel in old_state:
+        if rel not in state and os.path.isfile(rel):
+            os.remove(rel)
+            removed += 1
+
+    save_package_state(state)
+    log('Synced app directory: %d of %d files updated, %d removed.'
+        % (copied, len(state), removed))
+
+# Members of a .p4app archive up to this size are held in memory while they
+# are hashed; larger ones are spooled to a temporary file.
+SPOOL_BYTES = 16 * 1024 * 1024
+
+def extract_changed(app):
+    """Extract only the members of a .p4app archive whose content changed
+    since a previous run extracted them. Each member is read once, in
+    archive order, and hashed; it is written out only if its SHA-1 differs
+    from the one recorded in the state file or the file is missing."""
+    old_state = load_package_state()
+    state = {}
+    extracted = 0
+    tar = tarfile.open(app)
+    for member in tar:
+        if not member.isfile():
+            if member.isdir() and not os.path.isdir(member.name):
+                tar.extract(member)
+            continue
+        digest = hashlib.sha1()
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        data = tar.extractfile(member)
+        for block in iter(lambda: data.read(1 << 20), ''):
+            digest.update(block)
+            spool.write(block)
+        state[member.name] = dict(size=member.size, sha1=digest.hexdigest())
+        prev = old_state.get(member.name)
+        if prev and prev.get('sha1') == state[member.name]['sha1'] \
+                and os.path.isfile(member.name):
+            spool.close()
+            continue
+        if os.path.dirname(member.name) and not os.path.isdir(os.path.dirname(member.name)):
+            os.makedirs(os.path.dirname(member.name))
+        spool.seek(0)
+        with open(member.name, 'wb') as f:
+            shutil.copyfileobj(spool, f)
+        spool.close()
+        os.chmod(member.name, member.mode)
+        os.utime(member.name, (member.mtime, member.mtime))
+        extracted += 1
+    tar.close()
+    save_package_state(state)
+    log('Extracted %d of %d files.' % (extracted, len(state)))
+
 def read_manifest(manifest_file):
     manifest = json.load(manifest_file, object_pairs_hook=OrderedDict)
 
@@ -113,30 +326,109 @@ def run_compile_bmv2(manifest):
         log_error('configs should be a dictionary')
         sys.exit(1)
 
-    # Compile the programs.
+    # Compile the programs. Switches whose programs have identical contents
+    # (e.g. all core switches of a fat-tree) share a single compiled JSON.
     outputs = []
-    for switch, p4file  in file_map.iteritems():
-        output_file = p4file + '.json'
-        outputs.append( (switch, output_file) )
-        args = list(compiler_args)
-        args.append('"%s"' % p4file)
-        args.append('-o "%s"' % output_file)
-        rv = run_command('p4c-bm2-ss %s' % ' '.join(args))
-
-        if 'run-after-compile' in manifest.target_config:
-            commands = manifest.target_config['run-after-compile']
-            if not isinstance(commands, list):
-                log_error('run-after-compile should be a list:', commands)
-                sys.exit(1)
-            for command in commands:
-                run_command(command)
-
-        if rv != 0:
-            log_error('Compile failed for: ' + output_file)
+    programs = []
+    shared_outputs = {}
+    for switch, p4file in file_map.iteritems():
+        if not os.path.isfile(p4file):
+            log_error('P4 program not found for %s: %s' % (switch, p4file))
             sys.exit(1)
+        digest = source_digest(p4file)
+        if digest not in shared_outputs:
+            shared_outputs[digest] = p4file + '.json'
+            programs.append( (p4file, shared_outputs[digest]) )
+        outputs.append( (switch, shared_outputs[digest]) )
+    log('Found %d unique programs for %d switches.' % (len(programs), len(outputs)))
+
+    with timeline.timed('compile'):
+        compile_programs(manifest, programs, compiler_args)
 
     return outputs
 
+def start_compile(p4file, output_file, compiler_args):
+    """Spawn p4c-bm2-ss for one program. The compiler output goes to
+    <output_file>.log instead of the console so that parallel compiles
+    don't interleave."""
+    command = 'p4c-bm2-ss %s "%s" -o "%s"' % (' '.join(compiler_args), p4file, output_file)
+    log('>', command)
+    log_file = open(output_file + '.log', 'w')
+    proc = subprocess.Popen(command, shell=True, stdout=log_file,
+                            stderr=subprocess.STDOUT, preexec_fn=os.setpgrp)
+    return proc, log_file
+
+def run_after_compile(manifest):
+    """Run the target's run-after-compile commands, after each program is
+    compiled or fetched from the compile cache."""
+    if 'run-after-compile' not in manifest.target_config:
+        return
+    commands = manifest.target_config['run-after-compile']
+    if not isinstance(commands, list):
+        log_error('run-after-compile should be a list:', commands)
+        sys.exit(1)
+    for command in commands:
+        run_command(command)
+
+def compile_programs(manifest, programs, compiler_args):
+    """Compile (p4file, output_file) pairs on a pool of at most args.jobs
+    compiler processes. Programs found in the compile cache are copied
+    instead of compiled. Stops all outstanding compiles and exits as soon as
+    one of them fails."""
+    cache = None
+    if not args.no_compile_cache:
+        cache = CompileCache(args.compile_cache, args.compile_cache_size * 1024 * 1024)
+
+    jobs = max(args.jobs, 1)
+    pending = []
+    keys = {}
+    for p4file, output_file in programs:
+        if cache:
+            keys[output_file] = cache.key(p4file, compiler_args)
+            if cache.fetch(keys[output_file], output_file):
+                log('Compile cache hit:', p4file)
+                run_after_compile(manifest)
+                continue
+        pending.append((p4file, output_file))
+
+    running = []
+    while pending or running:
+        while pending and len(running) < jobs:
+            p4file, output_file = pending.pop(0)
+            proc, log_file = start_compile(p4file, output_file, compiler_args)
+            running.append((p4file, output_file, proc, log_file, time.time()))
+
+        finished = [r for r in running if r[2].poll() is not None]
+        if not finished:
+            time.sleep(0.05)
+            continue
+
+        for r in finished:
+            running.remove(r)
+            p4file, output_file, proc, log_file, start = r
+            log_file.close()
+            timeline.record(p4file, start, time.time(), kind='compile')
+
+            run_after_compile(manifest)
+
+            if proc.returncode != 0:
+                for _, _, other, other_log, _ in running:
+                    if other.poll() is None:
+                        try:
+                            os.killpg(other.pid, signal.SIGTERM)
+                        except OSError:
+                            pass
+                    other.wait()
+                    other_log.close()
+                log_error('Compile failed for: %s (see %s)' % (p4file, log_file.name))
+                sys.exit(1)
+
+            if cache:
+                cache.store(keys[output_file], output_file)
+
+    if cache:
+        cache.evict()
+
 def run_mininet(manifest):
     output_file = run_compile_bmv2(manifest)
 
@@ -206,6 +498,12 @@ def run_multiswitch(manifest):
     log_dir = os.path.join(cwd, cwd + '/logs')
     print ("*** Log directory %s" % log_dir)
     script_args.append('--log-dir "%s"' % log_dir)
+    if not os.path.isdir(log_dir):
+        os.mkdir(log_dir)
+    # Hand the compile timings over to multi_switch_mininet.py, which adds
+    # its own and writes the timeline of the whole run.
+    os.environ['P4APP_TIMELINE'] = timeline.save(
+        os.path.join(log_dir, timeline.TIMELINE_FILE))
     pcap_dir = os.path.join(cwd)
     print ("*** Pcap directory %s" % cwd)
     script_args.append('--manifest "%s"' % args.manifest)
@@ -251,6 +549,26 @@ def run_multiswitch(manifest):
     program = '"%s/mininet/multi_switch_mininet.py"' % sys.path[0]
     return run_command('python2 %s %s' % (program, ' '.join(script_args)))
 
+def run_plan(manifest):
+    # Nothing is compiled or started; the planner only needs the manifest
+    # and the table entry files.
+    plan_args = []
+    plan_args.append('--manifest "%s"' % args.manifest)
+    plan_args.append('--target "%s"' % manifest.target)
+    plan_args.append('--output "%s"' % os.path.join(os.getcwd(), 'plan.json'))
+
+    program = '"%s/mininet/plan.py"' % sys.path[0]
+    return run_command('python2 %s %s' % (program, ' '.join(plan_args)))
+
+def run_cleanup(manifest):
+    # Cleanup reads what the last run recorded in its log directory (see
+    # run_multiswitch()) in cluster.CLEANUP_STATE.
+    clean_args = []
+    clean_args.append('--state "%s"' % os.path.join(os.getcwd(), 'logs', 'cleanup_state.json'))
+
+    program = '"%s/mininet/clean.py"' % sys.path[0]
+    return run_command('python2 %s %s' % (program, ' '.join(clean_args)))
+
 def run_stf(manifest):
     output_files = run_compile_bmv2(manifest)
 
@@ -289,15 +607,21 @@ def run_custom(manifest):
     return rv
 
 def main():
+    app_dir = os.path.abspath(args.app) if os.path.isdir(args.app) else None
+
     log('Entering build directory.')
     os.chdir(args.build_dir)
 
-    # A '.p4app' package is really just a '.tar.gz' archive. Extract it so we
-    # can process its contents.
-    log('Extracting package.')
-    tar = tarfile.open(args.app)
-    tar.extractall()
-    tar.close()
+    with timeline.timed('unpack'):
+        if app_dir:
+            log('Syncing app directory.')
+            sync_app_dir(app_dir)
+        else:
+            # A '.p4app' package is really just a '.tar.gz' archive. Extract it
+            # so we can process its contents; members unchanged since the last
+            # run are skipped.
+            log('Extracting package.')
+            extract_changed(args.app)
 
     log('Reading package manifest.')
     with open(args.manifest, 'r') as manifest_file:
@@ -308,7 +632,11 @@ def main():
     if 'use' in manifest.target_config:
         backend = manifest.target_config['use']
 
-    if backend == 'mininet':
+    if args.plan:
+        rc = run_plan(manifest)
+    elif args.cleanup:
+        rc = run_cleanup(manifest)
+    elif backend == 'mininet':
         rc = run_mininet(manifest)
     elif backend == 'multiswitch':
         rc = run_multiswitch(manifest)
@@ -1,10 +1,12 @@
 import argparse
+import json
 import os, shutil
 
 parser=argparse.ArgumentParser(description="traff gen scripts")
 
 parser.add_argument('--indir',dest="indir",default=None,help="provide director name")
 parser.add_argument('--kary',dest="kary",default=2,help="k value")
+parser.add_argument('--addresses',dest="addresses",default=None,help="address table of the topology (addresses.json), to take host IPs from instead of the 10.0.<tor>.<21+n> layout")
 
 args=parser.parse_args()
 print args
@@ -19,13 +21,19 @@ src_hostips=[]
 dst_hostips=[]
 start=kary+(kary*kary)
 
-for i in range(1,(numtors/2)+1):
-	for h in range(21,21+numtorhosts):
-		src_hostips.append('10.0.'+str(i)+'.'+str(h))
-
-for i in range((numtors/2)+1, numtors+1):
-	for h in range(21,21+numtorhosts):
-		dst_hostips.append('10.0.'+str(i)+'.'+str(h))
+if args.addresses != None:
+	with open(args.addresses) as f:
+		hosts=json.load(f)['hosts']
+	src_hostips=[hosts['h'+str(start+i+1)]['ip'] for i in range(0, numhosts/2)]
+	dst_hostips=[hosts['h'+str(start+i+1)]['ip'] for i in range(numhosts/2, numhosts)]
+else:
+	for i in range(1,(numtors/2)+1):
+		for h in range(21,21+numtorhosts):
+			src_hostips.append('10.0.'+str(i)+'.'+str(h))
+
+	for i in range((numtors/2)+1, numtors+1):
+		for h in range(21,21+numtorhosts):
+			dst_hostips.append('10.0.'+str(i)+'.'+str(h))
 
 print src_hostips
 print dst_hostips